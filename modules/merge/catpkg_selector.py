@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+import fnmatch
+import re
+
+regextype = type(re.compile('hello, world'))
+
+
+class CatPkgSelector:
+
+	"""
+	A CatPkgSelector is a compiled list of catpkg patterns, as used in package sets and in the select, skip and replace
+	arguments of InsertEbuilds. It answers "does this catpkg match any of the patterns?" without looking at each pattern
+	in turn:
+
+	* literal catpkgs, like ``sys-apps/portage``, are kept in a set.
+	* category globs, like ``dev-python/*``, are kept in a set of categories.
+	* ``@regex@:<regex>`` patterns, compiled regexes and any other globs are combined into a single regex, which is
+	  matched (like re.match(), so anchored at the start only) against the whole catpkg.
+
+	A catpkg matches the selector if it matches any pattern.
+	"""
+
+	def __init__(self, patterns=None):
+		self.literals = set()
+		self.categories = set()
+		self.regex = None
+		# regexes whose flags differ from the others' can't be combined, so they are matched one by one:
+		self._extra_regexes = []
+		regexes = []
+		for pattern in patterns if patterns is not None else []:
+			if isinstance(pattern, regextype):
+				regexes.append(pattern)
+			elif pattern.startswith("@regex@:"):
+				regexes.append(re.compile(pattern[8:]))
+			elif not any(c in pattern for c in "*?["):
+				self.literals.add(pattern)
+			else:
+				cat, sep, pkg = pattern.partition("/")
+				if pkg == "*" and not any(c in cat for c in "*?["):
+					self.categories.add(cat)
+				else:
+					regexes.append(re.compile(fnmatch.translate(pattern)))
+		self._compile(regexes)
+
+	def _compile(self, regexes):
+		if not len(regexes):
+			return
+		flags = regexes[0].flags
+		combinable = [ regex for regex in regexes if regex.flags == flags ]
+		self._extra_regexes = [ regex for regex in regexes if regex.flags != flags ]
+		try:
+			self.regex = re.compile("|".join("(?:%s)" % regex.pattern for regex in combinable), flags)
+		except re.error:
+			# for instance, a pattern with global inline flags like "(?i)", which can't be put inside a group:
+			self._extra_regexes = regexes
+
+	def __len__(self):
+		return len(self.literals) + len(self.categories) + (1 if self.regex is not None else 0) + len(self._extra_regexes)
+
+	def match(self, catpkg):
+		if catpkg in self.literals:
+			return True
+		if len(self.categories) and catpkg.partition("/")[0] in self.categories:
+			return True
+		if self.regex is not None and self.regex.match(catpkg):
+			return True
+		for regex in self._extra_regexes:
+			if regex.match(catpkg):
+				return True
+		return False
+
+	def __contains__(self, catpkg):
+		return self.match(catpkg)
+
+	def select(self, index):
+		"""
+		Return a sorted list of the catpkgs in the TreeIndex ``index`` that match the selector. Literals and categories
+		are looked up directly. Only regexes need a pass over all the catpkgs in the index.
+		"""
+		out = set(catpkg for catpkg in self.literals if index.catpkg_exists(catpkg))
+		for cat in self.categories:
+			out.update(cat + "/" + pkg for pkg in index.packages(cat))
+		if self.regex is not None or len(self._extra_regexes):
+			out.update(catpkg for catpkg in index.catpkgs() if catpkg not in out and self.match(catpkg))
+		return sorted(out)
+
+
+def compile_selector(value):
+	"""
+	Compile the select, skip or replace argument of a MergeStep, which is a list of patterns or a compiled regex, into a
+	CatPkgSelector. Anything else (like "all", None, True or False) is returned as-is, so callers can test for it.
+	"""
+	if isinstance(value, regextype):
+		return CatPkgSelector([ value ])
+	elif isinstance(value, (list, set, tuple)):
+		return CatPkgSelector(value)
+	return value
+
+# vim: ts=4 sw=4 noet
@@ -40,6 +40,9 @@ meta-repo = master
 
 source = /var/git/source-trees
 destination = /var/git/dest-trees
+cache = /var/cache/merge
+source_jobs = 4
+push_jobs = 4
 			""")
 			sys.exit(1)
 
@@ -50,7 +53,7 @@ destination = /var/git/dest-trees
 			"sources": [ "flora", "kit-fixups", "gentoo-staging" ],
 			"destinations": [ "base_url", "mirror", "indy_url" ],
 			"branches": [ "flora", "kit-fixups", "meta-repo" ],
-			"work": [ "source", "destination" ]
+			"work": [ "source", "destination", "cache", "source_jobs", "fetch_ttl", "objects", "push_jobs", "copy_jobs", "hardlinks" ]
 		}
 		for section, my_valids in valids.items():
 
@@ -114,3 +117,37 @@ destination = /var/git/dest-trees
 	@property
 	def dest_trees(self):
 		return self.get_option("work", "destination", "/var/git/dest-trees")
+
+	@property
+	def cache_dir(self):
+		return self.get_option("work", "cache", "/var/cache/merge")
+
+	@property
+	def source_jobs(self):
+		return int(self.get_option("work", "source_jobs", 4))
+
+	@property
+	def push_jobs(self):
+		# maximum number of concurrent pushes run by the push scheduler.
+		return int(self.get_option("work", "push_jobs", 4))
+
+	@property
+	def copy_jobs(self):
+		# number of threads used to copy files into kits -- see merge.copy_engine.
+		return int(self.get_option("work", "copy_jobs", 8))
+
+	@property
+	def hardlinks(self):
+		# hard link files into kits from source trees on the same filesystem, rather than copying them.
+		return self.get_option("work", "hardlinks", "no").lower() in [ "yes", "true", "1" ]
+
+	@property
+	def object_store(self):
+		# path to a bare repository used as a shared object store for clones. If unset, clones are independent.
+		return self.get_option("work", "objects", None)
+
+	@property
+	def fetch_ttl(self):
+		# seconds after which a repository will be re-fetched. If unset, repositories are fetched once per run.
+		ttl = self.get_option("work", "fetch_ttl", None)
+		return int(ttl) if ttl is not None else None
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+"""
+Copying of files and directories from source trees into kits, without starting a ``cp -a`` for each catpkg, eclass or
+license.
+
+copy_engine.copy() takes a list of (source, destination) pairs, and does what ``cp -a source destination`` would do
+for each of them, where destination is the path to create (not the directory to copy into). All the directories are
+created first, then the files are copied by a bounded pool of threads. Each file is copied in the cheapest way that
+works:
+
+* a hard link, if ``hardlink`` is enabled, the file is a regular file and it is on the same filesystem as its
+  destination. This is only safe because our source trees are git working trees, which git updates by replacing files
+  rather than rewriting them, and because we never rewrite a copied file in place either: we unlink the destination
+  before copying over it, and merge steps that rewrite a kit file write a new file with replace_file() instead. Hard
+  links are off by default, since anything else writing into a kit in place would also change the source tree.
+* a reflink (FICLONE), which shares the file's blocks on filesystems that support it, like btrfs and XFS.
+* copy_file_range(), which lets the kernel copy the data without it passing through us.
+* a plain read and write.
+
+Whether reflinks and copy_file_range() work is remembered for each pair of filesystems, so we don't keep trying
+something that failed. Files keep their permissions and timestamps, like they do with ``cp -a``, but not their owner,
+which git doesn't record.
+"""
+
+import asyncio
+import contextlib
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# from linux/fs.h:
+FICLONE = 0x40049409
+
+# errors that mean a way of copying isn't supported for a pair of files, rather than that something is wrong:
+UNSUPPORTED = { errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.EPERM }
+
+
+def remove_path(path):
+	# rm -rf, for a single path:
+	if os.path.isdir(path) and not os.path.islink(path):
+		shutil.rmtree(path)
+	elif os.path.lexists(path):
+		os.unlink(path)
+
+
+@contextlib.contextmanager
+def replace_file(path, mode="w"):
+	"""
+	Like open(path, mode) for writing, but the data is written to a new file, which replaces ``path`` once it has been
+	written successfully. If ``path`` is a hard link to a file in a source tree, that file isn't changed.
+	"""
+	tmp_path = "%s.%s.tmp" % (path, os.getpid())
+	try:
+		with open(tmp_path, mode) as f:
+			yield f
+		if os.path.exists(path):
+			shutil.copymode(path, tmp_path)
+		os.replace(tmp_path, path)
+	finally:
+		if os.path.lexists(tmp_path):
+			os.unlink(tmp_path)
+
+
+class CopyEngine:
+
+	def __init__(self, jobs=8, hardlink=False):
+		self.jobs = jobs
+		self.hardlink = hardlink
+		# number of files copied each way, for tracing and benchmarks:
+		self.counts = { "hardlink": 0, "reflink": 0, "copy_file_range": 0, "write": 0, "symlink": 0 }
+		self.bytes = 0
+		# (source st_dev, destination st_dev) -> ways of copying that don't work between them:
+		self._unsupported = {}
+		self._lock = threading.Lock()
+
+	def _walk(self, src, dest, dirs, files):
+		# plan a "cp -a src dest" -- directories to create, and files and symlinks to copy:
+		st = os.lstat(src)
+		if stat.S_ISDIR(st.st_mode):
+			if os.path.isdir(dest) and not os.path.islink(dest):
+				# cp -a merges into an existing directory, without touching its attributes:
+				pass
+			else:
+				if os.path.lexists(dest):
+					os.unlink(dest)
+				dirs.append((src, dest, st))
+			with os.scandir(src) as it:
+				for entry in sorted(it, key=lambda entry: entry.name):
+					self._walk(entry.path, os.path.join(dest, entry.name), dirs, files)
+		else:
+			files.append((src, dest, st))
+
+	def _unsupportedFor(self, st, dest_dev):
+		key = (st.st_dev, dest_dev)
+		with self._lock:
+			if key not in self._unsupported:
+				self._unsupported[key] = set()
+			return self._unsupported[key]
+
+	def _copyData(self, src, dest, st, dest_dev):
+		unsupported = self._unsupportedFor(st, dest_dev)
+		with open(src, "rb") as fsrc:
+			fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+			with open(fd, "wb") as fdest:
+				if "reflink" not in unsupported:
+					try:
+						fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+						return "reflink"
+					except OSError as e:
+						if e.errno not in UNSUPPORTED:
+							raise
+						unsupported.add("reflink")
+				if "copy_file_range" not in unsupported and hasattr(os, "copy_file_range"):
+					copied = 0
+					try:
+						while copied < st.st_size:
+							count = os.copy_file_range(fsrc.fileno(), fdest.fileno(), st.st_size - copied)
+							if count == 0:
+								break
+							copied += count
+						return "copy_file_range"
+					except OSError as e:
+						if e.errno not in UNSUPPORTED or copied != 0:
+							raise
+						unsupported.add("copy_file_range")
+				shutil.copyfileobj(fsrc, fdest, 1024 * 1024)
+				return "write"
+
+	def _copyFile(self, src, dest, st, dest_dev):
+		if os.path.lexists(dest):
+			# never write into an existing file, which may be a hard link to a source tree:
+			if os.path.isdir(dest) and not os.path.islink(dest):
+				shutil.rmtree(dest)
+			else:
+				os.unlink(dest)
+		if stat.S_ISLNK(st.st_mode):
+			os.symlink(os.readlink(src), dest)
+			os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+			return "symlink", 0
+		if not stat.S_ISREG(st.st_mode):
+			raise OSError(errno.EINVAL, "Can't copy special file", src)
+		if self.hardlink and st.st_dev == dest_dev:
+			try:
+				os.link(src, dest)
+				return "hardlink", 0
+			except OSError as e:
+				if e.errno not in UNSUPPORTED and e.errno != errno.EMLINK:
+					raise
+		how = self._copyData(src, dest, st, dest_dev)
+		os.chmod(dest, stat.S_IMODE(st.st_mode))
+		os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+		return how, st.st_size
+
+	def copySync(self, pairs):
+		"""
+		Copy each (source, destination) pair like ``cp -a source destination``, where destination doesn't have to exist
+		yet. Later pairs win if their destinations overlap.
+		"""
+		dirs = []
+		files = []
+		for src, dest in pairs:
+			self._walk(src, dest, dirs, files)
+		# create all the directories up front, so the files can be copied in any order:
+		for src, dest, st in dirs:
+			os.makedirs(dest, exist_ok=True)
+		dest_devs = {}
+
+		def copy_file(item):
+			src, dest, st = item
+			parent = os.path.dirname(dest)
+			if parent not in dest_devs:
+				dest_devs[parent] = os.stat(parent).st_dev
+			return self._copyFile(src, dest, st, dest_devs[parent])
+
+		# files with the same destination (from overlapping pairs) must be copied in order, so only copy the last one:
+		last = {}
+		for item in files:
+			last[item[1]] = item
+		if self.jobs > 1 and len(last) > 1:
+			with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+				results = list(executor.map(copy_file, last.values()))
+		else:
+			results = [ copy_file(item) for item in last.values() ]
+		with self._lock:
+			for how, size in results:
+				self.counts[how] += 1
+				self.bytes += size
+		# like cp -a, set the attributes of new directories last, since copying files into them changes their mtime:
+		for src, dest, st in reversed(dirs):
+			os.chmod(dest, stat.S_IMODE(st.st_mode))
+			os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+	async def copy(self, pairs):
+		pairs = list(pairs)
+		if not len(pairs):
+			return
+		await asyncio.get_event_loop().run_in_executor(None, self.copySync, pairs)
+
+
+# shared by all MergeSteps. merge-all-kits configures it from the [work] section of ~/.merge:
+copy_engine = CopyEngine()
+
+# vim: ts=4 sw=4 noet
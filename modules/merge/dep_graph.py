@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+import os
+from array import array
+
+import portage
+from portage.dep import use_reduce, dep_getkey, flatten
+from merge.md5cache import tree_metadata
+from merge.portdb_pool import metadata_generation
+from merge.tree_index import TreeIndex
+
+
+def portage_dep_keys(depstring):
+	"""
+	Return the catpkgs in a DEPEND or RDEPEND string, whatever the USE flags, without blockers. This is how
+	@depsincat@ has always read dependencies. Raises ValueError for malformed strings.
+	"""
+	out = []
+	try:
+		deps = flatten(use_reduce(depstring, matchall=True))
+	except portage.exception.InvalidDependString as e:
+		raise ValueError(str(e))
+	for dep in deps:
+		if len(dep) and dep[0] == "!":
+			continue
+		try:
+			out.append(dep_getkey(dep))
+		except portage.exception.InvalidAtom:
+			continue
+	return out
+
+
+class DepGraph:
+
+	"""
+	A DepGraph is the catpkg -> catpkg dependency graph of the ebuilds in a tree and its masters (core-kit), with an edge
+	from each catpkg to everything any of its ebuilds depends on (DEPEND or RDEPEND), whichever repository they are in --
+	the ebuilds portage's cp_list() returns for it. Each catpkg is a node, numbered in ``catpkgs``: first those in the
+	tree, then those only in its masters, then the dependencies that are in neither, which have no edges of their own.
+
+	The edges are kept as integer arrays, in compressed sparse row form: the dependencies of node ``n`` are
+	``targets[offsets[n]:offsets[n + 1]]``. The reverse graph (who depends on a catpkg) is built the same way the first
+	time it is needed. Bounded-depth searches, as @depsincat@ does, are memoized per node and depth.
+	"""
+
+	def __init__(self):
+		self.catpkgs = []
+		self.ids = {}
+		# number of nodes that are in the tree -- they come first:
+		self.in_tree_count = 0
+		self.offsets = array("I", [ 0 ])
+		self.targets = array("I")
+		self._reverse = None
+		# (node, levels) -> frozenset of nodes:
+		self._memo = {}
+
+	def _node(self, catpkg):
+		if catpkg not in self.ids:
+			self.ids[catpkg] = len(self.catpkgs)
+			self.catpkgs.append(catpkg)
+		return self.ids[catpkg]
+
+	@classmethod
+	def build(cls, table, dep_keys=portage_dep_keys, masters=()):
+		"""
+		Build the graph of the tree whose metadata is in the MetadataTable ``table``, and of its ``masters``, the
+		MetadataTables of its master repositories. ``dep_keys`` turns a dependency string into a list of catpkgs, raising
+		ValueError if it can't.
+		"""
+		graph = cls()
+		packages = table.packages()
+		for catpkg in packages:
+			graph._node(catpkg)
+		graph.in_tree_count = len(packages)
+		for master in masters:
+			for catpkg in master.packages():
+				graph._node(catpkg)
+		known = graph.catpkgs[:]
+		for catpkg in known:
+			deps = set()
+			for cur_table in [ table ] + list(masters):
+				for cpv, depend in cur_table.column("DEPEND", catpkg):
+					depstring = depend + " " + cur_table.get(cpv, [ "RDEPEND" ])[0]
+					try:
+						deps.update(dep_keys(depstring))
+					except ValueError as e:
+						print("bad dep string in %s: %s (%s)" % (cpv, depstring, e))
+			graph.targets.extend(sorted(graph._node(dep) for dep in deps))
+			graph.offsets.append(len(graph.targets))
+		# dependencies outside the tree and its masters have no edges:
+		graph.offsets.extend([ len(graph.targets) ] * (len(graph.catpkgs) - len(known)))
+		return graph
+
+	def __len__(self):
+		return len(self.catpkgs)
+
+	def in_tree(self, catpkg):
+		return catpkg in self.ids and self.ids[catpkg] < self.in_tree_count
+
+	def tree_catpkgs(self):
+		return self.catpkgs[:self.in_tree_count]
+
+	def _edges(self, node, offsets, targets):
+		return targets[offsets[node]:offsets[node + 1]]
+
+	def dependencies(self, catpkg):
+		"""Return the catpkgs that ``catpkg`` depends on directly."""
+		if catpkg not in self.ids:
+			return []
+		return [ self.catpkgs[dep] for dep in self._edges(self.ids[catpkg], self.offsets, self.targets) ]
+
+	def _reverseGraph(self):
+		if self._reverse is None:
+			# only edges from catpkgs in the tree, which come first:
+			tree_targets = self.targets[:self.offsets[self.in_tree_count]]
+			counts = array("I", [ 0 ]) * (len(self.catpkgs) + 1)
+			for target in tree_targets:
+				counts[target + 1] += 1
+			offsets = array("I", [ 0 ]) * (len(self.catpkgs) + 1)
+			for node in range(len(self.catpkgs)):
+				offsets[node + 1] = offsets[node] + counts[node + 1]
+			targets = array("I", [ 0 ]) * len(tree_targets)
+			fill = array("I", offsets)
+			for node in range(self.in_tree_count):
+				for target in self._edges(node, self.offsets, self.targets):
+					targets[fill[target]] = node
+					fill[target] += 1
+			self._reverse = (offsets, targets)
+		return self._reverse
+
+	def dependents(self, catpkg):
+		"""Return the catpkgs in the tree that depend on ``catpkg`` directly."""
+		if catpkg not in self.ids:
+			return []
+		offsets, targets = self._reverseGraph()
+		return [ self.catpkgs[dep] for dep in self._edges(self.ids[catpkg], offsets, targets) ]
+
+	def _reachable(self, node, levels):
+		key = (node, levels)
+		if key not in self._memo:
+			found = set()
+			frontier = [ node ]
+			for level in range(0, levels + 1):
+				next_frontier = []
+				for cur in frontier:
+					for dep in self._edges(cur, self.offsets, self.targets):
+						if dep not in found:
+							found.add(dep)
+							next_frontier.append(dep)
+				frontier = next_frontier
+				if not len(frontier):
+					break
+			self._memo[key] = frozenset(found)
+		return self._memo[key]
+
+	def reachable(self, catpkgs, levels=0):
+		"""
+		Return the set of catpkgs that ``catpkgs`` depend on: their direct dependencies, and with ``levels`` > 0,
+		dependencies of dependencies, up to ``levels`` more steps away. ``catpkgs`` may be a single catpkg.
+		"""
+		if isinstance(catpkgs, str):
+			catpkgs = [ catpkgs ]
+		out = set()
+		for catpkg in catpkgs:
+			if catpkg in self.ids:
+				out.update(self._reachable(self.ids[catpkg], levels))
+		return set(self.catpkgs[node] for node in out)
+
+
+class CoreKitTree:
+
+	# just enough of a Tree for tree_metadata() to read the core-kit that ``tree`` is generated against:
+
+	name = "core-kit"
+
+	def __init__(self, tree):
+		self.root = os.path.join(tree.config.dest_trees, "core-kit")
+		self.config = tree.config
+		self._index = None
+
+	@property
+	def index(self):
+		if self._index is None:
+			self._index = TreeIndex.scan(self.root)
+		return self._index
+
+
+# (tree root, depcachedir) -> ((generations of the tree and core-kit), DepGraph)
+_graphs = {}
+
+
+async def tree_dep_graph(tree, depcachedir=None):
+	"""
+	Return the DepGraph of ``tree`` and core-kit, the repositories portage sees for the tree (see
+	merge.portdb_pool.portage_env()), built from their metadata once for each state of the tree and core-kit.
+	"""
+	root = os.path.normpath(tree.root)
+	core_kit = CoreKitTree(tree)
+	key = (root, depcachedir)
+	generations = (metadata_generation(root), metadata_generation(core_kit.root))
+	if key in _graphs and _graphs[key][0] == generations:
+		return _graphs[key][1]
+	masters = []
+	if os.path.normpath(core_kit.root) != root and os.path.isdir(core_kit.root):
+		masters.append(await tree_metadata(core_kit, depcachedir=depcachedir))
+	graph = DepGraph.build(await tree_metadata(tree, depcachedir=depcachedir), masters=masters)
+	_graphs[key] = (generations, graph)
+	return graph
+
+# vim: ts=4 sw=4 noet
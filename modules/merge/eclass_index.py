@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+import os
+
+from merge.md5cache import tree_metadata
+from merge.portdb_pool import metadata_generation
+
+
+class EclassIndex:
+
+	"""
+	An EclassIndex maps each eclass inherited by the ebuilds of a tree to the set of catpkgs with at least one ebuild
+	that inherits it, directly or not. It is built from the tree's MetadataTable in one pass, and then answers all the
+	@has_eclass@ and @cat_has_eclass@ package-set patterns, for all kits, with a dictionary lookup.
+
+	Like a TreeIndex, an EclassIndex of a committed tree can be saved to disk and loaded back in later runs, as long as
+	the tree is still at commit ``sha1``. This is only safe if all the eclasses the tree uses are in the tree itself
+	(see selfContained()), since an eclass from core-kit can change without the tree changing.
+	"""
+
+	file_magic = "ECLASSINDEX1"
+
+	def __init__(self, sha1=None):
+		self.sha1 = sha1
+		# format: { 'eclass' : { 'cat/pkg', ... } }
+		self._catpkgs = {}
+
+	@classmethod
+	def build(cls, table, sha1=None):
+		index = cls(sha1=sha1)
+		catpkgs = index._catpkgs
+		for catpkg, inherited in zip(table.catpkgs, table.columns["INHERITED"]):
+			for eclass in inherited.split():
+				if eclass not in catpkgs:
+					catpkgs[eclass] = set()
+				catpkgs[eclass].add(catpkg)
+		return index
+
+	@property
+	def eclasses(self):
+		return sorted(self._catpkgs.keys())
+
+	def catpkgs(self, eclass, categories=None):
+		"""Return the set of catpkgs that inherit ``eclass``, optionally only those in ``categories``."""
+		out = self._catpkgs.get(eclass, set())
+		if categories is None:
+			return set(out)
+		return set(catpkg for catpkg in out if catpkg.partition("/")[0] in categories)
+
+	def selfContained(self, root):
+		return all(os.path.exists(os.path.join(root, "eclass", eclass + ".eclass")) for eclass in self._catpkgs)
+
+	def save(self, path):
+		"""
+		Write the index to ``path``: a header line, then one ``eclass<TAB>catpkg<TAB>catpkg...`` line per eclass. The
+		file is replaced atomically.
+		"""
+		lines = [ "%s %s" % (self.file_magic, self.sha1 or "-") ]
+		for eclass in self.eclasses:
+			lines.append("\t".join([ eclass ] + sorted(self._catpkgs[eclass])))
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp_path = "%s.%s.tmp" % (path, os.getpid())
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			f.write("\n".join(lines) + "\n")
+		os.replace(tmp_path, path)
+
+	@classmethod
+	def load(cls, path):
+		"""Load an index written by save(), returning None if ``path`` does not exist or is not a valid index."""
+		try:
+			with open(path, "r", encoding="utf-8") as f:
+				lines = f.read().split("\n")
+		except FileNotFoundError:
+			return None
+		header = lines[0].split()
+		if len(header) != 2 or header[0] != cls.file_magic:
+			return None
+		index = cls(sha1=None if header[1] == "-" else header[1])
+		for line in lines[1:]:
+			if not line:
+				continue
+			fields = line.split("\t")
+			index._catpkgs[fields[0]] = set(fields[1:])
+		return index
+
+
+def eclass_index_path(tree):
+	if getattr(tree, "config", None) is None or not hasattr(tree.config, "cache_dir"):
+		return None
+	return os.path.join(tree.config.cache_dir, "eclass-index", os.path.normpath(tree.root).strip("/").replace("/", "_") + ".idx")
+
+
+# tree root -> ((HEAD SHA1 or generation of the tree, generation of core-kit), EclassIndex)
+_indexes = {}
+
+
+async def tree_eclass_index(tree):
+	"""
+	Return the EclassIndex of ``tree``. It is built once per run for each state of the tree, and for a clean GitTree it
+	is kept on disk keyed by the tree's HEAD SHA1, so later runs don't have to look at its metadata at all.
+	"""
+	root = os.path.normpath(tree.root)
+	sha1 = None if getattr(tree, "dirty", True) else tree.head()
+	# eclasses from core-kit may change while the tree doesn't:
+	key = (sha1 if sha1 is not None else metadata_generation(root), metadata_generation(os.path.join(tree.config.dest_trees, "core-kit")))
+	if root in _indexes and _indexes[root][0] == key:
+		return _indexes[root][1]
+	cache_path = eclass_index_path(tree) if sha1 is not None else None
+	index = EclassIndex.load(cache_path) if cache_path is not None else None
+	if index is None or index.sha1 != sha1:
+		index = EclassIndex.build(await tree_metadata(tree), sha1=sha1)
+		if cache_path is not None and index.selfContained(tree.root):
+			index.save(cache_path)
+	_indexes[root] = (key, index)
+	return index
+
+# vim: ts=4 sw=4 noet
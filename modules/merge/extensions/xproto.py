@@ -2,6 +2,7 @@
 
 import os
 from merge.merge_utils import runShell, MergeStep, CreateEbuildFromTemplate, get_catpkg_from_ebuild_path
+from merge.portdb_pool import portage_env
 from glob import glob
 from collections import defaultdict
 import itertools
@@ -55,30 +56,7 @@ class XProtoStepGenerator(MergeStep):
 		the meson package name, and the meson version.
 		"""
 
-		env = os.environ.copy()
-		env['PORTAGE_DEPCACHEDIR'] = '/var/cache/edb/%s-%s-meta' % (tree.name, tree.branch)
-		if tree.name != "core-kit":
-			env['PORTAGE_REPOSITORIES'] = '''
-[DEFAULT]
-main-repo = core-kit
-
-[core-kit]
-location = %s/core-kit
-aliases = gentoo
-
-[%s]
-location = %s
-		''' % (tree.config.dest_trees, tree.name, tree.root)
-		else:
-			env['PORTAGE_REPOSITORIES'] = '''
-[DEFAULT]
-main-repo = core-kit
-
-[core-kit]
-location = %s/core-kit
-aliases = gentoo
-		''' % tree.config.dest_trees
-
+		env = portage_env(tree, depcachedir='/var/cache/edb/%s-%s-meta' % (tree.name, tree.branch))
 		sdata = meta_pkg_ebuild_path.rstrip(".ebuild").split("/")
 		master_cpv = sdata[-3] + "/" + sdata[-1]
 		success = await runShell("(cd %s; ebuild %s clean unpack)" % (os.path.dirname(meta_pkg_ebuild_path), os.path.basename(meta_pkg_ebuild_path)), abort_on_failure=False, env=env)
@@ -105,31 +83,6 @@ aliases = gentoo
 		:return: None
 		"""
 
-		env = os.environ.copy()
-		env['PORTAGE_DEPCACHEDIR'] = '/var/cache/edb/%s-%s-meta' % (tree.name, tree.branch)
-		if tree.name != "core-kit":
-			env['PORTAGE_REPOSITORIES'] = '''
-		[DEFAULT]
-		main-repo = core-kit
-
-		[core-kit]
-		location = %s/core-kit
-		aliases = gentoo
-
-		[%s]
-		location = %s
-		''' % (tree.config.dest_trees, tree.name, tree.root)
-		else:
-			env['PORTAGE_REPOSITORIES'] = '''
-		[DEFAULT]
-		main-repo = core-kit
-
-		[core-kit]
-		location = %s/core-kit
-		aliases = gentoo
-		''' % tree.config.dest_trees
-
-
 		all_meta_pkg_ebuilds = list(glob(tree.root + "/x11-base/xorg-proto/xorg-proto-*.ebuild"))
 		futures =[
 			self.loop.run_in_executor(self.cpu_bound_executor, self.run_async_in_executor, self.worker_async, meta_pkg_ebuild_path, tree)
@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+
+"""
+Reading of ebuild metadata straight out of a tree's metadata cache, without asking portage for it one cpv at a time.
+
+After GenCache has run, the metadata of every ebuild in a kit is in metadata/md5-cache, one ``KEY=value`` file per
+ebuild. load_table() reads a whole cache directory, a category per thread, into a MetadataTable, which keeps each key
+we care about (see COLUMNS) as a column, so callers can answer questions like "which catpkgs inherit this eclass?" or
+"which licenses does this kit use?" with a pass over a list instead of thousands of async_aux_get() calls.
+
+An entry is only used if it is still valid -- if the md5 of its ebuild and of each eclass it inherits matches what the
+entry recorded, which is the check portage itself does. Caches written by ``egencache --cache-dir`` (flat_hash, which
+records mtimes and eclass paths rather than md5s) are read too. Entries that are stale or missing are returned by
+load_table(), and tree_metadata() fills them in with portage, so its tables are always complete.
+"""
+
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from portage.util.futures.iter_completed import async_iter_completed
+from merge.portdb_pool import metadata_generation, portdb_pool
+from merge.tracing import tracer
+
+# the metadata we keep. INHERITED is not in md5-cache entries -- it is the list of eclasses in _eclasses_, like portage
+# returns it from aux_get():
+COLUMNS = ( "INHERITED", "LICENSE", "SRC_URI", "RESTRICT", "DEPEND", "RDEPEND", "IUSE", "KEYWORDS", "_eclasses_" )
+
+# the same, as we ask portage for it when an entry is stale or missing. _eclasses_ is left empty for these entries:
+AUX_KEYS = [ key for key in COLUMNS if key != "_eclasses_" ]
+
+
+class MetadataTable:
+
+	"""
+	Metadata of the ebuilds in a tree, with a row per cpv and a column per key in COLUMNS. Rows are in the order of
+	the tree's TreeIndex (sorted by category, package, then ebuild file name). Values are the strings portage's
+	aux_get() would return, so "" for keys an ebuild doesn't set.
+	"""
+
+	def __init__(self, root):
+		self.root = root
+		self.cpvs = []
+		self.catpkgs = []
+		self.columns = { key : [] for key in COLUMNS }
+		self._rows = {}
+		self._catpkg_rows = {}
+		# see kit_metadata():
+		self._kit_metadata = None
+
+	def add(self, catpkg, cpv, values):
+		self._kit_metadata = None
+		if cpv in self._rows:
+			row = self._rows[cpv]
+			for key in COLUMNS:
+				self.columns[key][row] = values.get(key, "")
+			return
+		row = len(self.cpvs)
+		self._rows[cpv] = row
+		self.cpvs.append(cpv)
+		self.catpkgs.append(catpkg)
+		if catpkg not in self._catpkg_rows:
+			self._catpkg_rows[catpkg] = []
+		self._catpkg_rows[catpkg].append(row)
+		for key in COLUMNS:
+			self.columns[key].append(values.get(key, ""))
+
+	def __len__(self):
+		return len(self.cpvs)
+
+	def __contains__(self, cpv):
+		return cpv in self._rows
+
+	def get(self, cpv, keys):
+		"""Return the values of ``keys`` for ``cpv``, like aux_get() does. Raises KeyError for unknown cpvs."""
+		row = self._rows[cpv]
+		return [ self.columns[key][row] for key in keys ]
+
+	def column(self, key, catpkg=None):
+		"""Yield (cpv, value) for ``key``, for every ebuild in the tree, or only those of ``catpkg``."""
+		values = self.columns[key]
+		if catpkg is None:
+			return zip(self.cpvs, values)
+		return ((self.cpvs[row], values[row]) for row in self._catpkg_rows.get(catpkg, []))
+
+	def packages(self):
+		"""Return the catpkgs with ebuilds in the table, in tree order."""
+		return list(self._catpkg_rows.keys())
+
+
+class _Validator:
+
+	# checks cache entries against the ebuilds and eclasses they were generated from. Shared by the loading threads.
+
+	def __init__(self, root, eclass_dirs):
+		self.root = root
+		self.eclass_dirs = eclass_dirs
+		self._eclasses = {}
+
+	def _findEclass(self, eclass):
+		# the first eclass dir wins, as the tree's own eclasses override its master's:
+		if eclass not in self._eclasses:
+			found = None
+			for eclass_dir in self.eclass_dirs:
+				path = os.path.join(eclass_dir, eclass + ".eclass")
+				try:
+					st = os.stat(path)
+				except FileNotFoundError:
+					continue
+				with open(path, "rb") as f:
+					found = (path, str(st.st_mtime_ns // 1000000000), hashlib.md5(f.read()).hexdigest())
+				break
+			self._eclasses[eclass] = found
+		return self._eclasses[eclass]
+
+	def valid(self, entry, ebuild_path):
+		if "_md5_" in entry:
+			try:
+				with open(ebuild_path, "rb") as f:
+					if hashlib.md5(f.read()).hexdigest() != entry["_md5_"]:
+						return False
+			except FileNotFoundError:
+				return False
+			fields = entry["_eclasses_"].split("\t") if entry.get("_eclasses_") else []
+			for eclass, md5 in zip(fields[0::2], fields[1::2]):
+				found = self._findEclass(eclass)
+				if found is None or found[2] != md5:
+					return False
+			return len(fields) % 2 == 0
+		elif "_mtime_" in entry:
+			try:
+				if str(os.stat(ebuild_path).st_mtime_ns // 1000000000) != entry["_mtime_"]:
+					return False
+			except FileNotFoundError:
+				return False
+			fields = entry.get("_eclasses_", "").split("\t") if entry.get("_eclasses_") else []
+			for eclass, path, mtime in zip(fields[0::3], fields[1::3], fields[2::3]):
+				found = self._findEclass(eclass)
+				if found is None or os.path.dirname(found[0]) != path or found[1] != mtime:
+					return False
+			return len(fields) % 3 == 0
+		return False
+
+
+def _eclass_names(entry):
+	# _eclasses_ is "name<tab>md5<tab>name<tab>md5..." in md5-dict entries, and "name<tab>path<tab>mtime..." in flat_hash:
+	if not entry.get("_eclasses_"):
+		return ""
+	fields = entry["_eclasses_"].split("\t")
+	return " ".join(fields[0::2] if "_md5_" in entry else fields[0::3])
+
+
+def _read_entry(path):
+	try:
+		with open(path, "r", encoding="utf-8", errors="replace") as f:
+			data = f.read()
+	except (FileNotFoundError, NotADirectoryError):
+		return None
+	entry = {}
+	for line in data.split("\n"):
+		key, sep, value = line.partition("=")
+		if sep:
+			entry[key] = value
+	return entry
+
+
+def _load_category(cat, packages, cache_dirs, validator):
+	# returns [ (catpkg, cpv, values or None if stale or missing), ... ] for one category:
+	out = []
+	for pkg, ebuilds in packages:
+		catpkg = cat + "/" + pkg
+		for ebuild in ebuilds:
+			pf = ebuild[:-7]
+			cpv = cat + "/" + pf
+			ebuild_path = os.path.join(validator.root, catpkg, ebuild)
+			values = None
+			for cache_dir in cache_dirs:
+				entry = _read_entry(os.path.join(cache_dir, cat, pf))
+				if entry is None or not validator.valid(entry, ebuild_path):
+					continue
+				values = { key : entry.get(key, "") for key in COLUMNS }
+				values["INHERITED"] = _eclass_names(entry)
+				break
+			out.append((catpkg, cpv, values))
+	return out
+
+
+def load_table(root, index, eclass_dirs, cache_dirs, jobs=8):
+	"""
+	Read the cache entries for all the ebuilds in ``index`` (the TreeIndex of the tree at ``root``) from the first of
+	``cache_dirs`` that has a valid entry for each. ``eclass_dirs`` are the tree's eclass directories, its own first.
+	Returns a MetadataTable of the valid entries, and a list of (catpkg, cpv) of ebuilds that have none.
+	"""
+	table = MetadataTable(root)
+	stale = []
+	validator = _Validator(root, eclass_dirs)
+	cache_dirs = [ cache_dir for cache_dir in cache_dirs if os.path.isdir(cache_dir) ]
+	work = [ (cat, [ (pkg, index.ebuilds(cat + "/" + pkg)) for pkg in index.packages(cat) ]) for cat in index.categories ]
+	if jobs > 1 and len(work) > 1:
+		with ThreadPoolExecutor(max_workers=jobs) as executor:
+			results = list(executor.map(lambda item: _load_category(item[0], item[1], cache_dirs, validator), work))
+	else:
+		results = [ _load_category(cat, packages, cache_dirs, validator) for cat, packages in work ]
+	for result in results:
+		for catpkg, cpv, values in result:
+			if values is None:
+				stale.append((catpkg, cpv))
+				# keep its place in tree order, to be filled in by portage:
+				values = {}
+			table.add(catpkg, cpv, values)
+	return table, stale
+
+
+def parse_licenses(value):
+	"""
+	Return the license names in a LICENSE value, in order and without duplicates, including those in ``|| ( )`` and
+	USE-conditional groups, whatever the USE flags. Raises ValueError if the groups aren't well-formed.
+	"""
+	out = []
+	depth = 0
+	# after "||" or "flag?", which must be followed by a group:
+	need_group = False
+	prev = None
+	for token in value.split():
+		if need_group and token != "(":
+			raise ValueError("expected ( after %s" % prev)
+		if token == "(":
+			depth += 1
+			need_group = False
+		elif token == ")":
+			if depth == 0:
+				raise ValueError("unbalanced )")
+			depth -= 1
+		elif token == "||" or token.endswith("?"):
+			need_group = True
+		elif token not in out:
+			out.append(token)
+		prev = token
+	if depth or need_group:
+		raise ValueError("unterminated group")
+	return out
+
+
+class KitMetadata:
+
+	"""
+	The eclasses and licenses used by the ebuilds of a kit, collected in one pass over its MetadataTable.
+	``eclasses`` and ``licenses`` are sets of names, and ``cpv_eclasses`` and ``cpv_licenses`` map each cpv to a tuple
+	of the names it uses.
+	"""
+
+	def __init__(self):
+		self.eclasses = set()
+		self.licenses = set()
+		self.cpv_eclasses = {}
+		self.cpv_licenses = {}
+
+	def collect(self, table):
+		for cpv, inherited, license in zip(table.cpvs, table.columns["INHERITED"], table.columns["LICENSE"]):
+			eclasses = tuple(inherited.split())
+			try:
+				licenses = tuple(parse_licenses(license))
+			except ValueError as e:
+				print("!!! Invalid LICENSE in %s (%s): %s" % (cpv, e, license))
+				licenses = tuple(x for x in license.split() if x not in [ "(", ")", "||" ] and not x.endswith("?"))
+			self.cpv_eclasses[cpv] = eclasses
+			self.cpv_licenses[cpv] = licenses
+			self.eclasses.update(eclasses)
+			self.licenses.update(licenses)
+		return self
+
+
+def kit_metadata(table):
+	"""
+	Return the KitMetadata of a MetadataTable, collecting it the first time it is asked for. The eclass QA check in
+	GenCache and the pruning of unused licenses in finalizeKit() both use this, so they share a single pass as long as
+	no ebuild or eclass changes in between.
+	"""
+	if table._kit_metadata is None:
+		table._kit_metadata = KitMetadata().collect(table)
+	return table._kit_metadata
+
+
+def cache_dirs(tree, depcachedir=None):
+	"""Where the metadata cache for ``tree`` may be: its md5-cache, then the flat_hash cache egencache --cache-dir writes."""
+	out = [ os.path.join(tree.root, "metadata/md5-cache") ]
+	if depcachedir is not None:
+		out.append(os.path.join(depcachedir, tree.root.lstrip(os.sep)))
+	return out
+
+
+def eclass_dirs(tree):
+	out = [ os.path.join(tree.root, "eclass") ]
+	core_kit = os.path.join(tree.config.dest_trees, "core-kit")
+	if os.path.normpath(core_kit) != os.path.normpath(tree.root):
+		out.append(os.path.join(core_kit, "eclass"))
+	return out
+
+
+# (tree root, depcachedir) -> (generations of the tree and core-kit, MetadataTable)
+_tables = {}
+
+# for tracing and benchmarks:
+stats = { "loaded" : 0, "from_portage" : 0, "reused" : 0 }
+
+
+async def tree_metadata(tree, depcachedir=None, jobs=8):
+	"""
+	Return a complete MetadataTable for ``tree``, reading it from the tree's metadata cache, and asking portage (through
+	the portdbapi pool) for the ebuilds whose entries are stale or missing. Tables are kept until the metadata of the
+	tree or core-kit may have changed (see merge.portdb_pool.affects_metadata()).
+	"""
+	root = os.path.normpath(tree.root)
+	core_kit = os.path.join(tree.config.dest_trees, "core-kit")
+	key = (root, depcachedir)
+	generations = (metadata_generation(root), metadata_generation(core_kit))
+	if key in _tables and _tables[key][0] == generations:
+		stats["reused"] += 1
+		return _tables[key][1]
+	index = tree.index
+	with tracer.span("md5-cache", "portage", tree=tree.name):
+		table, stale = await asyncio.get_event_loop().run_in_executor(None, load_table, tree.root, index, eclass_dirs(tree), cache_dirs(tree, depcachedir), jobs)
+	stats["loaded"] += len(table) - len(stale)
+	if len(stale):
+		p = portdb_pool.get(tree, depcachedir=depcachedir)
+		future_aux = {}
+
+		def future_generator():
+			for catpkg, cpv in stale:
+				my_future = p.async_aux_get(cpv, AUX_KEYS, mytree=tree.root)
+				future_aux[id(my_future)] = (catpkg, cpv)
+				yield my_future
+
+		with tracer.span("aux_get", "portage", caller="tree_metadata"):
+			for fu_fu in async_iter_completed(future_generator()):
+				future_set = await fu_fu
+				for future in future_set:
+					catpkg, cpv = future_aux.pop(id(future))
+					try:
+						result = future.result()
+					except KeyError as e:
+						print("aux_get fail", cpv, e)
+					else:
+						table.add(catpkg, cpv, dict(zip(AUX_KEYS, result)))
+		stats["from_portage"] += len(stale)
+	_tables[key] = (generations, table)
+	return table
+
+
+def summary():
+	return "md5-cache: %s entries read, %s from portage, %s tables reused." % (stats["loaded"], stats["from_portage"], stats["reused"])
+
+# vim: ts=4 sw=4 noet
@@ -1,23 +1,36 @@
 #!/usr/bin/python3
 
+import bisect
 import glob
+import gzip
+import hashlib
 import itertools
+import json
 import os
 import shutil
 import subprocess
 import sys
 import re
+import tempfile
+import time
 from lxml import etree
 import portage
 portage._internal_caller = True
-from portage.dep import use_reduce, dep_getkey, flatten
-from portage.exception import PortageKeyError
 import grp
 import pwd
 import multiprocessing
-from collections import defaultdict
-from portage.util.futures.iter_completed import async_iter_completed
+from collections import defaultdict, OrderedDict
 from merge.async_portage import async_xmatch
+from merge.catpkg_selector import CatPkgSelector, compile_selector, regextype
+from merge.copy_engine import copy_engine, remove_path, replace_file
+from merge.dep_graph import tree_dep_graph
+from merge.eclass_index import tree_eclass_index
+from merge.md5cache import kit_metadata, tree_metadata
+from merge.portdb_pool import portdb_pool, tree_changed
+from merge.tree_index import TreeIndex
+from merge.step_graph import step_dependencies, resource_pathspecs
+from merge.step_memo import StepMemo, memoizable, step_fingerprint
+from merge.tracing import tracer
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import cpu_count
@@ -120,7 +133,9 @@ class RepositoryStepsCollector:
 
 	async def run_steps_in_tree(self, tree):
 		for step in self.steps:
+			tree.journalStep(step)
 			await step.run(tree)
+			tree.invalidateIndex()
 
 class MergeStep:
 
@@ -128,6 +143,20 @@ class MergeStep:
 	cpu_bound_executor = ThreadPoolExecutor(max_workers=cpu_count())
 	# This is only used for Repository Steps:
 	collector = None
+	# Steps that report every path they create, modify or delete in a tree with tree.journal() set this to True. If a
+	# step that isn't journaled runs on a GitTree, the next commit has to scan the whole tree for changes:
+	journaled = False
+	# The parts of the tree this step reads and writes -- see merge.step_graph. None means the whole tree. Steps that
+	# declare both can be run concurrently with other steps that they don't conflict with, by GitTree.run():
+	reads = None
+	writes = None
+	# Steps that declare their reads and writes can set this to True, so that GitTrees with a step memo skip running
+	# them when nothing they read has changed since they last ran -- see merge.step_memo:
+	memoize = False
+
+	def memoParams(self):
+		# the parameters that the output of this step depends on, for memoization:
+		return sorted((key, value) for key, value in vars(self).items() if isinstance(value, (str, int, float, bool, list, tuple, dict, type(None))))
 
 	def run_async_in_executor(self, corofn, *args):
 
@@ -167,6 +196,9 @@ def get_catpkg_from_ebuild_path(path):
 
 class RunRepositoryStepsIfAvailable(MergeStep):
 
+	# the repository steps we run are journaled (or not) individually, by run_steps_in_tree():
+	journaled = True
+
 	def __init__(self, fixup_root, cpm_logger):
 		self.fixup_root = fixup_root # the "master" repo root
 		self.cpm_logger = cpm_logger
@@ -204,6 +236,8 @@ class RunRepositoryStepsIfAvailable(MergeStep):
 
 class CreateEbuildFromTemplate(MergeStep):
 
+	journaled = True
+
 	def __init__(self, file_subpath, template_text, template_params=None):
 		self.file_subpath = file_subpath
 		self.template_text = template_text
@@ -217,17 +251,52 @@ class CreateEbuildFromTemplate(MergeStep):
 		outdir = os.path.dirname(outfile)
 		if not os.path.exists(outdir):
 			os.makedirs(outdir)
-		with open(outfile, "w") as f:
+		with replace_file(outfile) as f:
 			print('Generating %s...' % outfile)
 			template = jinja2.Template(self.template_text)
 			f.write(template.render(**self.template_params))
+		tree.journal(outfile)
 
 
 class Tree:
 
+	_indexes = None
+
 	def head(self):
 		return "None"
 
+	def getIndex(self, subpath=None):
+		"""
+		Return a TreeIndex snapshot of this tree, or of ``subpath`` inside it. The snapshot is built with a single scan the
+		first time it is requested and is then reused until invalidateIndex() is called.
+		"""
+		if self._indexes is None:
+			self._indexes = {}
+		if subpath not in self._indexes:
+			root = os.path.join(self.root, subpath) if subpath else self.root
+			self._indexes[subpath] = TreeIndex.scan(root)
+		return self._indexes[subpath]
+
+	@property
+	def index(self):
+		return self.getIndex()
+
+	def invalidateIndex(self, writes=None):
+		self._indexes = None
+		# our contents may have changed, so pooled portdbapis for this tree must not trust their caches. ``writes`` are
+		# the resources that changed, if known (see merge.step_graph):
+		tree_changed(self.root, writes)
+
+	def journal(self, *paths):
+		# only GitTrees keep a change journal (see GitTree.journal()):
+		pass
+
+	def journalRemoval(self, *paths):
+		pass
+
+	def journalStep(self, step):
+		pass
+
 
 class GitTreeError(Exception):
 	pass
@@ -235,6 +304,12 @@ class GitTreeError(Exception):
 
 class GitTree(Tree):
 	"A Tree (git) that we can use as a source for work jobs, and/or a target for running jobs."
+
+	# This is shared by all GitTrees in this process, and maps repository directories to the time they were last fetched.
+	# This way, we fetch each repository at most once per run (or once per config.fetch_ttl seconds, if set.)
+	fetch_times = {}
+	# asyncio locks, one per repository directory, that serialize fetches and pushes from a repository and its worktrees:
+	repo_locks = {}
 	
 	def __init__(self, name: str, branch: str = "master", config=None, url: str = None, commit_sha1: str = None,
 				 root: str = None,
@@ -243,11 +318,41 @@ class GitTree(Tree):
 				 mirror: str = None,
 				 origin_check: bool = True,
 				 destfix: bool = False,
-				 reclone: bool = False):
+				 reclone: bool = False,
+				 reference: str = None,
+				 worktree_of: "GitTree" = None,
+				 graft: bool = False,
+				 memo: StepMemo = None,
+				 incremental: bool = False):
 		
 		# note that if create=True, we are in a special 'local create' mode which is good for testing. We create the repo locally from
 		# scratch if it doesn't exist, as well as any branches. And we don't push.
+
+		# reference is the path of a bare repository to use as a shared object store when cloning. If not specified, the
+		# [work] objects setting is used, if any. Clones made this way borrow objects from the store via git alternates,
+		# so new kits and reclone=True rebuilds only need to transfer and store what the store doesn't already have.
 		self.config = config
+		if reference is None and config is not None:
+			reference = config.object_store
+		self.reference = reference
+		# if this tree is a linked worktree (see worktree()), worktree_of is the GitTree of the main working tree:
+		self.worktree_of = worktree_of
+		# if graft is True, steps that copy committed files from other GitTrees into this tree stage them straight from
+		# the source repository's objects -- see graftPath():
+		self.graft = graft
+		self._grafts = []
+		# if memo is a StepMemo, memoizable steps are skipped when their output can be replayed from it -- see run():
+		self.memo = memo
+		# if incremental is True, CleanTree sets the previous contents of the tree aside, so that anything that is copied
+		# into the tree again unchanged can be moved back instead -- see setAsidePrevious():
+		self.incremental = incremental
+		self._previous = None
+		# in-memory copy of 'git ls-tree -r' output for one commit -- see treeEntries():
+		self._tree_entries = None
+		# change journal -- a set of paths (relative to our root) that may differ from HEAD, or None if we don't know:
+		self._journal = None
+		# paths that were removed wholesale, and may have been partly written again since -- see journalRemoval():
+		self._removed = set()
 		self.name = name
 		self.root = root
 		self.url = url
@@ -257,6 +362,12 @@ class GitTree(Tree):
 		self.create = create
 		self.has_cleaned = False
 		self.initialized = False
+		# True when our working tree may differ from HEAD (merge steps have been run on it but not yet committed):
+		self.dirty = False
+		# in-memory ref table and remote URLs, loaded on demand -- see _refTable():
+		self._refs = None
+		self._head_ref = None
+		self._remote_urls = None
 		self.initial_future = self.initialize_tree(branch, commit_sha1)
 		self.mirror = mirror
 		self.origin_check = origin_check
@@ -276,7 +387,7 @@ class GitTree(Tree):
 		if os.path.isdir("%s/.git" % self.root) and self.reclone:
 			await runShell("rm -rf %s" % self.root)
 
-		if not os.path.isdir("%s/.git" % self.root):
+		if not os.path.exists("%s/.git" % self.root):
 			# repo does not exist? - needs to be cloned or created
 			if os.path.exists(self.root):
 				raise GitTreeError("%s exists but does not appear to be a valid git repository." % self.root)
@@ -289,11 +400,18 @@ class GitTree(Tree):
 				await runShell("echo 'created by merge.py' > %s/README" % self.root)
 				await runShell("( cd %s &&  git add README; git commit -a -m 'initial commit by merge.py' )" % self.root)
 				await runShell("( cd %s && git remote add origin %s )" % (self.root, self.url))
+				self.invalidateRefs()
 			elif self.url:
 				if not os.path.exists(base):
 					os.makedirs(base)
 				# we aren't supposed to create it from scratch -- can we clone it?
-				await runShell("(cd %s && git clone %s %s)" % (base, self.url, os.path.basename(self.root)))
+				if self.reference:
+					await self.updateObjectStore()
+					await runShell("(cd %s && git clone --reference %s %s %s)" % (base, self.reference, self.url, os.path.basename(self.root)))
+				else:
+					await runShell("(cd %s && git clone %s %s)" % (base, self.url, os.path.basename(self.root)))
+				GitTree.fetch_times[self.root] = time.monotonic()
+				self.invalidateRefs()
 
 			else:
 				# we've run out of options
@@ -301,23 +419,25 @@ class GitTree(Tree):
 				sys.exit(1)
 
 		# create local tracking branches for all remote branches. - we want to do this for every initialization.
-		s, o = subprocess.getstatusoutput("(cd %s && git branch -r | grep -v /HEAD)" % self.root)
-		if s != 0:
+		remote_branches = self.remoteBranches()
+		if not len(remote_branches):
 			# if repo is totally uninitialized (like gitolite wildrepo) -- initialize it with a first commit.
 			print("Attempting to initialize git repository for first use...")
 			await runShell("(cd %s && touch README && git add README && git commit -a -m 'first commit' && git push)" % self.root)
-			s, o = subprocess.getstatusoutput("(cd %s && git branch -r | grep -v /HEAD)" % self.root)
-			if s != 0:
+			self.invalidateRefs()
+			remote_branches = self.remoteBranches()
+			if not len(remote_branches):
 				print("Error listing local branches.")
 				sys.exit(1)
-		for branch in o.split():
+		for branch in remote_branches:
 			branch = branch.split("/")[-1]
 			if not self.localBranchExists(branch):
 				await runShell("( cd %s && git checkout %s)" % (self.root, branch))
+				self.invalidateRefs()
 
 		# if we've gotten here, we can assume that the repo exists at self.root.
 		if self.url is not None and self.origin_check:
-			retval, out = subprocess.getstatusoutput("(cd %s && git remote get-url origin)" % self.root)
+			out = self.getRemoteURL("origin") or ""
 			my_url = self.url
 			if my_url.endswith(".git"):
 				my_url = my_url[:-4]
@@ -341,115 +461,544 @@ class GitTree(Tree):
 		if not self.has_cleaned:
 			await runShell("(cd %s &&  git reset --hard && git clean -fd )" % self.root)
 			self.has_cleaned = True
+			self.dirty = False
+			self._journal = set()
+			self._removed = set()
 		
-		# git fetch will run as part of this:
+		# git fetch will run as part of this, and we will be up-to-date with our upstream branch if self.pull is True:
 		await self.gitCheckout(self.branch, from_init=True)
 		
 		# point to specified sha1:
 		
 		if self.commit_sha1:
 			await runShell("(cd %s && git checkout %s )" % (self.root, self.commit_sha1))
+			self.invalidateRefs()
 			if self.head() != self.commit_sha1:
 				raise GitTreeError("%s: Was not able to check out specified SHA1: %s." % (self.root, self.commit_sha1))
-		elif self.pull:
-			# we are on the right branch, but we want to make sure we have the latest updates
-			await runShell("(cd %s && git pull -f --all || true)" % self.root)
-	
+
+		self.invalidateIndex()
 		self.initialized = True
 		
 	async def initialize(self):
 		if not self.initialized:
 			await self.initial_future
+
+	@property
+	def repoRoot(self):
+		# the main working tree of our repository -- this is our own root unless we are a linked worktree:
+		return self.worktree_of.root if self.worktree_of is not None else self.root
+
+	def repoLock(self):
+		if self.repoRoot not in GitTree.repo_locks:
+			GitTree.repo_locks[self.repoRoot] = asyncio.Lock()
+		return GitTree.repo_locks[self.repoRoot]
+
+	def worktreeRoot(self, branch):
+		return "%s.worktrees/%s" % (self.root, branch)
+
+	async def removeWorktrees(self):
+		"""
+		Remove any linked worktrees left behind by a previous run, so that all branches are free to be checked out in our
+		main working tree again. This must be called before initialize().
+		"""
+		if os.path.isdir(self.root + ".worktrees"):
+			await runShell("rm -rf %s.worktrees" % self.root)
+		if os.path.exists(self.root + "/.git"):
+			await runShell("( cd %s && git worktree prune )" % self.root)
+
+	async def worktree(self, branch):
+		"""
+		Check out ``branch`` into a linked worktree of this repository, and return a new, initialized GitTree for it. This
+		allows several branches of one repository to be worked on (and committed) at the same time, without checking out
+		and wiping a single working tree between them. The worktree lives at worktreeRoot(branch) and replaces any
+		existing worktree there. ``branch`` must not be checked out in any other working tree of the repository.
+		"""
+		await self.initialize()
+		root = self.worktreeRoot(branch)
+		if os.path.exists(root):
+			await runShell("rm -rf %s" % root)
+			await runShell("( cd %s && git worktree prune )" % self.root)
+		os.makedirs(os.path.dirname(root), exist_ok=True)
+		await self.gitFetch()
+		if self.localBranchExists(branch):
+			await runShell("( cd %s && git worktree add %s %s )" % (self.root, root, branch))
+		elif self.remoteBranchExists(branch):
+			await runShell("( cd %s && git worktree add --track -b %s %s origin/%s )" % (self.root, branch, root, branch))
+		else:
+			await runShell("( cd %s && git worktree add -b %s %s )" % (self.root, branch, root))
+		self.invalidateRefs()
+		tree = GitTree(self.name, branch, config=self.config, url=self.url, root=root, create=self.create, reponame=self.reponame,
+					   mirror=self.mirror, origin_check=self.origin_check, destfix=self.destfix, worktree_of=self, graft=self.graft,
+					   memo=self.memo, incremental=self.incremental)
+		await tree.initialize()
+		return tree
+
+	async def updateObjectStore(self):
+		"""
+		Make sure our shared object store exists and has the objects of our upstream repository, so that a clone using it
+		as a reference only needs to transfer what is missing. Each repository's branches are stored in the object store
+		under refs/remotes/<name>/, which keeps their objects reachable. Automatic gc is disabled in the object store, as
+		clones depend on its objects not being pruned.
+		"""
+		if not os.path.isdir(self.reference):
+			os.makedirs(self.reference)
+			await runShell("( cd %s && git init --bare --quiet && git config gc.auto 0 )" % self.reference)
+		# a failure here isn't fatal -- the clone will just need to transfer more objects:
+		await runShell("( cd %s && git fetch --quiet --no-tags %s '+refs/heads/*:refs/remotes/%s/*' )" % (self.reference, self.url, self.name), abort_on_failure=False)
 			
+	def _gitDir(self):
+		git_path = os.path.join(self.root, ".git")
+		if os.path.isfile(git_path):
+			# linked worktrees and submodules have a .git file pointing to the real git directory:
+			with open(git_path, "r") as f:
+				line = f.read().strip()
+			if line.startswith("gitdir:"):
+				return os.path.normpath(os.path.join(self.root, line[7:].strip()))
+		return git_path
+
+	def _commonGitDir(self):
+		# the git directory holding our objects, which linked worktrees share with the main working tree:
+		return self.worktree_of._gitDir() if self.worktree_of is not None else self._gitDir()
+
+	def _refTable(self):
+		"""
+		Return our in-memory ref table, a dictionary mapping full ref names like 'refs/heads/master' to SHA1s. The table is
+		loaded with a single 'git for-each-ref', and HEAD is read directly from the git directory. It is kept until
+		invalidateRefs() is called, which we do whenever we run a git command that can change refs.
+		"""
+		if self._refs is None:
+			refs = {}
+			cmd = ["git", "for-each-ref", "--format=%(objectname) %(refname)"]
+			with tracer.subprocess(cmd):
+				cp = subprocess.run(cmd, cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+			if cp.returncode == 0:
+				for line in cp.stdout.decode("utf-8").splitlines():
+					sha1, _, refname = line.partition(" ")
+					refs[refname] = sha1
+			head_ref = None
+			try:
+				with open(os.path.join(self._gitDir(), "HEAD"), "r") as f:
+					head = f.read().strip()
+				if head.startswith("ref:"):
+					head_ref = head[4:].strip()
+				elif len(head):
+					# detached HEAD:
+					refs["HEAD"] = head
+			except FileNotFoundError:
+				pass
+			if head_ref is not None and head_ref in refs:
+				refs["HEAD"] = refs[head_ref]
+			self._head_ref = head_ref
+			self._refs = refs
+		return self._refs
+
+	def invalidateRefs(self):
+		self._refs = None
+		self._head_ref = None
+		self._remote_urls = None
+
 	@property
 	def currentLocalBranch(self):
-		s, branch = subprocess.getstatusoutput("( cd %s && git symbolic-ref --short -q HEAD )" % self.root)
-		if s:
+		self._refTable()
+		if self._head_ref is None or not self._head_ref.startswith("refs/heads/"):
 			return None
-		else:
-			return branch
+		return self._head_ref[len("refs/heads/"):]
 	
 	def localBranchExists(self, branch):
-		s, branch = subprocess.getstatusoutput("( cd %s && git show-ref --verify --quiet refs/heads/%s )" % (self.root, branch))
-		if s:
-			return False
-		else:
-			return True
+		return "refs/heads/%s" % branch in self._refTable()
+
+	def remoteBranches(self):
+		# like 'git branch -r', without the symbolic origin/HEAD:
+		return sorted(ref[len("refs/remotes/"):] for ref in self._refTable() if ref.startswith("refs/remotes/") and not ref.endswith("/HEAD"))
 
 	def getRemoteURL(self, remote):
-		s, o = subprocess.getstatusoutput("( cd %s && git remote get-url %s )" % (self.root, remote))
-		if s:
-			return None
-		else:
-			return o.strip()
+		if self._remote_urls is None:
+			self._remote_urls = {}
+			cmd = ["git", "config", "--get-regexp", r"^remote\..*\.url$"]
+			with tracer.subprocess(cmd):
+				cp = subprocess.run(cmd, cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+			for line in cp.stdout.decode("utf-8").splitlines():
+				key, _, url = line.partition(" ")
+				self._remote_urls[key[len("remote."):-len(".url")]] = url.strip()
+		return self._remote_urls.get(remote, None)
 
 	def setRemoteURL(self, mirror_name, url):
-		s, o = subprocess.getstatusoutput("( cd %s && git remote add %s %s )" % (self.root, mirror_name, url))
+		cmd = "( cd %s && git remote add %s %s )" % (self.root, mirror_name, url)
+		with tracer.subprocess(cmd):
+			s, o = subprocess.getstatusoutput(cmd)
+		self.invalidateRefs()
 		if s:
 			return False
 		else:
 			return True
 
 	def remoteBranchExists(self, branch):
-		s, o = subprocess.getstatusoutput("( cd %s && git show-branch remotes/origin/%s )" % (self.root, branch))
-		if s:
-			return False
-		else:
-			return True
+		return "refs/remotes/origin/%s" % branch in self._refTable()
 	
 	def getDepthOfCommit(self, sha1):
-		s, depth = subprocess.getstatusoutput("( cd %s && git rev-list HEAD ^%s --count)" % (self.root, sha1))
+		cmd = "( cd %s && git rev-list HEAD ^%s --count)" % (self.root, sha1)
+		with tracer.subprocess(cmd):
+			s, depth = subprocess.getstatusoutput(cmd)
 		return int(depth) + 1
 	
 	def getAllCatPkgs(self):
-		with open(self.root + "/profiles/categories", "r") as a:
-			cats = set(a.read().split())
-		for item in glob.glob(self.root + "/*-*"):
-			if os.path.isdir(item):
-				cat = os.path.basename(item)
-				if cat not in cats:
-					print("!!! WARNING: category %s not in categories... should be added to profiles/categories!" % item)
-				cats.add(cat)
-		cats = sorted(list(cats))
-		catpkgs = {}
-		
-		for cat in cats:
-			if not os.path.exists(self.root + "/" + cat):
+		index = self.index
+		if index.profile_categories is None:
+			raise FileNotFoundError("%s/profiles/categories" % self.root)
+		cats = set(index.profile_categories)
+		for cat in index.categories:
+			if "-" not in cat:
 				continue
-			pkgs = os.listdir(self.root + "/" + cat)
-			for pkg in pkgs:
-				if not os.path.isdir(self.root + "/" + cat + "/" + pkg):
-					continue
-				catpkgs[cat + "/" + pkg] = self.name
+			if cat not in cats:
+				print("!!! WARNING: category %s not in categories... should be added to profiles/categories!" % os.path.join(self.root, cat))
+			cats.add(cat)
+		catpkgs = {}
+		for catpkg in index.catpkgs(sorted(cats)):
+			catpkgs[catpkg] = self.name
 		return catpkgs
 	
 	def catpkg_exists(self, catpkg):
-		return os.path.exists(self.root + "/" + catpkg)
+		return self.index.catpkg_exists(catpkg)
+
+	def indexCachePath(self, subpath=None):
+		if self.config is None:
+			return None
+		root = os.path.join(self.root, subpath) if subpath else self.root
+		return os.path.join(self.config.cache_dir, "tree-index", os.path.normpath(root).strip("/").replace("/", "_") + ".idx")
+
+	def getIndex(self, subpath=None):
+		"""
+		Like Tree.getIndex(), but when our working tree is clean, the snapshot is persisted to disk keyed by our HEAD SHA1.
+		An unchanged tree then loads its snapshot from disk, and a tree that has moved to a new commit has its previous
+		snapshot updated from ``git diff --name-only`` rather than being rescanned.
+		"""
+		if self._indexes is None:
+			self._indexes = {}
+		if subpath in self._indexes:
+			return self._indexes[subpath]
+		root = os.path.join(self.root, subpath) if subpath else self.root
+		cache_path = self.indexCachePath(subpath)
+		sha1 = None if self.dirty else self.head()
+		if sha1 is None or cache_path is None:
+			index = TreeIndex.scan(root)
+		else:
+			index = TreeIndex.load(root, cache_path)
+			if index is not None and index.sha1 != sha1:
+				changed = self.getChangedPaths(index.sha1, sha1)
+				if changed is None:
+					index = None
+				else:
+					if subpath:
+						prefix = subpath.rstrip("/") + "/"
+						changed = [path[len(prefix):] for path in changed if path.startswith(prefix)]
+					index.apply_changes(changed, sha1=sha1)
+					index.save(cache_path)
+			if index is None:
+				index = TreeIndex.scan(root, sha1=sha1)
+				index.save(cache_path)
+		self._indexes[subpath] = index
+		return index
+
+	def getChangedPaths(self, old_sha1, new_sha1):
+		"""Return a list of paths changed between two commits, or None if we can't tell (for example, old_sha1 is gone.)"""
+		if old_sha1 is None:
+			return None
+		cmd = ["git", "diff", "--name-only", "-z", "--no-renames", old_sha1, new_sha1]
+		with tracer.subprocess(cmd):
+			cp = subprocess.run(cmd, cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		if cp.returncode != 0:
+			return None
+		return [path for path in cp.stdout.decode("utf-8").split("\0") if path]
 	
+	def treeEntries(self, path="", sha1=None):
+		"""
+		Return a list of (path, mode, blob SHA1) tuples for every file committed at or below ``path`` (relative to our
+		root) in commit ``sha1``, which defaults to HEAD. This is answered from an in-memory copy of 'git ls-tree -r' for
+		the commit, which is loaded once and reused until we are asked about another commit. Submodules are not listed.
+		"""
+		if sha1 is None:
+			sha1 = self.head()
+		if self._tree_entries is None or self._tree_entries[0] != sha1:
+			cmd = ["git", "ls-tree", "-r", "-z", "--full-tree", sha1]
+			with tracer.subprocess(cmd):
+				cp = subprocess.run(cmd, cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+			if cp.returncode != 0:
+				raise GitTreeError("%s: unable to list files in commit %s." % (self.root, sha1))
+			entries = {}
+			for item in cp.stdout.decode("utf-8").split("\0"):
+				info, _, file_path = item.partition("\t")
+				if not file_path:
+					continue
+				mode, obj_type, obj_sha1 = info.split()
+				if obj_type == "blob":
+					entries[file_path] = (mode, obj_sha1)
+			self._tree_entries = (sha1, sorted(entries.keys()), entries)
+		_, paths, entries = self._tree_entries
+		if path in entries:
+			return [(path,) + entries[path]]
+		prefix = path + "/" if path else ""
+		out = []
+		pos = bisect.bisect_left(paths, prefix)
+		while pos < len(paths) and paths[pos].startswith(prefix):
+			out.append((paths[pos],) + entries[paths[pos]])
+			pos += 1
+		return out
+
+	def canGraft(self, srctree):
+		# we can only graft files from a GitTree whose working tree is known to match its HEAD:
+		return self.graft and isinstance(srctree, GitTree) and not srctree.dirty and srctree.head() is not None
+
+	def graftPath(self, srctree, src_path, dest_path, replace=False):
+		"""
+		Queue the committed contents of ``src_path`` (a file or directory in ``srctree``) to be copied to ``dest_path`` in
+		this tree. This is what ``cp -a src_path dest_path`` would do, except that files are staged in our index directly
+		from the source repository's blobs by applyGrafts(), so they never need to be read and hashed again by
+		'git add'. Only committed files are copied. If ``replace`` is True, any grafts queued earlier for ``dest_path``
+		are dropped. Callers must check canGraft() first.
+		"""
+		src_path = os.path.relpath(src_path, srctree.root)
+		dest_path = os.path.relpath(dest_path, self.root)
+		if replace:
+			self._grafts = [graft for graft in self._grafts if graft[3] != dest_path and not graft[3].startswith(dest_path + "/")]
+		self._grafts.append((srctree, srctree.head(), "" if src_path == "." else src_path, "" if dest_path == "." else dest_path))
+
+	def previousDir(self):
+		return os.path.join(self._gitDir(), "merge-previous")
+
+	def setAsidePrevious(self, exclude=None):
+		"""
+		Move everything in our working tree, apart from dotfiles and ``exclude``, into previousDir(), and return True. This
+		is only done if the tree is incremental and we know that our working tree matches HEAD -- otherwise, nothing is
+		moved and we return False. Paths from the previous generation of the tree that are copied into it again unchanged
+		can then be moved back with reusePrevious(), which is much cheaper than copying them and 'git add'-ing them again.
+		The metadata cache is kept in place, so that GenCache only needs to regenerate entries for ebuilds that changed.
+		"""
+		if not self.incremental or self._journal is None or len(self._journal) or len(self._removed) or self.head() is None:
+			return False
+		if exclude is None:
+			exclude = []
+		previous = self.previousDir()
+		if os.path.lexists(previous):
+			shutil.rmtree(previous)
+		os.makedirs(previous)
+		for fn in os.listdir(self.root):
+			if fn[:1] == "." or fn in exclude:
+				continue
+			self.journalRemoval(fn)
+			os.rename(os.path.join(self.root, fn), os.path.join(previous, fn))
+		self._previous = self.head()
+		if os.path.isdir(os.path.join(previous, "metadata/md5-cache")):
+			os.makedirs(os.path.join(self.root, "metadata"))
+			os.rename(os.path.join(previous, "metadata/md5-cache"), os.path.join(self.root, "metadata/md5-cache"))
+		return True
+
+	def canReusePrevious(self, srctree):
+		# like grafts, we can only compare with a GitTree whose working tree is known to match its HEAD:
+		return self._previous is not None and isinstance(srctree, GitTree) and not srctree.dirty and srctree.head() is not None
+
+	def reusePrevious(self, srctree, src_path, dest_path, replace=False):
+		"""
+		If the previous generation of ``dest_path`` (see setAsidePrevious()) is identical to the committed contents of
+		``src_path`` in ``srctree``, move it back into place and return True. Otherwise, return False, and the caller has to
+		copy ``src_path`` itself. ``replace`` has the same meaning as for graftPath(). Callers must check
+		canReusePrevious() first.
+		"""
+		src_path = os.path.relpath(src_path, srctree.root)
+		dest_path = os.path.relpath(dest_path, self.root)
+		previous = os.path.join(self.previousDir(), dest_path)
+		if not os.path.lexists(previous) or os.path.lexists(os.path.join(self.root, dest_path)):
+			return False
+		theirs = [(path[len(src_path):], mode, sha1) for path, mode, sha1 in srctree.treeEntries(src_path)]
+		ours = [(path[len(dest_path):], mode, sha1) for path, mode, sha1 in self.treeEntries(dest_path, self._previous)]
+		if not len(ours) or ours != theirs:
+			return False
+		if replace:
+			self._grafts = [graft for graft in self._grafts if graft[3] != dest_path and not graft[3].startswith(dest_path + "/")]
+		os.rename(previous, os.path.join(self.root, dest_path))
+		self.journal(dest_path)
+		return True
+
+	def graftPending(self, dest_path):
+		dest_path = os.path.relpath(dest_path, self.root)
+		return any(graft[3] == dest_path for graft in self._grafts)
+
+	async def copyObjects(self, srctree, sha1s):
+		"""
+		Copy the objects ``sha1s`` from ``srctree``'s repository into ours, unless we already have them, so that our
+		commits never depend on objects that only exist in a source repository (which may be recloned, or pruned after a
+		force-push.) The missing objects are sent over as a single pack.
+		"""
+		sha1s = sorted(set(sha1s))
+		if not len(sha1s):
+			return
+		retval, out, err = await getcommandoutput(["git", "-C", self.root, "cat-file", "--batch-check"], input=("\n".join(sha1s) + "\n").encode("utf-8"))
+		if retval != 0:
+			raise GitTreeError("%s: unable to check for objects to copy from %s: %s" % (self.root, srctree.root, out.decode("utf-8")))
+		missing = [ line.split()[0] for line in out.decode("utf-8").split("\n") if line.endswith(" missing") ]
+		if not len(missing):
+			return
+		await runShell("( cd %s && git pack-objects -q --stdout ) | ( cd %s && git index-pack --stdin )" % (srctree.root, self.root),
+					   input=("\n".join(missing) + "\n").encode("utf-8"))
+
+	async def applyGrafts(self):
+		"""
+		Apply all grafts queued by graftPath(). The blobs we need are copied from the source repositories into ours with
+		copyObjects(). All grafted files are then added to our index with a single 'git update-index --index-info' and
+		written out with a single 'git checkout-index', which also records their stat information in the index. Later
+		grafts of the same path win over earlier ones.
+		"""
+		if not len(self._grafts):
+			return
+		grafts = self._grafts
+		self._grafts = []
+		entries = OrderedDict()
+		needed = OrderedDict()
+		for srctree, sha1, src_path, dest_path in grafts:
+			for path, mode, blob_sha1 in srctree.treeEntries(src_path, sha1):
+				entries[os.path.join(dest_path, path[len(src_path):].lstrip("/")).rstrip("/")] = (mode, blob_sha1)
+				needed.setdefault(srctree.root, (srctree, set()))[1].add(blob_sha1)
+		if not len(entries):
+			return
+		for srctree, sha1s in needed.values():
+			await self.copyObjects(srctree, sha1s)
+		index_info = "".join("%s %s\t%s\0" % (mode, blob_sha1, path) for path, (mode, blob_sha1) in entries.items())
+		await runShell("( cd %s && git update-index -z --add --replace --index-info )" % self.root, input=index_info.encode("utf-8"))
+		await runShell("( cd %s && git checkout-index -f -u -z --stdin )" % self.root, input="\0".join(entries.keys()).encode("utf-8"))
+
+	def journal(self, *paths):
+		"""
+		Record that ``paths`` (absolute, or relative to our root) have been created, modified or deleted. Directories
+		stand for everything below them. gitCommit() only needs to stage journaled paths, rather than scanning the whole
+		tree for changes.
+		"""
+		if self._journal is None:
+			return
+		for path in paths:
+			path = os.path.relpath(os.path.join(self.root, path), self.root)
+			if path == "." or path.startswith("../"):
+				# all bets are off:
+				self._journal = None
+				return
+			self._journal.add(path)
+
+	def journalRemoval(self, *paths):
+		"""
+		Record that ``paths`` (absolute, or relative to our root) have been removed, along with everything below them. Unlike
+		journal(), this doesn't make gitCommit() stage everything below them again: whatever later steps write there is
+		journaled by them, and the rest is found by asking git which of the files it tracks there are gone.
+		"""
+		if self._journal is None:
+			return
+		for path in paths:
+			path = os.path.relpath(os.path.join(self.root, path), self.root)
+			if path == "." or path.startswith("../"):
+				self._journal = None
+				return
+			self._removed.add(path)
+
+	def journalStep(self, step):
+		# called before a step runs on this tree -- if the step doesn't journal its changes, we can't trust our journal:
+		if not getattr(step, "journaled", False):
+			self._journal = None
+
+	async def stageChanges(self):
+		"""
+		Stage all changes in our working tree. If our change journal is complete, only the journaled paths are staged,
+		along with the deletion of tracked files below removed paths (see journalRemoval()) that haven't been written
+		again. Otherwise, or if staging them fails (for example, because a journaled file is ignored), we fall back to a
+		full 'git add .' of the tree.
+		"""
+		if self._journal is not None:
+			present = []
+			missing = []
+			for path in sorted(self._journal):
+				if os.path.lexists(os.path.join(self.root, path)):
+					present.append(path)
+				else:
+					missing.append(path)
+			success = True
+			if len(present):
+				success = await runShell("( cd %s && git --literal-pathspecs add -A --pathspec-from-file=- --pathspec-file-nul )" % self.root,
+										 abort_on_failure=False, input="\0".join(present).encode("utf-8"))
+			if success and len(self._removed):
+				# 'git ls-files --deleted' only has to lstat() the files git tracks below removed paths, not hash them:
+				retval, out, err = await getcommandoutput(["git", "-C", self.root, "--literal-pathspecs", "ls-files", "-z", "--deleted", "--"] + sorted(self._removed))
+				if retval == 0:
+					missing += [ path for path in out.decode("utf-8").split("\0") if len(path) ]
+				else:
+					success = False
+			if success and len(missing):
+				success = await runShell("( cd %s && git --literal-pathspecs rm -r -q --cached --ignore-unmatch --pathspec-from-file=- --pathspec-file-nul )" % self.root,
+										 abort_on_failure=False, input="\0".join(missing).encode("utf-8"))
+			if success:
+				return
+			print("Staging of journaled changes failed; scanning %s for changes instead." % self.root)
+		await runShell("( cd %s && git add . )" % self.root)
+
+	async def gitFetch(self, force=False):
+		"""
+		Fetch from origin, unless this repository has already been fetched during this run (or within the last
+		config.fetch_ttl seconds, if that is set.) Returns True if a fetch was performed.
+		"""
+		async with self.repoLock():
+			last_fetch = GitTree.fetch_times.get(self.repoRoot, None)
+			ttl = self.config.fetch_ttl if self.config is not None else None
+			if not force and last_fetch is not None and (ttl is None or time.monotonic() - last_fetch < ttl):
+				return False
+			await runShell("(cd %s && git fetch --verbose)" % self.root)
+			GitTree.fetch_times[self.repoRoot] = time.monotonic()
+		self.invalidateRefs()
+		return True
+
 	async def gitCheckout(self, branch="master", from_init=False):
 		if not from_init:
 			await self.initialize()
-		await runShell("(cd %s && git fetch --verbose)" % self.root)
+		await self.gitFetch()
 		if self.localBranchExists(branch):
-			await runShell("(cd %s && git checkout %s && git pull -f --all || true)" % (self.root, branch))
+			# We merge from our already-fetched upstream branch rather than using 'git pull', so this is local-only:
+			if self.pull:
+				await runShell("(cd %s && git checkout %s && git merge --no-edit @{upstream} || true)" % (self.root, branch))
+			else:
+				await runShell("(cd %s && git checkout %s)" % (self.root, branch))
 		elif self.remoteBranchExists(branch):
 			await runShell("(cd %s && git checkout -b %s --track origin/%s)" % (self.root, branch, branch))
 		else:
 			await runShell("(cd %s && git checkout -b %s)" % (self.root, branch))
+		self.invalidateRefs()
+		self.invalidateIndex()
 		if self.currentLocalBranch != branch:
 			raise GitTreeError("%s: On branch %s. not able to check out branch %s." % (self.root, self.currentLocalBranch, branch))
 
-	async def mirrorLocalBranches(self, mirror=None):
+	async def mirrorLocalBranches(self, mirror=None, abort_on_failure=True):
 		if mirror is None:
 			mirror = self.url
 		# This is a special push command that will push local tags and branches *only*
-		await runShell("(cd %s && git push %s +refs/heads/* +refs/tags/*)" % (self.root, mirror))
+		# Linked worktrees share their branches with other working trees, so they only push their own branch:
+		heads = "+refs/heads/%s" % self.branch if self.worktree_of is not None else "+refs/heads/*"
+		async with self.repoLock():
+			return await runShell("(cd %s && git push %s %s +refs/tags/*)" % (self.root, mirror, heads), abort_on_failure=abort_on_failure)
 
-	async def mirrorUpstreamRepository(self, mirror):
+	async def mirrorUpstreamRepository(self, mirror, abort_on_failure=True):
 		# This is a special push command that will push all the stuff from origin (branches and tags) *only*
 		# It will skip local branches.
-		await runShell("(cd %s && git fetch --prune)" % self.root)
-		await runShell("(cd %s && git push --prune %s +refs/remotes/origin/*:refs/heads/* +refs/tags/*:refs/tags/*)" % (self.root, mirror))
+		async with self.repoLock():
+			if not await runShell("(cd %s && git fetch --prune)" % self.root, abort_on_failure=abort_on_failure):
+				return False
+			GitTree.fetch_times[self.repoRoot] = time.monotonic()
+			self.invalidateRefs()
+			return await runShell("(cd %s && git push --prune %s +refs/remotes/origin/*:refs/heads/* +refs/tags/*:refs/tags/*)" % (self.root, mirror),
+								  abort_on_failure=abort_on_failure)
+
+	async def pushMirrors(self):
+		"""
+		Push our local branches to origin, and then mirror origin to self.mirror if we have one. Unlike the inline push done
+		by gitCommit(), failures don't abort -- we return False instead, so that a PushScheduler can retry us.
+		"""
+		if not await self.mirrorLocalBranches(abort_on_failure=False):
+			return False
+		if self.mirror:
+			return await self.mirrorUpstreamRepository(mirror=self.mirror, abort_on_failure=False)
+		return True
 
 	async def gitMirrorPush(self):
 		await runShell(
@@ -459,9 +1008,12 @@ class GitTree(Tree):
 		if self.mirror:
 			await self.mirrorUpstreamRepository(self.mirror)
 
-	async def gitCommit(self, message="", push=True):
-		await runShell("( cd %s && git add . )" % self.root)
-		cmd = "( cd %s && [ -n \"$(git status --porcelain)\" ] && git commit -a -F - << EOF\n" % self.root
+	async def gitCommit(self, message="", push=True, push_scheduler=None):
+		# If a PushScheduler is specified, our push is handed off to it to run in the background, rather than being done
+		# before we return.
+		await self.stageChanges()
+		# 'git diff HEAD' only looks at tracked files, so unlike 'git status' it doesn't need to scan for untracked ones:
+		cmd = "( cd %s && ! git diff --quiet HEAD && git commit -a -F - << EOF\n" % self.root
 		if message != "":
 			cmd += "%s\n\n" % message
 		names = []
@@ -483,28 +1035,126 @@ class GitTree(Tree):
 			# make sure HOME is set if we are root (maybe we entered to a minimal environment -- this will mess git up.)
 			# In particular, a new tmux window will have HOME set to /root but NOT exported. Which will mess git up. (It won't know where to find ~/.gitconfig.)
 			myenv["HOME"] = "/root"
-		cp = subprocess.run(cmd, shell=True, env=myenv)
+		with tracer.subprocess("git commit"):
+			cp = subprocess.run(cmd, shell=True, env=myenv)
 		retval = cp.returncode
 		if retval not in [ 0, 1 ]: # can return 1
 			print("retval is: %s" % retval)
 			print(cp)
 			print("Commit failed.")
 			sys.exit(1)
+		# everything in our working tree is now committed:
+		self.dirty = False
+		self._journal = set()
+		self._removed = set()
+		if self._previous is not None:
+			# whatever wasn't reused from the previous generation is gone for good:
+			shutil.rmtree(self.previousDir(), ignore_errors=True)
+			self._previous = None
+		self.invalidateRefs()
+		self.invalidateIndex()
 		if push is True and self.create is False:
-			await self.mirrorLocalBranches()
-			if self.mirror:
-				await self.mirrorUpstreamRepository(mirror=self.mirror)
+			if push_scheduler is not None:
+				push_scheduler.schedule(self.root, self.pushMirrors)
+			else:
+				await self.mirrorLocalBranches()
+				if self.mirror:
+					await self.mirrorUpstreamRepository(mirror=self.mirror)
 		else:
 			print("Pushing disabled.")
 	
-	async def run(self, steps):
-		for step in steps:
-			if step is not None:
+	async def contentDigest(self, resources):
+		"""
+		Return a digest of the current contents of ``resources`` (see merge.step_graph) in our working tree, including
+		changes that haven't been committed yet. Only the files of ``resources`` are staged, in a scratch copy of our
+		index, so that files whose stat information hasn't changed since they were last staged aren't hashed again, and
+		our real index isn't touched.
+		"""
+		pathspecs = resource_pathspecs(resources)
+		cmd = ["git", "rev-parse", "--git-path", "index"]
+		with tracer.subprocess(cmd):
+			cp = subprocess.run(cmd, cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		index = os.path.join(self.root, cp.stdout.decode("utf-8").strip())
+		fd, scratch = tempfile.mkstemp(prefix="index.digest.", dir=os.path.dirname(index))
+		os.close(fd)
+		try:
+			if os.path.exists(index):
+				shutil.copyfile(index, scratch)
+			else:
+				os.unlink(scratch)
+			env = os.environ.copy()
+			env["GIT_INDEX_FILE"] = scratch
+			# 'git add' fails on pathspecs that match nothing, so stage the files they match, in the index or the working
+			# tree, by name:
+			retval, out, err = await getcommandoutput(["git", "-C", self.root, "ls-files", "-z", "--cached", "--others", "--exclude-standard", "--"] + pathspecs, env=env)
+			if retval != 0:
+				raise GitTreeError("%s: unable to list files to digest: %s" % (self.root, out.decode("utf-8")))
+			if len(out):
+				add_env = env.copy()
+				add_env["GIT_LITERAL_PATHSPECS"] = "1"
+				await runShell(["git", "-C", self.root, "add", "-A", "--pathspec-from-file=-", "--pathspec-file-nul"], env=add_env, input=out)
+			retval, out, err = await getcommandoutput(["git", "-C", self.root, "ls-files", "-s", "-z", "--"] + pathspecs, env=env)
+			if retval != 0:
+				raise GitTreeError("%s: unable to list files in scratch index: %s" % (self.root, out.decode("utf-8")))
+		finally:
+			if os.path.exists(scratch):
+				os.unlink(scratch)
+		return hashlib.sha1(out).hexdigest()
+
+	async def runMemoized(self, step):
+		"""
+		Run ``step``, unless our step memo has its output for the current contents of what it reads, in which case that
+		output is copied into place instead.
+		"""
+		extra = [ portage.VERSION ]
+		if self.name != "core-kit" and self.config is not None:
+			# kits are generated against the eclasses and profiles of core-kit:
+			extra.append(str(headSHA1(self.config.dest_trees + "/core-kit")))
+		fingerprint = step_fingerprint(step, await self.contentDigest(step.reads), extra)
+		if self.memo.replay(self, step, fingerprint):
+			print("Step %s: inputs unchanged, replayed output from step memo %s." % (step.__class__.__name__, fingerprint))
+			return
+		await step.run(self)
+		self.memo.record(self, step, fingerprint)
+
+	async def run(self, steps, jobs=None):
+		"""
+		Run ``steps`` on this tree. Steps that declare what they read and write (see merge.step_graph) run concurrently,
+		up to ``jobs`` at a time, with other steps they don't conflict with. Everything else runs in list order.
+		"""
+		steps = [step for step in steps if step is not None]
+		deps = step_dependencies(steps)
+		semaphore = asyncio.Semaphore(jobs if jobs is not None else cpu_count())
+		tasks = []
+
+		async def run_step(pos, step):
+			if len(deps[pos]):
+				await asyncio.gather(*[tasks[other] for other in deps[pos]])
+			async with semaphore:
 				print("Running step", step.__class__.__name__, step)
-				await step.run(self)
+				self.dirty = True
+				self.journalStep(step)
+				with tracer.span(step.__class__.__name__, "step"):
+					if self.memo is not None and memoizable(step):
+						await self.runMemoized(step)
+					else:
+						await step.run(self)
+				# the step may have modified our tree (or checked out another branch), so any index snapshot or ref
+				# table we hold is no longer trustworthy:
+				self.invalidateIndex(getattr(step, "writes", None))
+				self.invalidateRefs()
+
+		for pos, step in enumerate(steps):
+			tasks.append(asyncio.ensure_future(run_step(pos, step)))
+		try:
+			await asyncio.gather(*tasks)
+		except BaseException:
+			for task in tasks:
+				task.cancel()
+			raise
 	
 	def head(self):
-		return headSHA1(self.root)
+		return self._refTable().get("HEAD", None)
 	
 	def logTree(self, srctree):
 		# record name and SHA of src tree in dest tree, used for git commit message/auditing:
@@ -663,59 +1313,32 @@ def do_package_use_line(pkg, def_python, bk_python, imps):
 
 class GenPythonUse(MergeStep):
 
+	journaled = True
+	memoize = True
+
 	def __init__(self, py_settings, out_subpath, release):
 		self.def_python = py_settings["primary"]
 		self.bk_python = py_settings["alternate"]
 		self.mask = py_settings["mask"]
 		self.out_subpath = out_subpath
 		self.release = release
+		self.reads = [ "@ebuilds", "eclass", "metadata/layout.conf", "metadata/md5-cache", "profiles/repo_name" ]
+		self.writes = [ "profiles/" + out_subpath ]
 	
 	async def run(self, cur_overlay):
 		cur_tree = cur_overlay.root
-		try:
-			with open(os.path.join(cur_tree, 'profiles/repo_name')) as f:
-				cur_name = f.readline().strip()
-		except FileNotFoundError:
-			cur_name = cur_overlay.name
-		env = os.environ.copy()
-		env['PORTAGE_DEPCACHEDIR'] = '/var/cache/edb/%s-%s-%s-meta' % ( self.release, cur_overlay.name, cur_overlay.branch )
-		if cur_name != "core-kit":
-			env['PORTAGE_REPOSITORIES'] = '''
-[DEFAULT]
-main-repo = core-kit
-
-[core-kit]
-location = %s/core-kit
-aliases = gentoo
-
-[%s]
-location = %s
-''' % (cur_overlay.config.dest_trees, cur_name, cur_tree)
-		else:
-			env['PORTAGE_REPOSITORIES'] = '''
-[DEFAULT]
-main-repo = core-kit
-
-[core-kit]
-location = %s/core-kit
-aliases = gentoo
-''' % cur_overlay.config.dest_trees
-		p = portage.portdbapi(mysettings=portage.config(env=env,config_profile_path=''))
+		cur_name = repoName(cur_overlay)
+		# only our own catpkgs -- those from core-kit are handled when processing core-kit:
+		table = await tree_metadata(cur_overlay, depcachedir='/var/cache/edb/%s-%s-%s-meta' % ( self.release, cur_overlay.name, cur_overlay.branch ))
 
 		pkg_use = []
 
-		for pkg in p.cp_all():
+		for pkg in table.packages():
 			
 			cp = portage.catsplit(pkg)
-			if not os.path.exists(cur_tree + "/" + pkg):
-				# catpkg is from core-kit, but we are not processing core kit, so skip:
-				continue
 			ebs = {}
-			for a in await async_xmatch(p, "match-all", pkg):
-				if len(a) == 0:
-					continue
-				aux = await p.async_aux_get(a, ["INHERITED"])
-				eclasses=aux[0].split()
+			for a, inherited in table.column("INHERITED", pkg):
+				eclasses=inherited.split()
 				if "python-single-r1" not in eclasses:
 					continue
 				else:
@@ -751,92 +1374,31 @@ aliases = gentoo
 			else:
 				for key,val in ebs.items():
 					pkg_use += [ do_package_use_line("=%s" % key, self.def_python, self.bk_python, val) ]
+		cur_overlay.journal("profiles/" + self.out_subpath)
 		outpath = cur_tree + '/profiles/' + self.out_subpath + '/package.use'
 		if not os.path.exists(outpath):
 			os.makedirs(outpath)
-		with open(outpath + "/python-use", "w") as f:
+		with replace_file(outpath + "/python-use") as f:
 			for l in sorted(x for x in pkg_use if x is not None):
 				f.write(l + "\n")
 		# for core-kit, set good defaults as well.
 		if cur_name == "core-kit":
 			outpath = cur_tree + '/profiles/' + self.out_subpath + '/make.defaults'
-			a = open(outpath, "w")
-			a.write('PYTHON_TARGETS="%s %s"\n' % ( self.def_python, self.bk_python ))
-			a.write('PYTHON_SINGLE_TARGET="%s"\n' % self.def_python)
-			a.close()
+			with replace_file(outpath) as a:
+				a.write('PYTHON_TARGETS="%s %s"\n' % ( self.def_python, self.bk_python ))
+				a.write('PYTHON_SINGLE_TARGET="%s"\n' % self.def_python)
 			if self.mask:
 				outpath = cur_tree + '/profiles/' + self.out_subpath + '/package.mask/funtoo-kit-python'
 				if not os.path.exists(os.path.dirname(outpath)):
 					os.makedirs(os.path.dirname(outpath))
-				a = open(outpath, "w")
-				a.write(self.mask + "\n")
-				a.close()
+				with replace_file(outpath) as a:
+					a.write(self.mask + "\n")
 
-async def getDependencies(cur_overlay, catpkgs, levels=0, cur_level=0):
-	cur_tree = cur_overlay.root
-	try:
-		with open(os.path.join(cur_tree, 'profiles/repo_name')) as f:
-			cur_name = f.readline().strip()
-	except FileNotFoundError:
-			cur_name = cur_overlay.name
-	env = os.environ.copy()
-	if cur_overlay.name != "core-kit":
-		env['PORTAGE_REPOSITORIES'] = '''
-	[DEFAULT]
-	main-repo = core-kit
-
-	[core-kit]
-	location = %s/core-kit
-	aliases = gentoo
-
-	[%s]
-	location = %s
-	''' % (cur_overlay.config.dest_trees, cur_name, cur_tree)
-	else:
-		env['PORTAGE_REPOSITORIES'] = '''
-	[DEFAULT]
-	main-repo = core-kit
-
-	[core-kit]
-	location = %s/core-kit
-	aliases = gentoo
-	''' % cur_overlay.config.dest_trees
-	p = portage.portdbapi(mysettings=portage.config(env=env,config_profile_path=''))
-	mypkgs = set()
-
-	future_aux = {}
-
-	def future_generator():
-		for catpkg in list(catpkgs):
-			for my_cpv in p.cp_list(catpkg):
-				if my_cpv == '':
-					print("No match for %s" % catpkg)
-					continue
-				my_future = p.async_aux_get(my_cpv, [ "DEPEND", "RDEPEND"])
-				future_aux[id(my_future)] = my_cpv
-				yield my_future
-
-	for fu_fu in  async_iter_completed(future_generator()):
-		future_set = await fu_fu
-		for future in future_set:
-			cpv = future_aux.pop(id(future))
-			try:
-				result = future.result()
-			except KeyError as e:
-				print("aux_get fail", cpv, e)
-			else:
-				for dep in flatten(use_reduce(result[0]+" "+result[1], matchall=True)):
-					if len(dep) and dep[0] == "!":
-						continue
-					try:
-						mypkg = dep_getkey(dep)
-					except portage.exception.InvalidAtom:
-						continue
-					if mypkg not in mypkgs:
-						mypkgs.add(mypkg)
-					if levels != cur_level:
-						mypkgs = mypkgs.union(await getDependencies(cur_overlay, mypkg, levels=levels, cur_level=cur_level+1))
-	return mypkgs
+async def getDependencies(cur_overlay, catpkgs, levels=0):
+	# direct dependencies of catpkgs, and with levels > 0, their dependencies too, up to levels steps further. Like
+	# portage's cp_list(), this sees the ebuilds in core-kit as well as those in cur_overlay:
+	graph = await tree_dep_graph(cur_overlay)
+	return graph.reachable(catpkgs, levels=levels)
 
 def getPackagesInCatWithMaintainer(cur_overlay, my_cat, my_email):
 	cat_root = os.path.join(cur_overlay.root, my_cat)
@@ -854,147 +1416,21 @@ def getPackagesMatchingGlob(cur_overlay, my_glob, exclusions=None):
 	insert_list = []
 	if exclusions is None:
 		exclusions = []
-	for candidate in glob.glob(cur_overlay.root + "/" + my_glob):
-		if not os.path.isdir(candidate):
-			continue
-		strip_len = len(cur_overlay.root)+1
-		candy_strip = candidate[strip_len:]
+	for candy_strip in cur_overlay.index.match_glob(my_glob):
 		if candy_strip not in exclusions:
 			insert_list.append(candy_strip)
 	return insert_list
 
 def getPackagesMatchingRegex(cur_overlay, my_regex):
-	insert_list = []
-	for candidate in glob.glob(cur_overlay.root + "/*/*"):
-		if not os.path.isdir(candidate):
-			continue
-		strip_len = len(cur_overlay.root)+1
-		candy_strip = candidate[strip_len:]
-		if my_regex.match(candy_strip):
-			insert_list.append(candy_strip)
-	return insert_list
+	return cur_overlay.index.match_regex(my_regex)
 
 async def getPackagesWithEclass(cur_overlay, eclass):
-	cur_tree = cur_overlay.root
-	try:
-		with open(os.path.join(cur_tree, 'profiles/repo_name')) as f:
-			cur_name = f.readline().strip()
-	except FileNotFoundError:
-			cur_name = cur_overlay.name
-	env = os.environ.copy()
-	if cur_name != "core-kit":
-		env['PORTAGE_REPOSITORIES'] = '''
-	[DEFAULT]
-	main-repo = core-kit
-
-	[core-kit]
-	location = %s/core-kit
-	aliases = gentoo
-
-	[%s]
-	location = %s
-	''' % (cur_overlay.config.dest_trees, cur_name, cur_tree)
-	else:
-		env['PORTAGE_REPOSITORIES'] = '''
-	[DEFAULT]
-	main-repo = core-kit
-
-	[core-kit]
-	location = /%s/core-kit
-	aliases = gentoo
-	''' % cur_overlay.config.dest_trees
-	p = portage.portdbapi(mysettings=portage.config(env=env, config_profile_path=''))
-	mypkgs = set()
-
-	future_aux = {}
-	cpv_map = {}
-
-	def future_generator():
-		for catpkg in p.cp_all():
-			for my_cpv in p.cp_list(catpkg):
-				if my_cpv == '':
-					print("No match for %s" % catpkg)
-					continue
-				cpv_map[my_cpv] = catpkg
-				my_future = p.async_aux_get(my_cpv, [ "INHERITED"])
-				future_aux[id(my_future)] = my_cpv
-				yield my_future
-
-	for fu_fu in  async_iter_completed(future_generator()):
-		future_set = await fu_fu
-		for future in future_set:
-			cpv = future_aux.pop(id(future))
-			try:
-				result = future.result()
-			except KeyError as e:
-				print("aux_get fail", cpv, e)
-			else:
-				if eclass in result[0].split():
-					cp = cpv_map[cpv]
-					if cp not in mypkgs:
-						mypkgs.add(cp)
-	return mypkgs
+	index = await tree_eclass_index(cur_overlay)
+	return index.catpkgs(eclass)
 
 async def getPackagesInCatWithEclass(cur_overlay, cat, eclass):
-	cur_tree = cur_overlay.root
-	try:
-		with open(os.path.join(cur_tree, 'profiles/repo_name')) as f:
-			cur_name = f.readline().strip()
-	except FileNotFoundError:
-			cur_name = cur_overlay.name
-	env = os.environ.copy()
-	if cur_name != "core-kit":
-		env['PORTAGE_REPOSITORIES'] = '''
-	[DEFAULT]
-	main-repo = core-kit
-
-	[core-kit]
-	location = %s/core-kit
-	aliases = gentoo
-
-	[%s]
-	location = %s
-	''' % (cur_overlay.config.dest_trees, cur_name, cur_tree)
-	else:
-		env['PORTAGE_REPOSITORIES'] = '''
-	[DEFAULT]
-	main-repo = core-kit
-
-	[core-kit]
-	location = %s/core-kit
-	aliases = gentoo
-	''' % cur_overlay.config.dest_trees
-	p = portage.portdbapi(mysettings=portage.config(env=env, config_profile_path=''))
-	mypkgs = set()
-
-	future_aux = {}
-	cpv_map = {}
-
-	def future_generator():
-		for catpkg in p.cp_all(categories=[cat]):
-			for my_cpv in p.cp_list(catpkg):
-				if my_cpv == '':
-					print("No match for %s" % catpkg)
-					continue
-				cpv_map[my_cpv] = catpkg
-				my_future = p.async_aux_get(my_cpv, [ "INHERITED"])
-				future_aux[id(my_future)] = my_cpv
-				yield my_future
-
-	for fu_fu in async_iter_completed(future_generator()):
-		future_set = await fu_fu
-		for future in future_set:
-			cpv = future_aux.pop(id(future))
-			try:
-				result = future.result()
-			except KeyError as e:
-				print("aux_get fail", cpv, e)
-			else:
-				if eclass in result[0].split():
-					cp = cpv_map[cpv]
-					if cp not in mypkgs:
-						mypkgs.add(cp)
-	return mypkgs
+	index = await tree_eclass_index(cur_overlay)
+	return index.catpkgs(eclass, categories=[cat])
 
 def extract_uris(src_uri):
 	
@@ -1038,6 +1474,11 @@ def extract_uris(src_uri):
 
 class FastPullScan(MergeStep):
 
+	# we don't modify the tree:
+	journaled = True
+	reads = [ "@ebuilds", "@manifests", "eclass", "metadata/layout.conf", "metadata/md5-cache", "profiles/repo_name" ]
+	writes = []
+
 	def __init__(self, now, engine: AsyncEngine = None):
 		self.now = now
 		self.engine = engine
@@ -1046,37 +1487,10 @@ class FastPullScan(MergeStep):
 		if self.engine is None:
 			return
 		cur_tree = cur_overlay.root
-		try:
-			with open(os.path.join(cur_tree, 'profiles/repo_name')) as f:
-				cur_name = f.readline().strip()
-		except FileNotFoundError:
-				cur_name = cur_overlay.name
-		env = os.environ.copy()
-		if cur_name != "core-kit":
-			env['PORTAGE_REPOSITORIES'] = '''
-		[DEFAULT]
-		main-repo = core-kit
-
-		[core-kit]
-		location = %s/core-kit
-		aliases = gentoo
-
-		[%s]
-		location = %s
-		''' % (cur_overlay.config.dest_trees, cur_name, cur_tree)
-		else:
-			env['PORTAGE_REPOSITORIES'] = '''
-		[DEFAULT]
-		main-repo = core-kit
+		p = portdb_pool.get(cur_overlay, accept_keywords="~amd64 amd64")
+		table = await tree_metadata(cur_overlay)
 
-		[core-kit]
-		location = %s/core-kit
-		aliases = gentoo
-		''' % cur_overlay.config.dest_trees
-		env['ACCEPT_KEYWORDS'] = "~amd64 amd64"
-		p = portage.portdbapi(mysettings=portage.config(env=env, config_profile_path=''))
-
-		for pkg in p.cp_all(trees=[cur_overlay.root]):
+		for pkg in table.packages():
 
 			# src_uri now has the following format:
 
@@ -1094,23 +1508,16 @@ class FastPullScan(MergeStep):
 			fn_urls = defaultdict(list)
 			fn_meta = defaultdict(dict)
 
-			for cpv in await async_xmatch(p, "match-all", pkg):
-				if len(cpv) == 0:
-					continue
-				try:
-					aux_info = await p.async_aux_get(cpv, ["SRC_URI", "RESTRICT" ], mytree=cur_overlay.root)
-					restrict = aux_info[1].split()
-					mirror_restrict = False
-					for r in restrict:
-						if r == "mirror":
-							mirror_restrict = True
-							break
-				except portage.exception.PortageKeyError:
-					print("!!! PortageKeyError on %s" % cpv)
-					continue
+			for cpv, src_uri in table.column("SRC_URI", pkg):
+				restrict = table.get(cpv, [ "RESTRICT" ])[0].split()
+				mirror_restrict = False
+				for r in restrict:
+					if r == "mirror":
+						mirror_restrict = True
+						break
 
 				# record our own metadata about each file...
-				new_fn_urls, new_files = extract_uris(aux_info[0])
+				new_fn_urls, new_files = extract_uris(src_uri)
 				fn_urls.update(new_fn_urls)
 				for fn in new_files:
 					fn_meta[fn]["restrict"] = mirror_restrict
@@ -1241,10 +1648,10 @@ async def getAllEclasses(dest_kit, release):
 async def getAllLicenses(dest_kit, release):
 	return await _getAllDriver("LICENSE", "licenses", dest_kit, release)
 
-# getAllMeta uses the Portage API to query metadata out of a set of repositories. It is designed to be used to figure
-# out what licenses or eclasses to copy from a parent repository to the current kit so that the current kit contains a
-# set of all eclasses (and licenses) it needs within itself, without any external dependencies on other repositories 
-# for these items -- this is a key design feature of kits to improve stability.
+# getAllMeta uses the metadata of a kit's ebuilds to figure out what licenses or eclasses to copy from a parent
+# repository to the current kit so that the current kit contains a set of all eclasses (and licenses) it needs within
+# itself, without any external dependencies on other repositories for these items -- this is a key design feature of
+# kits to improve stability.
 
 # It supports being called this way:
 #
@@ -1257,74 +1664,19 @@ async def getAllLicenses(dest_kit, release):
 #  getAllMeta() returns a set of actual files (without directories) that are used, so [ 'foo.eclass', 'bar.eclass'] 
 #  or [ 'GPL-2', 'bleh' ].
 #
+# Both come from a single pass over the kit's metadata (see getKitMetadata()), which is shared by getAllEclasses() and
+# getAllLicenses() as long as no ebuild or eclass in the kit changes in between.
+
+async def getKitMetadata(dest_kit, release):
+	table = await tree_metadata(dest_kit, depcachedir='/var/cache/edb/%s-%s-%s-meta' % ( release, dest_kit.name, dest_kit.branch ))
+	return kit_metadata(table)
 
 async def getAllMeta(metadata, dest_kit, release):
-	metadict = { "LICENSE" : 0, "INHERITED" : 1 }
-	metapos = metadict[metadata]
-	
-	env = os.environ.copy()
-	env['PORTAGE_DEPCACHEDIR'] = '/var/cache/edb/%s-%s-%s-meta' % ( release, dest_kit.name, dest_kit.branch )
-	if dest_kit.name != "core-kit":
-		env['PORTAGE_REPOSITORIES'] = '''
-	[DEFAULT]
-	main-repo = core-kit
-
-	[core-kit]
-	location = %s/core-kit
-	aliases = gentoo
-
-	[%s]
-	location = %s
-		''' % ( dest_kit.config.dest_trees, dest_kit.name, dest_kit.root)
-	else:
-		# we are testing a stand-alone kit that should have everything it needs included
-		env['PORTAGE_REPOSITORIES'] = '''
-	[DEFAULT]
-	main-repo = core-kit
-
-	[%s]
-	location = %s
-	aliases = gentoo
-		''' % ( dest_kit.name, dest_kit.root )
-
-	p = portage.portdbapi(mysettings=portage.config(env=env, config_profile_path=''))
-	mymeta = set()
-
-	future_aux = {}
-	cpv_map = {}
-
-	def future_generator():
-		for catpkg in p.cp_all(trees=[dest_kit.root]):
-			for cpv in p.cp_list(catpkg, mytree=dest_kit.root):
-				if cpv == '':
-					print("No match for %s" % catpkg)
-					continue
-				cpv_map[cpv] = catpkg
-				my_future = p.async_aux_get(cpv, [ "LICENSE", "INHERITED" ], mytree=dest_kit.root)
-				future_aux[id(my_future)] = cpv
-				yield my_future
-
-	for fu_fu in async_iter_completed(future_generator()):
-		future_set = await fu_fu
-		for future in future_set:
-			cpv = future_aux.pop(id(future))
-			try:
-				result = future.result()
-			except KeyError as e:
-				print("aux_get fail", cpv, e)
-			else:
-				if metadata == "INHERITED":
-					for eclass in result[metapos].split():
-						key = eclass + ".eclass"
-						if key not in mymeta:
-							mymeta.add(key)
-				elif metadata == "LICENSE":
-					for lic in result[metapos].split():
-						if lic in [")", "(", "||"] or lic.endswith("?"):
-							continue
-						if lic not in mymeta:
-							mymeta.add(lic)
-	return mymeta
+	kit_meta = await getKitMetadata(dest_kit, release)
+	if metadata == "INHERITED":
+		return set(eclass + ".eclass" for eclass in kit_meta.eclasses)
+	elif metadata == "LICENSE":
+		return set(kit_meta.licenses)
 
 
 async def generateKitSteps(release, kit_name, from_tree, select_only="all", fixup_repo=None, cpm_logger=None, filter_repos=None, filter_cats=None, move_maps=None, force=None, secondary_kit=False):
@@ -1346,9 +1698,11 @@ async def generateKitSteps(release, kit_name, from_tree, select_only="all", fixu
 	else:
 		move_maps = move_maps
 	master_pkglist, skip = get_package_set_and_skips_for_kit(fixup_repo.root, release, kit_name)
+	# regexes and category globs, which are all matched against from_tree at once:
+	selector_patterns = []
 	for pattern in master_pkglist:
 		if pattern.startswith("@regex@:"):
-			pkglist += getPackagesMatchingRegex( from_tree, re.compile(pattern[8:]))
+			selector_patterns.append(pattern)
 		elif pattern.startswith("@depsincat@:"):
 			patsplit = pattern.split(":")
 			catpkg = patsplit[1]
@@ -1379,7 +1733,10 @@ async def generateKitSteps(release, kit_name, from_tree, select_only="all", fixu
 						exclusions.append(exclusion[1:])
 					else:
 						print("Invalid exclusion: %s" % pattern)
-				pkglist += getPackagesMatchingGlob( from_tree, linesplit[0], exclusions=exclusions )
+				if len(linesplit) == 1 and "/" not in linesplit[0][:-2]:
+					selector_patterns.append(linesplit[0])
+				else:
+					pkglist += getPackagesMatchingGlob( from_tree, linesplit[0], exclusions=exclusions )
 			else:
 				move_pkg = pattern.split("->")
 				if len(move_pkg) == 2:
@@ -1390,6 +1747,8 @@ async def generateKitSteps(release, kit_name, from_tree, select_only="all", fixu
 				else:
 					pkglist.append(pattern)
 					literals.append(pattern)
+	if len(selector_patterns):
+		pkglist += CatPkgSelector(selector_patterns).select(from_tree.index)
 
 	to_insert = set(pkglist)
 
@@ -1545,9 +1904,17 @@ class CatPkgMatchLogger(object):
 
 		self._fixup_matchdict = defaultdict(dict)
 		self._matchdict_curkit = {}
-		# for regex matches
+		# for regex matches. format: 'regex pattern' : 'first catpkg it matched'
 		self._regexdict = {}
 		self._regexdict_curkit = {}
+		# the active regexes (those in _regexdict), compiled into a single CatPkgSelector -- see _activate():
+		self._regex_selector = None
+		# match() results for the current kit. They only change when nextKit() or restore() is called:
+		self._match_cache = {}
+		self._cache_hits = 0
+		self._cache_misses = 0
+		# everything that changed our state, so it can be saved and replayed -- see save() and load():
+		self._log = []
 
 		if log_xml:
 			self.xml_recorder = XMLRecorder()
@@ -1591,6 +1958,22 @@ class CatPkgMatchLogger(object):
 	def matchcount(self):
 		return self._matchcount
 
+	@property
+	def cache_hits(self):
+		return self._cache_hits
+
+	@property
+	def cache_misses(self):
+		return self._cache_misses
+
+	def _activate(self):
+		# called whenever _matchdict or _regexdict change, which only happens in nextKit() and restore():
+		if len(self._regexdict):
+			self._regex_selector = CatPkgSelector([ "@regex@:" + pat for pat in self._regexdict.keys() ])
+		else:
+			self._regex_selector = None
+		self._match_cache = {}
+
 	def match(self, catpkg):
 		"""
 		This method tells us whether we should copy over a catpkg to a particular kit.
@@ -1599,21 +1982,32 @@ class CatPkgMatchLogger(object):
 				 should copy..
 		"""
 
-		if catpkg in self._matchdict:
-			# Yes, we've seen it, just as a regular package copied before (non-fixup), so don't copy
-			return True
-
-		for pat, regex in self._regexdict.items():
-			if regex.match(catpkg):
+		try:
+			result = self._match_cache[catpkg]
+			self._cache_hits += 1
+		except KeyError:
+			self._cache_misses += 1
+			if catpkg in self._matchdict:
+				# Yes, we've seen it, just as a regular package copied before (non-fixup), so don't copy
+				result = True
+			elif self._regex_selector is not None and self._regex_selector.match(catpkg):
 				# Seen and likely copied before, don't copy
-				return True
-		# We've passed all tests -- copy this sucker!
-		return False
+				result = True
+			else:
+				# We've passed all tests -- copy this sucker!
+				result = False
+			self._match_cache[catpkg] = result
+		if result:
+			self._matchcount += 1
+		return result
 
 	def update_cached_kit_catpkg_set(self, myset):
 		# this is used by the intra-kit logic that identifies catpkgs selected from prior runs of the same kit that
 		# don't exist in the current kit selection. We want to grab these stragglers.
 
+		added = myset - self._current_kit_set
+		if len(added) and self._log is not None:
+			self._log.append([ "kit_set", sorted(added) ])
 		self._current_kit_set |= myset
 		return self._current_kit_set
 
@@ -1630,6 +2024,8 @@ class CatPkgMatchLogger(object):
 		:param is_fixup: True if we are applying a fixup; else False.
 		:return: None
 		"""
+		if self._log is not None:
+			self._log.append([ "record", kit, catpkg, regex_matched.pattern if regex_matched is not None else None, is_fixup ])
 		if regex_matched is not None:
 			if is_fixup:
 				raise IndexError("Can't use regex with fixup")
@@ -1641,42 +2037,125 @@ class CatPkgMatchLogger(object):
 			self._match_map[catpkg] = kit
 		self._copycount += 1
 
+	def snapshot(self):
+		"""
+		Return a copy of everything we have recorded so far. Passing it to restore() puts a CatPkgMatchLogger into the
+		same state, so that it makes the same decisions as we would from now on.
+		"""
+		return {
+			"copycount": self._copycount,
+			"matchdict": dict(self._matchdict),
+			"matchdict_curkit": dict(self._matchdict_curkit),
+			"regexdict": dict(self._regexdict),
+			"regexdict_curkit": dict(self._regexdict_curkit),
+			"match_map": dict(self._match_map),
+			"current_kit_set": set(self._current_kit_set)
+		}
+
+	def restore(self, state):
+		self._copycount = state["copycount"]
+		self._matchdict = dict(state["matchdict"])
+		self._matchdict_curkit = dict(state["matchdict_curkit"])
+		self._regexdict = dict(state["regexdict"])
+		self._regexdict_curkit = dict(state["regexdict_curkit"])
+		self._match_map = dict(state["match_map"])
+		self._current_kit_set = set(state["current_kit_set"])
+		self._activate()
+		# we don't know how we got to this state, so we can't be saved:
+		self._log = None
+
+	def startKitBranch(self, key):
+		# mark the point where we start generating kit branch ``key`` (like "xorg-kit/1.19-prime"), for load():
+		if self._log is not None:
+			self._log.append([ "kit", key ])
+
+	def save(self, path):
+		"""
+		Save everything we have recorded, in the order it was recorded, to ``path`` as gzipped JSON. Since each catpkg is
+		only recorded once, this is much smaller than our state at each kit, while load() can still rebuild it.
+		"""
+		if self._log is None:
+			raise ValueError("Can't save a CatPkgMatchLogger that was restored from a snapshot.")
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+			json.dump({ "version": 1, "log": self._log }, f, separators=(",", ":"))
+		os.rename(path + ".tmp", path)
+
+	@classmethod
+	def load(cls, path, until=None):
+		"""
+		Load a CatPkgMatchLogger saved with save(). If ``until`` is the key of a kit branch, the returned logger is in the
+		state it was in right before that kit branch was generated, so that kit branch can be regenerated on its own with
+		the same results. KeyError is raised if that kit branch isn't in the file.
+		"""
+		with gzip.open(path, "rt", encoding="utf-8") as f:
+			data = json.load(f)
+		if data["version"] != 1:
+			raise ValueError("%s: unknown CatPkgMatchLogger format version %s" % (path, data["version"]))
+		logger = cls()
+		for entry in data["log"]:
+			if entry[0] == "kit":
+				if entry[1] == until:
+					return logger
+				logger.startKitBranch(entry[1])
+			elif entry[0] == "next_kit":
+				logger.nextKit()
+			elif entry[0] == "kit_set":
+				logger.update_cached_kit_catpkg_set(set(entry[1]))
+			elif entry[0] == "record":
+				kit, catpkg, pattern, is_fixup = entry[1:]
+				logger.record(kit, catpkg, regex_matched=re.compile(pattern) if pattern is not None else None, is_fixup=is_fixup)
+		if until is not None:
+			raise KeyError(until)
+		return logger
+
 	def nextKit(self):
+		if self._log is not None:
+			self._log.append([ "next_kit" ])
+		new_regexes = any(pat not in self._regexdict for pat in self._regexdict_curkit)
 		self._regexdict.update(self._regexdict_curkit)
 		self._regexdict_curkit = {}
 		self._matchdict.update(self._matchdict_curkit)
 		self._matchdict_curkit = {}
 		self._current_kit_set = set()
+		if new_regexes:
+			self._activate()
+		else:
+			self._match_cache = {}
 
 def headSHA1(tree):
-	retval, out = subprocess.getstatusoutput("(cd %s && git rev-parse HEAD)" % tree)
+	cmd = "(cd %s && git rev-parse HEAD)" % tree
+	with tracer.subprocess(cmd):
+		retval, out = subprocess.getstatusoutput(cmd)
 	if retval == 0:
 		return out.strip()
 	return None
 
 
-async def getcommandoutput(args, env=None):
+async def getcommandoutput(args, env=None, input=None):
 	# Slight modification of the function getstatusoutput present in:
 	# https://docs.python.org/3/library/asyncio-subprocess.html#example
-	if isinstance(args, str):
-		proc = await asyncio.create_subprocess_shell(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
-	else:
-		proc = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
-	try:
-		stdout, stderr = await proc.communicate()
-	except:
-		proc.kill()
-		await proc.wait()
-		raise
+	stdin = subprocess.PIPE if input is not None else None
+	with tracer.subprocess(args):
+		if isinstance(args, str):
+			proc = await asyncio.create_subprocess_shell(args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+		else:
+			proc = await asyncio.create_subprocess_exec(*args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+		try:
+			stdout, stderr = await proc.communicate(input)
+		except:
+			proc.kill()
+			await proc.wait()
+			raise
 
-	exitcode = await proc.wait()
+		exitcode = await proc.wait()
 	return exitcode, stdout, stderr
 
 
-async def runShell(cmd_list, abort_on_failure=True, env=None):
+async def runShell(cmd_list, abort_on_failure=True, env=None, input=None):
 	if debug:
 		print("running: %r" % cmd_list)
-	out = await getcommandoutput(cmd_list, env=env)
+	out = await getcommandoutput(cmd_list, env=env, input=input)
 	if out[0] != 0:
 		print("Error executing %r" % cmd_list)
 		print()
@@ -1707,6 +2186,8 @@ class AutoGlobMask(MergeStep):
 
 	"""
 
+	journaled = True
+
 	def __init__(self, catpkg, my_glob, maskdest):
 		self.glob = my_glob
 		self.catpkg = catpkg
@@ -1715,19 +2196,23 @@ class AutoGlobMask(MergeStep):
 	async def run(self,tree):
 		if not os.path.exists(tree.root + "/profiles/package.mask"):
 			os.makedirs(tree.root + "/profiles/package.mask")
-		f = open(os.path.join(tree.root,"profiles/package.mask", self.maskdest), "w")
-		#os.chdir(os.path.join(tree.root,self.catpkg))
-		cat = self.catpkg.split("/")[0]
-		for item in glob.glob(os.path.join(tree.root,self.catpkg) + "/" + self.glob+".ebuild"):
-			s_split = item.split("/")
-			f.write("=%s/%s\n" % (cat,"/".join(s_split[-2:])[:-7]))
-		f.close()
+		tree.journal(os.path.join("profiles/package.mask", self.maskdest))
+		with replace_file(os.path.join(tree.root,"profiles/package.mask", self.maskdest)) as f:
+			cat = self.catpkg.split("/")[0]
+			for item in glob.glob(os.path.join(tree.root,self.catpkg) + "/" + self.glob+".ebuild"):
+				s_split = item.split("/")
+				f.write("=%s/%s\n" % (cat,"/".join(s_split[-2:])[:-7]))
 
 class ThirdPartyMirrors(MergeStep):
 	"Add funtoo's distfiles mirror, and add funtoo's mirrors as gentoo back-ups."
 
+	journaled = True
+	reads = [ "profiles/thirdpartymirrors" ]
+	writes = [ "profiles/thirdpartymirrors" ]
+
 	async def run(self,tree):
 		orig = "%s/profiles/thirdpartymirrors" % tree.root
+		tree.journal(orig)
 		new = "%s/profiles/thirdpartymirrors.new" % tree.root
 		mirrors = "https://fastpull-us.funtoo.org/distfiles"
 		a = open(orig, "r")
@@ -1761,6 +2246,11 @@ class ApplyPatchSeries(MergeStep):
 				runShell( "( cd %s && git apply %s/%s )" % ( tree.root, self.path, line[:-1] ))
 
 class GenerateRepoMetadata(MergeStep):
+
+	journaled = True
+	reads = []
+	writes = [ "metadata/layout.conf", "profiles/repo_name" ]
+
 	def __init__(self, name, masters=None, aliases=None, priority=None):
 		self.name = name
 		self.aliases = aliases if aliases is not None else []
@@ -1771,7 +2261,7 @@ class GenerateRepoMetadata(MergeStep):
 		meta_path = os.path.join(tree.root, "metadata")
 		if not os.path.exists(meta_path):
 			os.makedirs(meta_path)
-		a = open(meta_path + '/layout.conf','w')
+		tree.journal("metadata/layout.conf", "profiles/repo_name")
 		out = '''repo-name = %s
 thin-manifests = true
 sign-manifests = false
@@ -1782,14 +2272,13 @@ cache-formats = md5-dict
 			out += "aliases = %s\n" % " ".join(self.aliases)
 		if self.masters:
 			out += "masters = %s\n" % " ".join(self.masters)
-		a.write(out)
-		a.close()
+		with replace_file(meta_path + '/layout.conf') as a:
+			a.write(out)
 		rn_path = os.path.join(tree.root, "profiles")
 		if not os.path.exists(rn_path):
 			os.makedirs(rn_path)
-		a = open(rn_path + '/repo_name', 'w')
-		a.write(self.name + "\n")
-		a.close() 
+		with replace_file(rn_path + '/repo_name') as a:
+			a.write(self.name + "\n")
 
 class RemoveFiles(MergeStep):
 	def __init__(self,globs=None):
@@ -1803,12 +2292,17 @@ class RemoveFiles(MergeStep):
 			runShell(cmd)
 
 class SyncDir(MergeStep):
-	def __init__(self,srcroot,srcdir=None,destdir=None,exclude=None,delete=False):
+
+	journaled = True
+
+	def __init__(self,srcroot,srcdir=None,destdir=None,exclude=None,delete=False,srctree=None):
 		self.srcroot = srcroot
 		self.srcdir = srcdir
 		self.destdir = destdir
 		self.exclude = exclude if exclude is not None else []
 		self.delete = delete
+		# srctree is the GitTree that srcroot belongs to, if any. This allows the sync to be grafted (see GitTree.graftPath()):
+		self.srctree = srctree
 
 	async def run(self, tree):
 		if self.srcdir:
@@ -1824,6 +2318,13 @@ class SyncDir(MergeStep):
 				dest = os.path.normpath(tree.root)+"/"
 		if not os.path.exists(dest):
 			os.makedirs(dest)
+		tree.journal(dest)
+		if self.srcdir and not len(self.exclude) and isinstance(tree, GitTree) and tree.canGraft(self.srctree):
+			if self.delete:
+				await runShell("rm -rf %s" % dest)
+			tree.graftPath(self.srctree, src, dest, replace=self.delete)
+			await tree.applyGrafts()
+			return
 		cmd = "rsync -a --exclude CVS --exclude .svn --filter=\"hide /.git\" --filter=\"protect /.git\" "
 		for e in self.exclude:
 			cmd += "--exclude %s " % e
@@ -1833,6 +2334,9 @@ class SyncDir(MergeStep):
 		await runShell(cmd)
 
 class CopyAndRename(MergeStep):
+
+	journaled = True
+
 	def __init__(self, src, dest, ren_fun):
 		self.src = src
 		self.dest = dest
@@ -1841,12 +2345,18 @@ class CopyAndRename(MergeStep):
 
 	async def run(self, tree):
 		srcpath = os.path.join(tree.root,self.src)
+		copies = []
 		for f in os.listdir(srcpath):
 			destfile = os.path.join(tree.root,self.dest)
 			destfile = os.path.join(destfile,self.ren_fun(f))
-			await runShell("( cp -a %s/%s %s )" % ( srcpath, f, destfile ))
+			tree.journal(destfile)
+			copies.append((os.path.join(srcpath, f), destfile))
+		await copy_engine.copy(copies)
 
 class SyncFiles(MergeStep):
+
+	journaled = True
+
 	def __init__(self, srcroot, files):
 		self.srcroot = srcroot
 		self.files = files
@@ -1860,6 +2370,7 @@ class SyncFiles(MergeStep):
 			else:
 				dest = os.path.join(tree.root, src)
 			src = os.path.join(self.srcroot, src)
+			tree.journal(dest)
 			if os.path.exists(dest):
 				print("%s exists, attempting to unlink..." % dest)
 				try:
@@ -1877,18 +2388,27 @@ class SyncFiles(MergeStep):
 
 class ELTSymlinkWorkaround(MergeStep):
 
+	# this only creates an empty directory, which git doesn't track:
+	journaled = True
+	reads = []
+	writes = [ "eclass/ELT-patches" ]
+
 	async def run(self, tree):
 		dest = os.path.join(tree.root + "/eclass/ELT-patches")
 		if not os.path.lexists(dest):
 			os.makedirs(dest)
 
 class MergeUpdates(MergeStep):
+
+	journaled = True
+
 	def __init__(self, srcroot):
 		self.srcroot = srcroot
 
 	async def run(self, tree):
 		for src in sorted(glob.glob(os.path.join(self.srcroot, "profiles/updates/?Q-????")), key=lambda x: (x[-4:], x[-7])):
 			dest = os.path.join(tree.root, "profiles/updates", src[-7:])
+			tree.journal(dest)
 			if os.path.exists(dest):
 				src_file = open(src)
 				dest_file = open(dest)
@@ -1897,26 +2417,30 @@ class MergeUpdates(MergeStep):
 				src_file.close()
 				dest_file.close()
 				dest_lines.extend(src_lines)
-				dest_file = open(dest, "w")
-				dest_file.writelines(dest_lines)
-				dest_file.close()
+				with replace_file(dest) as dest_file:
+					dest_file.writelines(dest_lines)
 			else:
 				shutil.copyfile(src, dest)
 
 class CleanTree(MergeStep):
 	# remove all files from tree, except dotfiles/dirs.
 
+	journaled = True
+
 	def __init__(self,exclude=None):
 		if exclude is None:
 			exclude = []
 		self.exclude = exclude
 	
 	async def run(self,tree):
+		if isinstance(tree, GitTree) and tree.setAsidePrevious(exclude=self.exclude):
+			return
 		for fn in os.listdir(tree.root):
 			if fn[:1] == ".":
 				continue
 			if fn in self.exclude:
 				continue
+			tree.journalRemoval(fn)
 			await runShell("rm -rf %s/%s" % (tree.root, fn))
 
 class SyncFromTree(SyncDir):
@@ -1924,8 +2448,7 @@ class SyncFromTree(SyncDir):
 	def __init__(self,srctree,exclude=None):
 		if exclude is None:
 			exclude=[]
-		self.srctree = srctree
-		SyncDir.__init__(self,srctree.root,srcdir=None,destdir=None,exclude=exclude,delete=True)
+		SyncDir.__init__(self,srctree.root,srcdir=None,destdir=None,exclude=exclude,delete=True,srctree=srctree)
 
 	async def run(self, desttree):
 		await SyncDir.run(self,desttree)
@@ -1981,10 +2504,10 @@ class XMLRecorder(object):
 		catxml.append(pkgxml)
 
 
-regextype = type(re.compile('hello, world'))
-
 class InsertFilesFromSubdir(MergeStep):
 
+	journaled = True
+
 	def __init__(self,srctree,subdir,suffixfilter=None,select="all",skip=None, src_offset=None):
 		self.subdir = subdir
 		self.suffixfilter = suffixfilter
@@ -2007,6 +2530,8 @@ class InsertFilesFromSubdir(MergeStep):
 			dst = os.path.join(dst, self.subdir)
 		if not os.path.exists(dst):
 			os.makedirs(dst)
+		graft = isinstance(desttree, GitTree) and desttree.canGraft(self.srctree)
+		copies = []
 		for e in os.listdir(src):
 			if self.suffixfilter and not e.endswith(self.suffixfilter):
 				continue
@@ -2022,8 +2547,14 @@ class InsertFilesFromSubdir(MergeStep):
 			elif isinstance(self.skip, regextype):
 				if self.skip.match(e):
 					continue
-			real_dst = os.path.basename(os.path.join(dst, e))
-			await runShell("cp -a %s/%s %s" % ( src, e, dst))
+			desttree.journal(os.path.join(dst, e))
+			if graft:
+				desttree.graftPath(self.srctree, os.path.join(src, e), os.path.join(dst, e))
+			else:
+				copies.append((os.path.join(src, e), os.path.join(dst, e)))
+		await copy_engine.copy(copies)
+		if graft:
+			await desttree.applyGrafts()
 
 class InsertEclasses(InsertFilesFromSubdir):
 
@@ -2037,23 +2568,33 @@ class InsertLicenses(InsertFilesFromSubdir):
 
 class CreateCategories(MergeStep):
 
+	journaled = True
+	# we also read profiles/categories of our source tree, which isn't part of our tree:
+	reads = [ "@ebuilds" ]
+	writes = [ "profiles/categories" ]
+
 	def __init__(self,srctree):
 		self.srctree = srctree
 
 	async def run(self,desttree):
 		catset = set()
+		dest_index = desttree.index
 		with open(self.srctree.root + "/profiles/categories", "r") as f:
 			cats = f.read().split()
 			for cat in cats:
-				if os.path.isdir(desttree.root + "/" + cat):
+				if dest_index.has_category(cat):
 					catset.add(cat)
 			if not os.path.exists(desttree.root + "/profiles"):
 				os.makedirs(desttree.root + "/profiles")
-			with open(desttree.root + "/profiles/categories", "w") as g:
+			desttree.journal("profiles/categories")
+			with replace_file(desttree.root + "/profiles/categories") as g:
 				for cat in sorted(list(catset)):
 					g.write(cat+"\n")
 
 class ZapMatchingEbuilds(MergeStep):
+
+	journaled = True
+
 	def __init__(self,srctree,select="all",branch=None):
 		self.select = select
 		self.srctree = srctree
@@ -2074,18 +2615,19 @@ class ZapMatchingEbuilds(MergeStep):
 
 		# Our main loop:
 		print( "# Zapping builds from %s" % desttree.root )
-		for cat in os.listdir(desttree.root):
+		src_index = self.srctree.index
+		dest_index = desttree.index
+		for cat in dest_index.categories:
 			if cat not in dest_cat_set:
 				continue
-			src_catdir = os.path.join(self.srctree.root,cat)
-			if not os.path.isdir(src_catdir):
+			if not src_index.has_category(cat):
 				continue
-			for src_pkg in os.listdir(src_catdir):
-				dest_pkgdir = os.path.join(desttree.root,cat,src_pkg)
-				if not os.path.exists(dest_pkgdir):
+			for src_pkg in src_index.packages(cat):
+				if not dest_index.catpkg_exists(cat + "/" + src_pkg):
 					# don't need to zap as it doesn't exist
 					continue
-				await runShell("rm -rf %s" % dest_pkgdir)
+				desttree.journal(os.path.join(cat, src_pkg))
+				remove_path(os.path.join(desttree.root, cat, src_pkg))
 
 
 class RecordAllCatPkgs(MergeStep):
@@ -2094,6 +2636,8 @@ class RecordAllCatPkgs(MergeStep):
 	This is used for non-auto-generated kits where we should record the catpkgs as belonging to a particular kit
 	but perform no other action. A kit generation NO-OP, comparted to InsertEbuilds
 	"""
+
+	journaled = True
 	
 	def __init__(self, srctree: GitTree, cpm_logger: CatPkgMatchLogger=None):
 		self.cpm_logger = cpm_logger
@@ -2133,6 +2677,9 @@ class InsertEbuilds(MergeStep):
 	
 	
 	"""
+
+	journaled = True
+
 	def __init__(self, srctree: GitTree, select="all", select_only="all", skip=None, replace=False, categories=None,
 				 ebuildloc=None, branch=None, cpm_logger: CatPkgMatchLogger=None, literals: list=None, move_maps: dict=None, is_fixup=False):
 		self.select = select
@@ -2158,6 +2705,12 @@ class InsertEbuilds(MergeStep):
 		else:
 			self.select_only = select_only
 		self.branch = branch
+		# select, select_only, skip and replace compiled into CatPkgSelectors, or None if they don't limit anything:
+		self._select = compile_selector(select) if isinstance(select, (list, regextype)) else None
+		self._select_only = compile_selector(self.select_only) if self.select_only != "all" else None
+		self._skip = compile_selector(skip) if isinstance(skip, (list, regextype)) else None
+		self._replace = compile_selector(replace) if isinstance(replace, list) else None
+		self._literals = set(self.literals)
 
 
 		self.ebuildloc = ebuildloc
@@ -2165,22 +2718,16 @@ class InsertEbuilds(MergeStep):
 	def __repr__(self):
 		return "<InsertEbuilds: %s>" % self.srctree.root
 
-	async def run(self,desttree):
-		if self.branch is not None:
-			# Allow dynamic switching to different branches/commits to grab things we want:
-			await self.srctree.gitCheckout(self.branch)
-		# Just for clarification, I'm breaking these out to separate variables:
-		branch = desttree.branch
-		kit = desttree.name
-
+	def srcRoot(self):
 		if self.ebuildloc:
-			srctree_root = self.srctree.root + "/" + self.ebuildloc
+			return self.srctree.root + "/" + self.ebuildloc
 		else:
-			srctree_root = self.srctree.root
-		desttree.logTree(self.srctree)
+			return self.srctree.root
+
+	def srcCategories(self):
 		# Figure out what categories to process:
-		src_cat_path = os.path.join(srctree_root, "profiles/categories")
-		dest_cat_path = os.path.join(desttree.root, "profiles/categories")
+		src_index = self.srctree.getIndex(self.ebuildloc)
+		src_cat_path = os.path.join(self.srcRoot(), "profiles/categories")
 		if self.categories is not None:
 			# categories specified in __init__:
 			src_cat_set = set(self.categories)
@@ -2191,107 +2738,146 @@ class InsertEbuilds(MergeStep):
 				with open(src_cat_path, "r") as f:
 					src_cat_set.update(f.read().splitlines())
 			# auto-detect additional categories:
-			cats = os.listdir(srctree_root)
-			for cat in cats:
+			for cat in src_index.categories:
 				# All categories have a "-" in them and are directories:
-				if os.path.isdir(os.path.join(srctree_root,cat)):
-					if "-" in cat or cat == "virtual":
-						src_cat_set.add(cat)
-		if os.path.exists(dest_cat_path):
-			with open(dest_cat_path, "r") as f:
-				dest_cat_set = set(f.read().splitlines())
-		else:
-			dest_cat_set = set()
-		# Our main loop:
-		print( "# Merging in ebuilds from %s" % srctree_root )
-		for cat in src_cat_set:
+				if "-" in cat or cat == "virtual":
+					src_cat_set.add(cat)
+		return src_cat_set
+
+	def plan(self, dest_root, dest_exists):
+		"""
+		Decide which catpkgs to copy into the tree at ``dest_root``, without copying anything. This generates a
+		(catpkg, pkgdir, tcatpkg, tpkgdir, action) tuple for each selected catpkg, where pkgdir is its source directory,
+		tcatpkg is the catpkg it is moved to (or None), and tpkgdir is the destination directory. action is "replace" if
+		tpkgdir should be replaced, "copy" if it should be copied because it doesn't exist yet, or None if it already
+		exists. ``dest_exists`` is called with tpkgdir to find out whether it exists, so callers must apply each decision
+		before asking for the next one. run() uses this to do the actual copying, and merge.planner to plan whole releases.
+		"""
+		srctree_root = self.srcRoot()
+		src_index = self.srctree.getIndex(self.ebuildloc)
+		for cat in self.srcCategories():
 			catdir = os.path.join(srctree_root, cat)
-			if not os.path.isdir(catdir):
+			if not src_index.has_category(cat):
 				# not a valid category in source overlay, so skip it
 				continue
 			#runShell("install -d %s" % catdir)
-			for pkg in os.listdir(catdir):
+			for pkg in src_index.packages(cat):
 				catpkg = "%s/%s" % (cat,pkg)
 				pkgdir = os.path.join(catdir, pkg)
 				if self.cpm_logger and self.cpm_logger.match(catpkg):
-					if catpkg in self.literals:
+					if catpkg in self._literals:
 						print("!!! WARNING: catpkg '%s' specified in package set was already included in kit %s. This should be fixed." % ( catpkg, self.cpm_logger.get_other_kit(catpkg)))
 					#already copied
 					continue
-				if self.select_only != "all" and catpkg not in self.select_only:
+				if self._select_only is not None and not self._select_only.match(catpkg):
 					# we don't want this catpkg
 					continue
-				if not os.path.isdir(pkgdir):
-					# not a valid package dir in source overlay, so skip it
+				if self._select is not None and not self._select.match(catpkg):
+					# we have a list of pkgs or a regex to merge, and this catpkg doesn't match, so skip:
+					continue
+				if self._skip is not None and self._skip.match(catpkg):
+					# we have a list of pkgs or a regex to skip, and this catpkg matches, so skip:
 					continue
-				if isinstance(self.select, list):
-					if catpkg not in self.select:
-						# we have a list of pkgs to merge, and this isn't on the list, so skip:
-						continue
-				elif isinstance(self.select, regextype):
-					if not self.select.match(catpkg):
-						# no regex match:
-						continue
-				if isinstance(self.skip, list):
-					if catpkg in self.skip:
-						# we have a list of pkgs to skip, and this catpkg is on the list, so skip:
-						continue
-				elif isinstance(self.skip, regextype):
-					if self.select.match(catpkg):
-						# regex skip match, continue
-						continue
-				dest_cat_set.add(cat)
 				tpkgdir = None
 				tcatpkg = None
 				if catpkg in self.move_maps:
-					if os.path.exists(pkgdir):
+					if src_index.catpkg_exists(catpkg):
 						# old package exists, so we'll want to rename.
 						tcatpkg = self.move_maps[catpkg]
-						tpkgdir = os.path.join(desttree.root, tcatpkg)
+						tpkgdir = os.path.join(dest_root, tcatpkg)
 					else:
 						tcatpkg = self.move_maps[catpkg]
 						# old package doesn't exist, so we'll want to use the "new" pkgname as the source, hope it's there...
 						pkgdir = os.path.join(srctree_root, tcatpkg)
 						# and use new package name as destination...
-						tpkgdir = os.path.join(desttree.root, tcatpkg)
+						tpkgdir = os.path.join(dest_root, tcatpkg)
+				else:
+					tpkgdir = os.path.join(dest_root, catpkg)
+				if self.replace is True or (self._replace is not None and self._replace.match(catpkg)):
+					action = "replace"
+				elif not dest_exists(tpkgdir):
+					action = "copy"
+				else:
+					action = None
+				yield catpkg, pkgdir, tcatpkg, tpkgdir, action
+
+	def recordCopy(self, kit, catpkg, tcatpkg):
+		# record a copied catpkg in our CatPkgMatchLogger, so later kits don't copy it again:
+		if isinstance(self.select, regextype):
+			# If a regex was used to match the copied catpkg, record the regex.
+			self.cpm_logger.record(kit, catpkg, regex_matched=self.select, is_fixup=self.is_fixup)
+		else:
+			# otherwise, record the literal catpkg matched.
+			self.cpm_logger.record(kit, catpkg, is_fixup=self.is_fixup)
+			if tcatpkg is not None:
+				# This means we did a package move. Record the "new name" of the package, too. So both
+				# old name and new name get marked as being part of this kit.
+				self.cpm_logger.record(kit, tcatpkg, is_fixup=self.is_fixup)
+
+	async def run(self,desttree):
+		if self.branch is not None:
+			# Allow dynamic switching to different branches/commits to grab things we want:
+			await self.srctree.gitCheckout(self.branch)
+		graft = isinstance(desttree, GitTree) and desttree.canGraft(self.srctree)
+		reuse = isinstance(desttree, GitTree) and desttree.canReusePrevious(self.srctree)
+		desttree.logTree(self.srctree)
+		dest_cat_path = os.path.join(desttree.root, "profiles/categories")
+		if os.path.exists(dest_cat_path):
+			with open(dest_cat_path, "r") as f:
+				dest_cat_set = set(f.read().splitlines())
+		else:
+			dest_cat_set = set()
+
+		# tpkgdir -> pkgdir, for catpkgs we copy all at once at the end of this step -- see merge.copy_engine:
+		copies = OrderedDict()
+
+		def dest_exists(tpkgdir):
+			# grafts and copies are done at the end of this step, so a pending one counts as already existing:
+			return os.path.exists(tpkgdir) or tpkgdir in copies or (graft and desttree.graftPending(tpkgdir))
+
+		# Our main loop:
+		print( "# Merging in ebuilds from %s" % self.srcRoot() )
+		for catpkg, pkgdir, tcatpkg, tpkgdir, action in self.plan(desttree.root, dest_exists):
+			dest_cat_set.add(catpkg.split("/")[0])
+			tcatdir = os.path.dirname(tpkgdir)
+			desttree.journal(tpkgdir)
+			if not os.path.exists(tcatdir):
+				os.makedirs(tcatdir)
+			if action == "replace":
+				remove_path(tpkgdir)
+				copies.pop(tpkgdir, None)
+				if reuse and desttree.reusePrevious(self.srctree, pkgdir, tpkgdir, replace=True):
+					pass
+				elif graft:
+					desttree.graftPath(self.srctree, pkgdir, tpkgdir, replace=True)
 				else:
-					tpkgdir = os.path.join(desttree.root, catpkg)
-				tcatdir = os.path.dirname(tpkgdir)
-				copied = False
-				if self.replace is True or (isinstance(self.replace, list) and (catpkg in self.replace)):
-					if not os.path.exists(tcatdir):
-						os.makedirs(tcatdir)
-					await runShell("rm -rf %s; cp -a %s %s" % (tpkgdir, pkgdir, tpkgdir ))
-					copied = True
+					copies[tpkgdir] = pkgdir
+			elif action == "copy":
+				if reuse and desttree.reusePrevious(self.srctree, pkgdir, tpkgdir):
+					# unchanged since the last time we generated this tree -- see GitTree.setAsidePrevious()
+					pass
+				elif graft:
+					desttree.graftPath(self.srctree, pkgdir, tpkgdir)
 				else:
-					if not os.path.exists(tpkgdir):
-						copied = True
-					if not os.path.exists(tcatdir):
-						os.makedirs(tcatdir)
-					if not os.path.exists(tpkgdir):
-						await runShell("cp -a %s %s" % (pkgdir, tpkgdir))
-				if copied:
-					# log XML here.
-					if self.cpm_logger:
-						self.cpm_logger.recordCopyToXML(self.srctree, desttree, catpkg)
-						if isinstance(self.select, regextype):
-							# If a regex was used to match the copied catpkg, record the regex.
-							self.cpm_logger.record(desttree.name, catpkg, regex_matched=self.select, is_fixup=self.is_fixup)
-						else:
-							# otherwise, record the literal catpkg matched.
-							self.cpm_logger.record(desttree.name, catpkg, is_fixup=self.is_fixup)
-							if tcatpkg is not None:
-								# This means we did a package move. Record the "new name" of the package, too. So both
-								# old name and new name get marked as being part of this kit.
-								self.cpm_logger.record(desttree.name, tcatpkg, is_fixup=self.is_fixup)
+					copies[tpkgdir] = pkgdir
+			if action is not None and self.cpm_logger:
+				# log XML here.
+				self.cpm_logger.recordCopyToXML(self.srctree, desttree, catpkg)
+				self.recordCopy(desttree.name, catpkg, tcatpkg)
+		await copy_engine.copy((pkgdir, tpkgdir) for tpkgdir, pkgdir in copies.items())
+		if graft:
+			await desttree.applyGrafts()
 		if os.path.isdir(os.path.dirname(dest_cat_path)):
-			with open(dest_cat_path, "w") as f:
+			desttree.journal(dest_cat_path)
+			with replace_file(dest_cat_path) as f:
 				f.write("\n".join(sorted(dest_cat_set)))
 
 class ProfileDepFix(MergeStep):
 
 	"ProfileDepFix undeprecates profiles marked as deprecated."
 
+	journaled = True
+
 	async def run(self,tree):
 		fpath = os.path.join(tree.root,"profiles/profiles.desc")
 		if os.path.exists(fpath):
@@ -2302,6 +2888,7 @@ class ProfileDepFix(MergeStep):
 				sp = line.split()
 				if len(sp) >= 2:
 					prof_path = sp[1]
+					tree.journal("profiles/%s/deprecated" % prof_path)
 					await runShell("rm -f %s/profiles/%s/deprecated" % ( tree.root, prof_path ))
 
 class RunSed(MergeStep):
@@ -2314,13 +2901,17 @@ class RunSed(MergeStep):
 	commands: List of commands.
 	"""
 
+	journaled = True
+
 	def __init__(self, files, commands):
 		self.files = files
 		self.commands = commands
+		self.reads = self.writes = list(files)
 
 	async def run(self, tree):
 		commands = list(itertools.chain.from_iterable(("-e", command) for command in self.commands))
 		files = [os.path.join(tree.root, file) for file in self.files]
+		tree.journal(*files)
 		await runShell(["sed"] + commands + ["-i"] + files)
 
 class GenCache(MergeStep):
@@ -2330,6 +2921,11 @@ class GenCache(MergeStep):
 		self.release = release
 	"GenCache runs egencache --update to update metadata."
 
+	journaled = True
+	memoize = True
+	reads = [ "@ebuilds", "eclass", "metadata/layout.conf", "profiles/repo_name", "profiles/categories" ]
+	writes = [ "metadata/md5-cache" ]
+
 	async def run(self,tree):
 
 		if tree.name != "core-kit":
@@ -2362,6 +2958,7 @@ class GenCache(MergeStep):
 			if not os.path.exists(self.cache_dir):
 				os.makedirs(self.cache_dir)
 				os.chown(self.cache_dir, pwd.getpwnam('portage').pw_uid, grp.getgrnam('portage').gr_gid)
+		tree.journal("metadata/md5-cache")
 		attempts = 10
 		attempt = 1
 		while attempt <= attempts:
@@ -2379,7 +2976,13 @@ class GenUseLocalDesc(MergeStep):
 
 	"GenUseLocalDesc runs egencache to update use.local.desc"
 
+	journaled = True
+	memoize = True
+	reads = [ "@pkgmetadata", "metadata/layout.conf", "profiles/repo_name", "profiles/categories" ]
+	writes = [ "profiles/use.local.desc" ]
+
 	async def run(self,tree):
+		tree.journal("profiles/use.local.desc")
 		if tree.name != "core-kit":
 			repos_conf = "[DEFAULT]\nmain-repo = core-kit\n\n[core-kit]\nlocation = %s/core-kit\n\n[%s]\nlocation = %s\n" % (tree.config.dest_trees, tree.reponame if tree.reponame else tree.name, tree.root)
 		else:
@@ -2388,28 +2991,61 @@ class GenUseLocalDesc(MergeStep):
 
 class GitCheckout(MergeStep):
 
+	# checking out a branch doesn't add any differences between HEAD and the working tree:
+	journaled = True
+
 	def __init__(self,branch):
 		self.branch = branch
 
 	async def run(self,tree):
 		await runShell("(cd %s && git checkout %s || git checkout -b %s --track origin/%s || git checkout -b %s)" % ( tree.root, self.branch, self.branch, self.branch, self.branch ))
+		if isinstance(tree, GitTree):
+			tree.invalidateRefs()
 
 class CreateBranch(MergeStep):
 
+	journaled = True
+
 	def __init__(self,branch):
 		self.branch = branch
 
 	async def run(self,tree):
 		await runShell("( cd %s && git checkout -b %s --track origin/%s )" % ( tree.root, self.branch, self.branch ))
+		if isinstance(tree, GitTree):
+			tree.invalidateRefs()
 
 
 class Minify(MergeStep):
 
 	"Minify removes ChangeLogs and shrinks Manifests."
 
+	journaled = True
+	reads = [ "@manifests" ]
+	writes = [ "@manifests" ]
+
 	async def run(self,tree):
-		await runShell("( cd %s && find -iname ChangeLog | xargs rm -f )" % tree.root, abort_on_failure=False )
-		await runShell("( cd %s && find -iname Manifest | xargs -i@ sed -ni '/^DIST/p' @ )" % tree.root )
+		# This is done in Python rather than with find, rm and sed, so that we only rewrite (and journal) the Manifests
+		# that actually change:
+		for dirpath, dirnames, filenames in os.walk(tree.root):
+			if dirpath == tree.root and ".git" in dirnames:
+				dirnames.remove(".git")
+			for fn in filenames:
+				if fn.lower() == "changelog":
+					path = os.path.join(dirpath, fn)
+					os.unlink(path)
+					tree.journal(path)
+				elif fn.lower() == "manifest":
+					path = os.path.join(dirpath, fn)
+					with open(path, "rb") as f:
+						lines = f.readlines()
+					dist_lines = [line for line in lines if line.startswith(b"DIST")]
+					if len(dist_lines) == len(lines):
+						continue
+					with open(path + ".minify", "wb") as f:
+						f.writelines(dist_lines)
+					shutil.copymode(path, path + ".minify")
+					os.replace(path + ".minify", path)
+					tree.journal(path)
 
 
 # We want to reset 'kitted_catpkgs' at certain points. The 'kit_order' variable below is used to control this, and we
@@ -2430,7 +3066,7 @@ def getKitPrepSteps(release, repos, kit_dict, gentoo_staging, fixup_repo):
 			GenerateRepoMetadata("core-kit", aliases=["gentoo"], priority=1000),
 			# core-kit has special logic for eclasses -- we want all of them, so that third-party overlays can reference the full set.
 			# All other kits use alternate logic (not in kit_steps) to only grab the eclasses they actually use.
-			SyncDir(gentoo_staging.root, "eclass"),
+			SyncDir(gentoo_staging.root, "eclass", srctree=gentoo_staging),
 		],
 			'post': [
 				# news items are not included here anymore
@@ -2500,48 +3136,97 @@ def getKitPrepSteps(release, repos, kit_dict, gentoo_staging, fixup_repo):
 # a particular kit's kit_source, in the order that they should be processed (in the order they are defined in
 # kit_source_defs, in other words.)
 
-prev_source_defs = None
-prev_repos = None
+class SourceTreeCache:
 
-async def getKitSourceInstances(foundation, config, kit_dict):
+	"""
+	SourceTreeCache is an LRU of initialized source GitTrees, keyed by (repo name, branch, commit SHA1), so that any kit
+	can reuse a source tree that an earlier kit has already prepared instead of re-initializing it.
 
-	# We use a 'cache last repos' scheme to avoid unnecessarily reinitializing repos when they have already been
-	# initialized properly for us. This should help speed up the merge scripts.
+	All GitTrees for a particular repository share the same working directory, so only one of them can be valid at any
+	time. Adding a tree to the cache evicts any other cached trees using the same directory, and lock() should be used to
+	serialize initialization of trees that share a directory.
+	"""
 
-	global prev_source_defs
-	global prev_repos
+	def __init__(self, max_size=16):
+		self.max_size = max_size
+		self._trees = OrderedDict()
+		self._locks = {}
 
-	source_name = kit_dict['source']
+	def lock(self, root):
+		if root not in self._locks:
+			self._locks[root] = asyncio.Lock()
+		return self._locks[root]
 
-	repos = []
+	def get(self, key):
+		tree = self._trees.get(key, None)
+		if tree is None:
+			return None
+		repo_name, branch, sha1 = key
+		# something may have checked out another branch or commit in this tree since we cached it:
+		if (sha1 is not None and tree.head() != sha1) or (sha1 is None and tree.currentLocalBranch != branch):
+			del self._trees[key]
+			return None
+		self._trees.move_to_end(key)
+		return tree
 
-	source_defs = foundation.kit_source_defs[source_name]
+	def put(self, key, tree):
+		for other_key, other_tree in list(self._trees.items()):
+			if other_tree.root == tree.root:
+				del self._trees[other_key]
+		self._trees[key] = tree
+		while len(self._trees) > self.max_size:
+			self._trees.popitem(last=False)
+
+source_tree_cache = SourceTreeCache()
+
+async def getKitSourceInstances(foundation, config, kit_dict, jobs=None, sha1s=None):
 
-	if source_defs == prev_source_defs:
-		return prev_repos
+	# Source trees are initialized concurrently (up to 'jobs' at a time), and initialized trees are kept in
+	# source_tree_cache so later kits using the same repo, branch and SHA1 don't need to reinitialize them. If sha1s is
+	# specified, it maps repo names to the commits to check out, rather than those in the kit's source definitions.
 
-	for source_def in source_defs:
+	source_name = kit_dict['source']
+	source_defs = foundation.kit_source_defs[source_name]
+	if jobs is None:
+		jobs = config.source_jobs
+	semaphore = asyncio.Semaphore(jobs)
+	errors = []
 
+	async def get_source_instance(source_def):
 		repo_name = source_def['repo']
 		repo_branch = source_def['branch'] if "branch" in source_def else "master"
 		repo_sha1 = source_def["src_sha1"] if "src_sha1" in source_def else None
-		repo_obj = GitTree
+		if sha1s is not None and repo_name in sha1s:
+			repo_sha1 = sha1s[repo_name]
 		repo_url = foundation.overlays[repo_name]["url"]
 		if "dirname" in foundation.overlays[repo_name]:
 			path = foundation.overlays[repo_name]["dirname"]
 		else:
 			path = repo_name
-		repo = repo_obj(repo_name, url=repo_url, config=config, root="%s/%s" % (config.source_trees, path),
-						branch=repo_branch, commit_sha1=repo_sha1, origin_check=False,
-						reclone=foundation.overlays[repo_name]["reclone"] if "reclone" in foundation.overlays[
-							repo_name] else False)
-		await repo.initialize()
-		repos.append(
-			{"name": repo_name, "repo": repo, "is_fixup": source_def['is_fixup'] if 'is_fixup' in source_def else False,
-			 "overlay_def": foundation.overlays[repo_name]})
-
-	prev_source_defs = source_defs
-	prev_repos = repos
+		root = "%s/%s" % (config.source_trees, path)
+		key = (repo_name, repo_branch, repo_sha1)
+		async with source_tree_cache.lock(root):
+			repo = source_tree_cache.get(key)
+			if repo is None:
+				repo = GitTree(repo_name, url=repo_url, config=config, root=root,
+								branch=repo_branch, commit_sha1=repo_sha1, origin_check=False,
+								reclone=foundation.overlays[repo_name]["reclone"] if "reclone" in foundation.overlays[
+									repo_name] else False)
+				async with semaphore:
+					try:
+						await repo.initialize()
+					except (Exception, SystemExit) as e:
+						errors.append((repo_name, e))
+						return None
+				source_tree_cache.put(key, repo)
+		return {"name": repo_name, "repo": repo, "is_fixup": source_def['is_fixup'] if 'is_fixup' in source_def else False,
+				"overlay_def": foundation.overlays[repo_name]}
+
+	repos = await asyncio.gather(*[get_source_instance(source_def) for source_def in source_defs])
+	if len(errors):
+		for repo_name, e in errors:
+			print("!!! Error: could not initialize source repository %s: %s" % (repo_name, repr(e)))
+		raise GitTreeError("Unable to initialize source repositories: %s" % ", ".join(x[0] for x in errors))
 	return repos
 
 async def copyFromSourceRepositoriesSteps(repo_dict=None, release=None, source_defs=None, kit_dict=None, secondary_kit=False, fixup_repo=None, cpm_logger=None, move_maps=None):
@@ -2625,7 +3310,7 @@ def copyFromFixupsSteps(release=None, fixup_repo=None, branch=None, kit_dict=Non
 	# Here is the core logic that copies all the fix-ups from kit-fixups (eclasses and ebuilds) into place:
 	eclass_release_path = "eclass/%s" % release
 	if os.path.exists(os.path.join(fixup_repo.root, eclass_release_path)):
-		steps += [SyncDir(fixup_repo.root, eclass_release_path, "eclass")]
+		steps += [SyncDir(fixup_repo.root, eclass_release_path, "eclass", srctree=fixup_repo)]
 	if branch == "master":
 		# if a branch has "master" as its branch, we will look for a fixup directory of its *release* (like "1.2-release") just so it's clear
 		# for maintainers ("master" would be ambiguous in kit-fixups.)
@@ -2674,20 +3359,21 @@ def copyFromFixupsSteps(release=None, fixup_repo=None, branch=None, kit_dict=Non
 # regenerating it. The kitted_catpkgs argument is a dictionary which is also written to and used to keep track of
 # catpkgs copied between runs of updateKit.
 
-async def updateKit(foundation, config, release, async_engine: AsyncMergeAllKits, kit_dict, prev_kit_dict,
-					cpm_logger, create=False, push=False, now=None, fixup_repo=None, branch=None, force=False, indypush=False, destfix=False):
+# Kit trees that have been set up for worktree mode in this run, indexed by kit name. The first branch of each kit we
+# process is generated in the kit's main working tree, and further branches get linked worktrees of it:
+worktree_kits = {}
 
-	# secondary_kit means: we're the second (or third, etc.) xorg-kit or other kit to be processed. The first kind of
-	# each kit processed has secondary_kit = False, and later ones have secondary_kit = True. We need special processing
-	# to grab any 'orphan' packages that were selected as part of prior kit scans (and thus will not be included in
-	# later kits) but were not picked up in our current kit-scan. For example, let's say @depsincat@:virtual/ttf-fonts:
-	# media-fonts picks up a funky font in the first xorg-kit scan, but in the second xorg-kit scan, the deps have
-	# changed and thus this font isn't selected. Well without special handling, if we are using the second (or later)
-	# xorg-kit, funky-font won't exist. We call these guys 'orphans' and need to ensure we include them.
+def get_match_logger_path(config, release):
+	# where merge-all-kits saves the CatPkgMatchLogger of each release, so single kits can be regenerated later:
+	return os.path.join(config.cache_dir, "match-logger", "%s.json.gz" % release)
 
-	move_maps = get_move_maps(fixup_repo.root + "/move-maps", kit_dict['name'])
 
-	secondary_kit = False
+def startKit(cpm_logger, kit_dict, prev_kit_dict):
+	"""
+	Tell cpm_logger that we are about to generate kit_dict, right after prev_kit_dict (or first, if prev_kit_dict is None.)
+	Returns True if kit_dict is a secondary kit -- another branch of the same kit as prev_kit_dict -- see updateKit().
+	"""
+	cpm_logger.startKitBranch("%s/%s" % (kit_dict['name'], kit_dict['branch']))
 	if prev_kit_dict is not None:
 		if kit_dict['name'] != prev_kit_dict['name']:
 
@@ -2697,7 +3383,57 @@ async def updateKit(foundation, config, release, async_engine: AsyncMergeAllKits
 			cpm_logger.nextKit()
 
 		else:
-			secondary_kit = True
+			return True
+	return False
+
+
+async def getPlannedSourceInstances(foundation, config, plan):
+	"""
+	Return the source repos of the kit of ``plan`` (see merge.planner), checked out at exactly the commits it was planned
+	from -- branch-tracked source repos may have been fetched and moved on since. generate_release() only lets kits that
+	agree on these commits run at the same time. Raises PlanError if the repos can't be checked out at them.
+	"""
+	from merge.planner import PlanError
+	repos = await getKitSourceInstances(foundation, config, plan.kit_dict, sha1s=dict((name, sha1) for name, root, sha1 in plan.sources))
+	heads = [ (repo_dict["name"], repo_dict["repo"].root, repo_dict["repo"].head()) for repo_dict in repos ]
+	if heads != plan.sources:
+		raise PlanError("%s was planned from %s, but its sources are at %s" % (plan.key, plan.sources, heads))
+	return repos
+
+
+async def updateKit(foundation, config, release, async_engine: AsyncMergeAllKits, kit_dict, prev_kit_dict,
+					cpm_logger, create=False, push=False, now=None, fixup_repo=None, branch=None, force=False, indypush=False, destfix=False,
+					worktree=False, pending=None, graft=False, push_scheduler=None, memo=None, incremental=False, plan=None):
+
+	# When worktree is True, each branch of a kit (other than core-kit, which other kits use as their master repo) is
+	# generated in its own working tree -- see GitTree.worktree(). When pending is a dictionary, only the parts of the
+	# kit update that depend on cpm_logger and the source repos are run before we return None. The rest (finalizing the
+	# kit, generating metadata and committing) is started as a task that returns the new HEAD SHA1, and is stored in
+	# pending[(kit name, branch)]. The caller must wait for these tasks to finish before it checks out another branch of
+	# core-kit or the source repos. When graft is True, files copied from source repos are grafted into the kit -- see
+	# GitTree.graftPath(). If push_scheduler is specified, pushes are handed off to it -- see GitTree.gitCommit(). If memo
+	# is a StepMemo, it is used to skip metadata generation steps whose inputs haven't changed -- see GitTree.run(). When
+	# incremental is True, catpkgs that are unchanged since the last generation of the kit are reused rather than copied
+	# again, and the metadata cache is updated rather than rebuilt -- see GitTree.setAsidePrevious(). When plan is a
+	# KitPlan, the kit is generated from it rather than from the kits generated before it -- see merge.planner.
+
+	# secondary_kit means: we're the second (or third, etc.) xorg-kit or other kit to be processed. The first kind of
+	# each kit processed has secondary_kit = False, and later ones have secondary_kit = True. We need special processing
+	# to grab any 'orphan' packages that were selected as part of prior kit scans (and thus will not be included in
+	# later kits) but were not picked up in our current kit-scan. For example, let's say @depsincat@:virtual/ttf-fonts:
+	# media-fonts picks up a funky font in the first xorg-kit scan, but in the second xorg-kit scan, the deps have
+	# changed and thus this font isn't selected. Well without special handling, if we are using the second (or later)
+	# xorg-kit, funky-font won't exist. We call these guys 'orphans' and need to ensure we include them.
+
+	move_maps = get_move_maps(fixup_repo.root + "/move-maps", kit_dict['name'])
+
+	if plan is not None:
+		# we are generating this kit from a release plan (see merge.planner), which holds the state cpm_logger would be in
+		# at this point if all the kits before this one had just been generated:
+		cpm_logger.restore(plan.logger_state)
+		secondary_kit = plan.secondary_kit
+	else:
+		secondary_kit = startKit(cpm_logger, kit_dict, prev_kit_dict)
 
 	if branch is None:
 		branch = kit_dict['branch']
@@ -2719,12 +3455,47 @@ async def updateKit(foundation, config, release, async_engine: AsyncMergeAllKits
 		if indypush:
 			# If --indypush is specified, we want to mirror the independent kit to the same destination as the kits we
 			# are auto-generating. This does it:
-			await tree.mirrorUpstreamRepository(mirror=config.base_url(kit_dict['name']))
+			if push_scheduler is not None:
+				push_scheduler.schedule(tree.root, lambda: tree.mirrorUpstreamRepository(mirror=config.base_url(kit_dict['name']), abort_on_failure=False))
+			else:
+				await tree.mirrorUpstreamRepository(mirror=config.base_url(kit_dict['name']))
 		return tree.head()
 
-	if "repo_obj" not in kit_dict:
-		kit_dict["repo_obj"] = await getKitSourceInstances(foundation, config, kit_dict)
-	repos = kit_dict["repo_obj"]
+	if worktree and kit_dict['name'] == "core-kit":
+		worktree = False
+		pending = None
+
+	# If we have gotten here, we are automatically generating a kit...
+	if worktree and kit_dict['name'] in worktree_kits:
+		tree = await worktree_kits[kit_dict['name']].worktree(branch)
+	else:
+		tree = GitTree(kit_dict['name'], branch, config=config,
+						 url=config.base_url(kit_dict['name']), create=create,
+						 root="%s/%s" % (config.dest_trees, kit_dict['name']),
+						 mirror=config.mirror.rstrip("/") + "/" + kit_dict[
+							 "name"] if config.mirror else None,
+						 origin_check=True,
+						 destfix=destfix,
+						 graft=graft,
+						 memo=memo,
+						 incremental=incremental)
+		if worktree:
+			await tree.removeWorktrees()
+			worktree_kits[kit_dict['name']] = tree
+		await tree.initialize()
+	kit_dict['tree'] = tree
+	if "stability" in kit_dict and kit_dict["stability"] == KitStabilityRating.DEPRECATED:
+		# no longer update this kit.
+		return tree.head()
+
+	# deprecated kits don't need their source repos, so only check them out now. Under --jobs, other kits may be using
+	# different commits of them:
+	if plan is not None:
+		repos = await getPlannedSourceInstances(foundation, config, plan)
+	else:
+		if "repo_obj" not in kit_dict:
+			kit_dict["repo_obj"] = await getKitSourceInstances(foundation, config, kit_dict)
+		repos = kit_dict["repo_obj"]
 
 	# get a handy variable reference to gentoo_staging:
 	gentoo_staging = None
@@ -2738,19 +3509,6 @@ async def updateKit(foundation, config, release, async_engine: AsyncMergeAllKits
 	elif gentoo_staging.name != "gentoo-staging":
 		print("Gentoo staging mismatch -- name is %s" % gentoo_staging["name"])
 
-	# If we have gotten here, we are automatically generating a kit...
-	kit_dict['tree'] = tree = GitTree(kit_dict['name'], branch, config=config,
-										 url=config.base_url(kit_dict['name']), create=create,
-										 root="%s/%s" % (config.dest_trees, kit_dict['name']),
-										 mirror=config.mirror.rstrip("/") + "/" + kit_dict[
-											 "name"] if config.mirror else None,
-										 origin_check=True,
-										 destfix=destfix)
-	await tree.initialize()
-	if "stability" in kit_dict and kit_dict["stability"] == KitStabilityRating.DEPRECATED:
-		# no longer update this kit.
-		return tree.head()
-
 	# Phase 1: prep the kit
 	pre_steps = [
 		GitCheckout(branch),
@@ -2780,7 +3538,7 @@ async def updateKit(foundation, config, release, async_engine: AsyncMergeAllKits
 	# This is an improved faster sync of all licenses. We will remove missing ones later:
 
 	pre_steps += [
-		SyncDir(gentoo_staging.root, "licenses")
+		SyncDir(gentoo_staging.root, "licenses", srctree=gentoo_staging)
 	]
 
 	await tree.run(pre_steps)
@@ -2792,11 +3550,26 @@ async def updateKit(foundation, config, release, async_engine: AsyncMergeAllKits
 	steps = copyFromFixupsSteps(release=release, fixup_repo=fixup_repo, branch=branch, kit_dict=kit_dict, cpm_logger=cpm_logger)
 
 	steps += [
-		RunRepositoryStepsIfAvailable(fixup_root=fixup_repo.root, cpm_logger=cpm_logger)
+		RunRepositoryStepsIfAvailable(fixup_root=fixup_repo.root, cpm_logger=cpm_logger),
+		# this is the last step that looks at a source repo:
+		CreateCategories(gentoo_staging)
 	]
 
 	await tree.run(steps)
 
+	if pending is not None:
+		pending[(kit_dict['name'], branch)] = asyncio.ensure_future(finalizeKit(foundation, release, async_engine, kit_dict, tree,
+																					post_steps, push=push, now=now, push_scheduler=push_scheduler))
+		return None
+	return await finalizeKit(foundation, release, async_engine, kit_dict, tree, post_steps, push=push, now=now, push_scheduler=push_scheduler)
+
+
+async def finalizeKit(foundation, release, async_engine: AsyncMergeAllKits, kit_dict, tree, post_steps, push=False, now=None,
+					  push_scheduler=None):
+
+	# This is the second half of updateKit(). It only touches the kit's own tree (and core-kit), so it can run
+	# concurrently with the generation of other kits in their own trees.
+
 	# copy all available licenses that have not been copied in fixups from gentoo-staging over to the kit.
 	# We will remove any unused licenses below...
 
@@ -2813,10 +3586,10 @@ async def updateKit(foundation, config, release, async_engine: AsyncMergeAllKits
 			to_remove.append(tree.root + "/licenses/" + license)
 	for file in to_remove:
 		os.unlink(file)
+	tree.journal(*to_remove)
 
 	post_steps += [
 		ELTSymlinkWorkaround(),
-		CreateCategories(gentoo_staging),
 		# multi-plex this and store in different locations so that different selections can be made based on which python-kit is enabled.
 		# python-kit itself only needs one set which will be enabled by default.
 	]
@@ -2830,15 +3603,16 @@ async def updateKit(foundation, config, release, async_engine: AsyncMergeAllKits
 	post_steps += [
 		Minify(),
 		GenUseLocalDesc(),
-		GenCache(cache_dir="/var/cache/edb/%s-%s-%s" % (release, kit_dict['name'], branch), release=release),
+		GenCache(cache_dir="/var/cache/edb/%s-%s-%s" % (release, kit_dict['name'], tree.branch), release=release),
 	]
 
 	post_steps += [
 		FastPullScan(now=now, engine=async_engine)
 	]
 
-	await tree.run(post_steps)
-	await tree.gitCommit(message="updates", push=push)
+	with tracer.span("finalize", "finalize", branch=tree.branch):
+		await tree.run(post_steps)
+		await tree.gitCommit(message="updates", push=push, push_scheduler=push_scheduler)
 	return tree.head()
 
 # vim: ts=4 sw=4 noet
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+"""
+Release planning.
+
+The kits of a release are normally generated strictly in order, because each kit's CatPkgMatchLogger decisions depend on
+what the kits before it claimed. plan_release() works out these decisions for a whole release up front: it runs the
+same package-set, move-map, filter and fixup logic as updateKit(), using InsertEbuilds.plan() against the source trees'
+indexes, but doesn't copy anything. The result is a list of KitPlans, one per kit branch, which record the catpkgs each
+kit will get and the state of the CatPkgMatchLogger right before the kit is generated.
+
+Since a KitPlan holds everything about the kits before it that matters to a kit, generate_release() can then generate
+kits concurrently from their plans. Two things still constrain the order: kits that need different commits of the same
+source repository can't run at the same time (source repositories have a single working tree), and kits use core-kit as
+their master repository, so each core-kit branch is generated on its own, between the kits that came before and after
+it in the release.
+
+A generate.py in kit-fixups (see RunRepositoryStepsIfAvailable) can claim catpkgs that the planner can't know about
+without running it. After a kit has been generated, the catpkgs it actually claimed are compared with its plan, and if
+they differ in a way that could change the decisions of a later kit, generate_release() raises PlanError.
+"""
+
+import asyncio
+import json
+import os
+from collections import OrderedDict
+
+from merge.merge_utils import CatPkgMatchLogger, GitTree, InsertEbuilds, KitStabilityRating, KitType, RecordAllCatPkgs, \
+	copyFromFixupsSteps, copyFromSourceRepositoriesSteps, getKitSourceInstances, get_move_maps, startKit
+
+
+class PlanError(Exception):
+	pass
+
+
+class KitPlan:
+
+	def __init__(self, kit_dict, release):
+		self.kit_dict = kit_dict
+		self.name = kit_dict["name"]
+		self.branch = kit_dict["branch"]
+		self.release = release
+		# "auto" (generated from sources), "indy" (independently maintained) or "deprecated" (no longer updated):
+		self.kind = "auto"
+		self.secondary_kit = False
+		# CatPkgMatchLogger.snapshot() from right before the kit is generated:
+		self.logger_state = None
+		# the source repositories the kit is generated from, as (repo name, root, commit SHA1) tuples:
+		self.sources = []
+		# catpkg in the kit -> (name of the repo it comes from, catpkg in that repo), in the order they are copied:
+		self.copies = OrderedDict()
+		# catpkgs the kit claims in the CatPkgMatchLogger, so that later kits don't copy them:
+		self.claims = set()
+		# True if kit-fixups has a generate.py for the kit, which may claim catpkgs we don't know about:
+		self.has_generate_py = False
+
+	@property
+	def key(self):
+		return "%s/%s" % (self.name, self.branch)
+
+	def __repr__(self):
+		return "<KitPlan: %s>" % self.key
+
+
+def new_claims(logger_state, logger):
+	# the catpkgs that have been claimed for the current kit since logger_state was taken:
+	before = logger_state["matchdict_curkit"]
+	return set(catpkg for catpkg in logger.snapshot()["matchdict_curkit"] if catpkg not in before)
+
+
+def has_generate_py(fixup_root, kit_name, branch):
+	root = os.path.join(fixup_root, kit_name)
+	return any(os.path.exists(os.path.join(root, subdir, "generate.py")) for subdir in [ branch, "curated", "global" ])
+
+
+def plan_steps(plan, steps, dest):
+	# Apply the InsertEbuilds steps in ``steps`` to the set of catpkgs ``dest``, as InsertEbuilds.run() would. Other steps
+	# don't copy catpkgs or record anything in the CatPkgMatchLogger, so we can ignore them:
+	for step in steps:
+		if not isinstance(step, InsertEbuilds):
+			continue
+		for catpkg, pkgdir, tcatpkg, tpkgdir, action in step.plan("", lambda tpkgdir: tpkgdir in dest):
+			if action is None:
+				continue
+			dest.add(tpkgdir)
+			plan.copies[tpkgdir] = (step.srctree.name, os.path.relpath(pkgdir, step.srcRoot()))
+			if step.cpm_logger:
+				step.recordCopy(plan.name, catpkg, tcatpkg)
+
+
+async def plan_kit(plan, release, repos, fixup_repo, cpm_logger, move_maps=None):
+	"""
+	Fill in ``plan`` by deciding what updateKit() would copy into its kit from ``repos`` and ``fixup_repo``, recording
+	the kit's claims in ``cpm_logger`` as we go.
+	"""
+	kit_dict = plan.kit_dict
+	if move_maps is None:
+		move_maps = get_move_maps(fixup_repo.root + "/move-maps", plan.name)
+	plan.logger_state = cpm_logger.snapshot()
+	plan.sources = [ (repo_dict["name"], repo_dict["repo"].root, repo_dict["repo"].head()) for repo_dict in repos ]
+	plan.has_generate_py = has_generate_py(fixup_repo.root, plan.name, plan.branch)
+	dest = set()
+	for repo_dict in repos:
+		steps = await copyFromSourceRepositoriesSteps(repo_dict=repo_dict, kit_dict=kit_dict, source_defs=repos, release=release,
+													   secondary_kit=plan.secondary_kit, fixup_repo=fixup_repo, cpm_logger=cpm_logger,
+													   move_maps=move_maps)
+		plan_steps(plan, steps, dest)
+	plan_steps(plan, copyFromFixupsSteps(release=release, fixup_repo=fixup_repo, branch=plan.branch, kit_dict=kit_dict, cpm_logger=cpm_logger), dest)
+	plan.claims = new_claims(plan.logger_state, cpm_logger)
+	return plan
+
+
+async def plan_release(foundation, config, release, fixup_repo, cpm_logger=None):
+	"""
+	Return a list of KitPlans for the kits of ``release``, in the order they are listed in the foundation. Source trees
+	are checked out as needed, but nothing is copied, and no kit is touched.
+	"""
+	if cpm_logger is None:
+		cpm_logger = CatPkgMatchLogger()
+	plans = []
+	prev_kit_dict = None
+	for kit_dict in foundation.kit_groups[release]:
+		plan = KitPlan(kit_dict, release)
+		plan.secondary_kit = startKit(cpm_logger, kit_dict, prev_kit_dict)
+		prev_kit_dict = kit_dict
+		plans.append(plan)
+		if "type" in kit_dict and kit_dict["type"] == KitType.INDEPENDENTLY_MAINTAINED:
+			# independently-maintained kits aren't generated, but all their catpkgs are claimed:
+			plan.kind = "indy"
+			plan.logger_state = cpm_logger.snapshot()
+			tree = GitTree(kit_dict["name"], kit_dict["branch"], config=config, url=config.indy_url(kit_dict["name"]),
+						   root=config.source_trees + "/" + kit_dict["name"], origin_check=False)
+			await tree.initialize()
+			plan.sources = [ (kit_dict["name"], tree.root, tree.head()) ]
+			await RecordAllCatPkgs(tree, cpm_logger).run()
+			plan.claims = new_claims(plan.logger_state, cpm_logger)
+			continue
+		if "stability" in kit_dict and kit_dict["stability"] == KitStabilityRating.DEPRECATED:
+			plan.kind = "deprecated"
+			plan.logger_state = cpm_logger.snapshot()
+			continue
+		print("Planning kit %s branch %s..." % (plan.name, plan.branch))
+		repos = await getKitSourceInstances(foundation, config, kit_dict)
+		await plan_kit(plan, release, repos, fixup_repo, cpm_logger)
+	return plans
+
+
+def plan_assignment(plans):
+	"""
+	Return the catpkg-to-kit assignment of ``plans`` as a JSON-serializable dictionary, which lists, for each kit branch,
+	the source commits it is planned from and where each of its catpkgs comes from, and for each catpkg, the kit
+	branches it is in.
+	"""
+	kits = []
+	catpkgs = {}
+	for plan in plans:
+		if plan.kind == "indy":
+			# independently-maintained kits aren't copied from anywhere, but all their catpkgs are claimed:
+			copies = OrderedDict((catpkg, "%s:%s" % (plan.name, catpkg)) for catpkg in sorted(plan.claims))
+		else:
+			copies = OrderedDict((catpkg, "%s:%s" % src) for catpkg, src in plan.copies.items())
+		kits.append(OrderedDict([
+			("kit", plan.name),
+			("branch", plan.branch),
+			("kind", plan.kind),
+			("sources", OrderedDict((repo_name, sha1) for repo_name, root, sha1 in plan.sources)),
+			("catpkgs", copies)
+		]))
+		for catpkg, src in copies.items():
+			if catpkg not in catpkgs:
+				catpkgs[catpkg] = []
+			catpkgs[catpkg].append("%s (%s)" % (plan.key, src))
+	return OrderedDict([ ("kits", kits), ("catpkgs", OrderedDict(sorted(catpkgs.items()))) ])
+
+
+def diff_assignments(old, new):
+	"""
+	Compare two assignments returned by plan_assignment(), and return a list of lines describing the catpkgs that were
+	added ("+"), removed ("-") or assigned differently ("~").
+	"""
+	lines = []
+	old_catpkgs = old["catpkgs"]
+	new_catpkgs = new["catpkgs"]
+	for catpkg in sorted(set(old_catpkgs.keys()) | set(new_catpkgs.keys())):
+		if catpkg not in old_catpkgs:
+			lines.append("+ %s: %s" % (catpkg, ", ".join(new_catpkgs[catpkg])))
+		elif catpkg not in new_catpkgs:
+			lines.append("- %s: %s" % (catpkg, ", ".join(old_catpkgs[catpkg])))
+		elif old_catpkgs[catpkg] != new_catpkgs[catpkg]:
+			lines.append("~ %s: %s -> %s" % (catpkg, ", ".join(old_catpkgs[catpkg]), ", ".join(new_catpkgs[catpkg])))
+	return lines
+
+
+def write_assignment(path, assignment):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path + ".tmp", "w") as f:
+		json.dump(assignment, f, indent=1)
+		f.write("\n")
+	os.rename(path + ".tmp", path)
+
+
+def read_assignment(path):
+	if not os.path.exists(path):
+		return None
+	with open(path, "r") as f:
+		return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def check_claims(plans, pos, claims):
+	"""
+	Compare the catpkgs that the kit of ``plans[pos]`` actually claimed when it was generated with the ones it was
+	planned to claim, and raise PlanError if the difference could change what a later kit gets.
+	"""
+	plan = plans[pos]
+	missing = plan.claims - claims
+	if len(missing):
+		raise PlanError("%s did not claim planned catpkgs: %s" % (plan.key, " ".join(sorted(missing))))
+	extra = claims - plan.claims
+	for later in plans[pos + 1:]:
+		if later.name == plan.name:
+			# other branches of the same kit can copy the same catpkgs:
+			continue
+		stolen = (extra & set(later.copies.keys())) | (extra & set(src_catpkg for repo_name, src_catpkg in later.copies.values()))
+		if len(stolen):
+			raise PlanError("%s claimed catpkgs that were planned for %s: %s" % (plan.key, later.key, " ".join(sorted(stolen))))
+
+
+async def generate_release(plans, generate, jobs=4):
+	"""
+	Generate the kits in ``plans`` concurrently, up to ``jobs`` at a time. ``generate`` is a coroutine function that is
+	called with a KitPlan, generates that kit and returns a tuple of the kit's new HEAD SHA1 and the set of catpkgs it
+	claimed. Returns a dictionary mapping each plan's key to the HEAD SHA1.
+	"""
+	heads = {}
+	errors = []
+	condition = asyncio.Condition()
+	# source repository root -> [ SHA1 that is checked out, number of running kits using it ]:
+	sources_in_use = {}
+	kits_running = set()
+
+	def can_start(plan):
+		if len(kits_running) >= jobs or plan.name in kits_running:
+			# the branches of a kit share its working tree:
+			return False
+		for repo_name, root, sha1 in plan.sources:
+			if root in sources_in_use and sources_in_use[root][0] != sha1:
+				return False
+		return True
+
+	async def run_plan(pos, plan):
+		async with condition:
+			await condition.wait_for(lambda: can_start(plan))
+			kits_running.add(plan.name)
+			for repo_name, root, sha1 in plan.sources:
+				if root in sources_in_use:
+					sources_in_use[root][1] += 1
+				else:
+					sources_in_use[root] = [ sha1, 1 ]
+		try:
+			heads[plan.key], claims = await generate(plan)
+			if plan.kind == "auto":
+				check_claims(plans, pos, claims)
+		except PlanError as e:
+			errors.append(str(e))
+		finally:
+			async with condition:
+				kits_running.discard(plan.name)
+				for repo_name, root, sha1 in plan.sources:
+					sources_in_use[root][1] -= 1
+					if sources_in_use[root][1] == 0:
+						del sources_in_use[root]
+				condition.notify_all()
+
+	# each core-kit branch is generated on its own, since the kits around it use it as their master repository:
+	segment = []
+	for pos, plan in enumerate(plans + [ None ]):
+		if plan is None or plan.name == "core-kit":
+			if len(segment):
+				await asyncio.gather(*[ run_plan(seg_pos, seg_plan) for seg_pos, seg_plan in segment ])
+				segment = []
+			if plan is not None:
+				await run_plan(pos, plan)
+		else:
+			segment.append((pos, plan))
+	if len(errors):
+		raise PlanError("; ".join(errors))
+	return heads
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+"""
+A pool of portdbapi instances, shared by everything that queries a tree through portage.
+
+Building a portage.config and portdbapi for a tree is expensive, and a kit's tree is queried many times (FastPullScan,
+and merge.md5cache for every metadata cache entry that is stale or missing, ...). portdb_pool.get() returns a frozen
+portdbapi for a tree, keyed by the tree's location, the core-kit location, the depcachedir and ACCEPT_KEYWORDS, so that
+its settings, xmatch cache and aux_get caches are reused by all of them.
+
+Trees tell us when they change by calling tree_changed() (Tree.invalidateIndex() does this after every MergeStep, with
+what the step writes, and after checkouts and commits.) A frozen portdbapi caches xmatch() results, which go stale
+whenever the tree changes, so a pooled portdbapi is melted and frozen again, clearing its caches, when its tree or
+core-kit has changed since it was last handed out. That isn't enough when ebuilds, eclasses or profiles change (as
+they do when another branch is checked out at the same location): portage reads the list of eclasses, the categories
+and the profile's masks once, when the portdbapi is built, and would fail to find new eclasses. So when
+metadata_generation() or profile_generation() of the tree or core-kit has moved, the portdbapi is built again. Caches
+of ebuild metadata (see merge.md5cache) only need to be dropped when metadata_generation() changes.
+"""
+
+import os
+from collections import OrderedDict
+
+import portage
+
+# tree root -> number of times it has changed:
+_generations = {}
+# tree root -> number of times it has changed in a way that can change the metadata of its ebuilds:
+_metadata_generations = {}
+# tree root -> number of times its profiles (or layout.conf) may have changed:
+_profile_generations = {}
+
+
+def affects_metadata(writes):
+	"""
+	Return True if a change to ``writes``, the resources written by a MergeStep (see merge.step_graph), can change
+	the metadata of the ebuilds in a tree. Changes to licenses, profiles, Manifests, metadata.xml files and the
+	metadata cache don't, and neither do changes to anything in eclass/ other than eclasses (like ELT-patches).
+	"""
+	if writes is None:
+		return True
+	for path in writes:
+		if path in [ "", "@ebuilds" ]:
+			return True
+		if path.startswith("@"):
+			continue
+		top = path.split("/")[0]
+		if top in [ "licenses", "profiles" ]:
+			continue
+		if top == "metadata" and path != "metadata" and path != "metadata/layout.conf":
+			continue
+		if top == "eclass" and path != "eclass" and not path.endswith(".eclass"):
+			continue
+		return True
+	return False
+
+
+def affects_profiles(writes):
+	"""Return True if a change to ``writes`` can change a tree's profiles (like profiles/categories) or layout.conf."""
+	if writes is None:
+		return True
+	for path in writes:
+		if path in [ "", "profiles", "metadata", "metadata/layout.conf" ] or path.startswith("profiles/"):
+			return True
+	return False
+
+
+def tree_changed(root, writes=None):
+	root = os.path.normpath(root)
+	_generations[root] = _generations.get(root, 0) + 1
+	if affects_metadata(writes):
+		_metadata_generations[root] = _metadata_generations.get(root, 0) + 1
+	if affects_profiles(writes):
+		_profile_generations[root] = _profile_generations.get(root, 0) + 1
+
+
+def generation(root):
+	return _generations.get(os.path.normpath(root), 0)
+
+
+def metadata_generation(root):
+	return _metadata_generations.get(os.path.normpath(root), 0)
+
+
+def profile_generation(root):
+	return _profile_generations.get(os.path.normpath(root), 0)
+
+
+def _repo_name(tree):
+	# like merge_utils.repoName():
+	try:
+		with open(os.path.join(tree.root, 'profiles/repo_name')) as f:
+			return f.readline().strip()
+	except FileNotFoundError:
+		return tree.name
+
+
+def portage_env(tree, depcachedir=None, accept_keywords=None):
+	"""
+	Return an environment for running portage (or the ebuild command) on ``tree``, with core-kit as the master
+	repository. For core-kit itself, core-kit is the only repository.
+	"""
+	env = os.environ.copy()
+	name = _repo_name(tree)
+	if depcachedir is not None:
+		env['PORTAGE_DEPCACHEDIR'] = depcachedir
+	if accept_keywords is not None:
+		env['ACCEPT_KEYWORDS'] = accept_keywords
+	if name != "core-kit":
+		env['PORTAGE_REPOSITORIES'] = '''
+[DEFAULT]
+main-repo = core-kit
+
+[core-kit]
+location = %s/core-kit
+aliases = gentoo
+
+[%s]
+location = %s
+''' % (tree.config.dest_trees, name, tree.root)
+	else:
+		env['PORTAGE_REPOSITORIES'] = '''
+[DEFAULT]
+main-repo = core-kit
+
+[core-kit]
+location = %s
+aliases = gentoo
+''' % tree.root
+	return env
+
+
+def _new_portdb(env):
+	return portage.portdbapi(mysettings=portage.config(env=env, config_profile_path=''))
+
+
+class PortDBPool:
+
+	def __init__(self, size=16, factory=_new_portdb):
+		self.size = size
+		self.factory = factory
+		# key -> [ portdbapi, generations of the tree and core-kit when it was built, and when it was last handed out ]
+		self._pool = OrderedDict()
+		self.built = 0
+		self.reused = 0
+		self.refreshed = 0
+		self.rebuilt = 0
+
+	def get(self, tree, depcachedir=None, accept_keywords=None):
+		core_kit = os.path.join(tree.config.dest_trees, "core-kit")
+		key = (os.path.normpath(tree.root), core_kit, depcachedir, accept_keywords)
+		built_generations = tuple(f(root) for root in (tree.root, core_kit) for f in (metadata_generation, profile_generation))
+		generations = (generation(tree.root), generation(core_kit))
+		if key in self._pool:
+			self._pool.move_to_end(key)
+			entry = self._pool[key]
+			if entry[1] == built_generations:
+				if entry[2] != generations:
+					# the tree has changed since we froze this one -- drop its xmatch cache:
+					entry[0].melt()
+					entry[0].freeze()
+					entry[2] = generations
+					self.refreshed += 1
+				else:
+					self.reused += 1
+				return entry[0]
+			# ebuilds, eclasses or profiles have changed, which a portdbapi doesn't notice:
+			del self._pool[key]
+			self.rebuilt += 1
+		p = self.factory(portage_env(tree, depcachedir=depcachedir, accept_keywords=accept_keywords))
+		p.freeze()
+		self.built += 1
+		self._pool[key] = [ p, built_generations, generations ]
+		while len(self._pool) > self.size:
+			self._pool.popitem(last=False)
+		return p
+
+	def clear(self):
+		self._pool.clear()
+
+	def summary(self):
+		return "portdbapi pool: %s built (%s rebuilt after ebuild, eclass or profile changes), %s reused, %s refreshed after other tree changes." % (self.built, self.rebuilt, self.reused, self.refreshed)
+
+
+portdb_pool = PortDBPool()
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+import asyncio
+
+
+class PushError(Exception):
+	pass
+
+
+class PushScheduler:
+
+	"""
+	A PushScheduler runs git pushes in the background, so that pushing a kit that has just been committed doesn't hold
+	up the generation of the next kit.
+
+	Pushes are scheduled with schedule(key, push), where ``push`` is a coroutine function taking no arguments that
+	returns True on success, and ``key`` identifies what is being pushed (normally the root of the repository.) At most
+	``jobs`` pushes run at once. A failed push is retried up to ``retries`` more times, waiting ``backoff`` seconds before
+	the first retry and twice as long before each following one.
+
+	Pushes of the same key are coalesced: a push that is scheduled while another push of the same key is still waiting
+	to run replaces it, and a push that is scheduled while one is running is run once the running one finishes. Since a
+	push sends whatever the repository holds at the time it runs, the latest push of a key covers all earlier ones.
+
+	barrier() waits for all scheduled pushes to finish, and raises PushError if any of them ultimately failed.
+	"""
+
+	def __init__(self, jobs=4, retries=3, backoff=5.0):
+		self.jobs = jobs
+		self.retries = retries
+		self.backoff = backoff
+		self._semaphore = None
+		# the next push to run for each key, if one is waiting:
+		self._pending = {}
+		# the task handling pushes for each key, while there is one:
+		self._tasks = {}
+		self.failures = []
+		self.push_count = 0
+		self.coalesced_count = 0
+
+	def schedule(self, key, push):
+		if key in self._pending:
+			self.coalesced_count += 1
+		self._pending[key] = push
+		if key not in self._tasks:
+			self._tasks[key] = asyncio.ensure_future(self._run_pushes(key))
+
+	async def _run_pushes(self, key):
+		if self._semaphore is None:
+			self._semaphore = asyncio.Semaphore(self.jobs)
+		try:
+			while key in self._pending:
+				async with self._semaphore:
+					# take the latest push for this key only once we are allowed to run it, so we coalesce while we wait:
+					push = self._pending.pop(key)
+					await self._push_with_retries(key, push)
+		finally:
+			del self._tasks[key]
+
+	async def _push_with_retries(self, key, push):
+		delay = self.backoff
+		attempt = 0
+		while True:
+			self.push_count += 1
+			try:
+				success = await push()
+			except Exception as e:
+				print("Push of %s raised %s" % (key, repr(e)))
+				success = False
+			if success:
+				return
+			if attempt >= self.retries:
+				print("!!! Push of %s failed after %s attempts." % (key, attempt + 1))
+				self.failures.append(key)
+				return
+			attempt += 1
+			print("Push of %s failed; retrying in %s seconds (attempt %s of %s)..." % (key, delay, attempt, self.retries))
+			await asyncio.sleep(delay)
+			delay *= 2
+
+	async def barrier(self):
+		while len(self._tasks):
+			await asyncio.gather(*list(self._tasks.values()))
+		if len(self.failures):
+			failures = self.failures
+			self.failures = []
+			raise PushError("Unable to push: %s" % ", ".join(failures))
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+"""
+Helpers for working out which MergeSteps can run at the same time.
+
+A MergeStep can declare the parts of a tree it reads and writes in its ``reads`` and ``writes`` attributes. Each of
+these is a list of resources, or None (the default), which means "the whole tree". A resource is either a path relative
+to the root of the tree, which stands for everything below it, or one of the following names for the files spread over
+all catpkg directories, which can't be described by path prefixes:
+
+	@ebuilds     -- ebuilds and their files/ directories.
+	@manifests   -- Manifests and ChangeLogs.
+	@pkgmetadata -- metadata.xml files.
+
+These overlap any path that something they stand for could be in: a category or catpkg directory, or a file that one of
+their globs matches. Top-level directories that aren't categories (see non_category_dirs) hold none of them.
+
+Two steps conflict if one of them writes something that the other one reads or writes. A step has to wait for all
+earlier steps in the list that it conflicts with, so the result is the same as running the steps one after the other.
+"""
+
+import fnmatch
+
+# git pathspecs matching the files that the @ resource names stand for:
+resource_globs = {
+	"@ebuilds": [ "*/*/*.ebuild", "*/*/files/**" ],
+	"@manifests": [ "*/*/Manifest", "*/*/ChangeLog*" ],
+	"@pkgmetadata": [ "*/*/metadata.xml" ]
+}
+
+
+def resource_pathspecs(resources):
+	"""Return a list of git pathspecs matching ``resources``, a list of resources (not None.)"""
+	pathspecs = []
+	for resource in resources:
+		if resource in resource_globs:
+			pathspecs += [ ":(glob)" + glob for glob in resource_globs[resource] ]
+		elif resource == "":
+			pathspecs.append(":/")
+		else:
+			pathspecs.append(":(literal)" + resource)
+	return pathspecs
+
+# top-level directories of a tree that are not categories:
+non_category_dirs = { "eclass", "licenses", "metadata", "profiles" }
+
+
+def glob_overlaps(glob, path):
+	"""Return True if git pathspec glob ``glob`` (without magic) can match ``path`` or anything below it."""
+	parts = path.split("/")
+	patterns = glob.split("/")
+	for pos, pattern in enumerate(patterns):
+		if pattern == "**" or pos == len(parts):
+			return True
+		if not fnmatch.fnmatchcase(parts[pos], pattern):
+			return False
+	# a file that the glob matches has nothing below it:
+	return len(parts) == len(patterns)
+
+
+def resource_overlaps(x, y):
+	if x == "" or y == "" or x == y:
+		return True
+	if x in resource_globs and y in resource_globs:
+		return False
+	if y in resource_globs:
+		x, y = y, x
+	if x in resource_globs:
+		if y.split("/")[0] in non_category_dirs:
+			return False
+		return any(glob_overlaps(glob, y) for glob in resource_globs[x])
+	return x.startswith(y + "/") or y.startswith(x + "/")
+
+
+def resources_overlap(a, b):
+	if a is None or b is None:
+		return True
+	for x in a:
+		for y in b:
+			if resource_overlaps(x, y):
+				return True
+	return False
+
+
+def steps_conflict(a, b):
+	a_reads = getattr(a, "reads", None)
+	a_writes = getattr(a, "writes", None)
+	b_reads = getattr(b, "reads", None)
+	b_writes = getattr(b, "writes", None)
+	return resources_overlap(a_writes, b_writes) or resources_overlap(a_writes, b_reads) or resources_overlap(a_reads, b_writes)
+
+
+def step_dependencies(steps):
+	"""
+	Return a list containing, for each step in ``steps``, the set of indexes of earlier steps that it has to wait for.
+	A step that doesn't declare both reads and writes is a barrier: it waits for everything before it, and everything
+	after it waits for it, so it is enough for later steps to depend on the barrier rather than everything before it.
+	"""
+	deps = []
+	last_barrier = None
+	for pos, step in enumerate(steps):
+		is_barrier = getattr(step, "reads", None) is None or getattr(step, "writes", None) is None
+		start = 0 if last_barrier is None else last_barrier
+		my_deps = set()
+		for other in range(start, pos):
+			if is_barrier or steps_conflict(steps[other], step):
+				my_deps.add(other)
+		if last_barrier is not None:
+			my_deps.add(last_barrier)
+		deps.append(my_deps)
+		if is_barrier:
+			last_barrier = pos
+	return deps
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+"""
+Memoization of MergeSteps.
+
+A step that sets ``memoize`` to True, and declares the parts of the tree it reads and writes (see merge.step_graph) can
+be memoized: after it runs, the paths it writes are saved in the memo, under a fingerprint of the step's class, its
+parameters and the contents of everything it reads. The next time the step runs with the same fingerprint -- for
+example, when a kit is regenerated and none of its sources have changed -- its saved output is copied into the tree
+instead of running the step again.
+
+The memo directory holds one directory per fingerprint, containing a copy of each written path that existed after the
+step ran. Entries are written to a temporary directory and renamed into place, so an interrupted run never leaves a
+partial entry behind. Nothing is ever expired; it's safe to remove the memo directory (or any entry in it) at any time.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+from merge.step_graph import resources_overlap
+
+
+def memoizable(step):
+	# a step's output can only be replayed if we know everything it reads, and it doesn't modify what it reads:
+	reads = getattr(step, "reads", None)
+	writes = getattr(step, "writes", None)
+	if not getattr(step, "memoize", False) or reads is None or writes is None or not len(writes):
+		return False
+	if any(path == "" or path.startswith("@") for path in writes):
+		return False
+	return not resources_overlap(reads, writes)
+
+
+def step_fingerprint(step, content_digest, extra=None):
+	"""
+	Return the fingerprint of running ``step`` on a tree in which the contents of the step's reads have the digest
+	``content_digest``. ``extra`` is a list of strings describing other things the output of the step depends on.
+	"""
+	h = hashlib.sha1()
+	for part in [step.__class__.__name__, repr(step.memoParams()), content_digest] + (extra if extra is not None else []):
+		h.update(part.encode("utf-8"))
+		h.update(b"\0")
+	return h.hexdigest()
+
+
+def _remove(path):
+	if os.path.isdir(path) and not os.path.islink(path):
+		shutil.rmtree(path)
+	elif os.path.lexists(path):
+		os.unlink(path)
+
+
+def _copy(src, dest):
+	os.makedirs(os.path.dirname(dest), exist_ok=True)
+	if os.path.isdir(src) and not os.path.islink(src):
+		shutil.copytree(src, dest, symlinks=True)
+	else:
+		shutil.copy2(src, dest, follow_symlinks=False)
+
+
+class StepMemo:
+
+	def __init__(self, root):
+		self.root = root
+		self.hits = 0
+		self.misses = 0
+
+	def entry(self, fingerprint):
+		return os.path.join(self.root, fingerprint[:2], fingerprint)
+
+	def replay(self, tree, step, fingerprint):
+		"""
+		If we have an entry for ``fingerprint``, replace the paths ``step`` writes in ``tree`` with their saved copies,
+		and return True. Otherwise, return False.
+		"""
+		entry = self.entry(fingerprint)
+		if not os.path.isdir(entry):
+			self.misses += 1
+			return False
+		for path in step.writes:
+			dest = os.path.join(tree.root, path)
+			_remove(dest)
+			if os.path.lexists(os.path.join(entry, path)):
+				_copy(os.path.join(entry, path), dest)
+		tree.journal(*step.writes)
+		self.hits += 1
+		return True
+
+	def record(self, tree, step, fingerprint):
+		"""Save the paths ``step`` wrote in ``tree`` as the entry for ``fingerprint``."""
+		entry = self.entry(fingerprint)
+		if os.path.isdir(entry):
+			return
+		os.makedirs(os.path.dirname(entry), exist_ok=True)
+		tmp = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry))
+		try:
+			for path in step.writes:
+				if os.path.lexists(os.path.join(tree.root, path)):
+					_copy(os.path.join(tree.root, path), os.path.join(tmp, path))
+			os.rename(tmp, entry)
+		except OSError:
+			# another process may have recorded this entry first, or we are out of space -- either way, it can wait:
+			shutil.rmtree(tmp, ignore_errors=True)
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+
+"""
+Tracing for the merge pipeline. When ``tracer.enabled`` is set, MergeSteps, shell and git commands, portdbapi aux_get
+batches and whole kits are recorded as spans, which can be written out as a Chrome trace-event file (load it in
+chrome://tracing or https://ui.perfetto.dev) and summarized as a table of the slowest steps and kits.
+
+Each span records its wall time, plus the CPU time (ours and that of our finished child processes), number of
+subprocesses started and bytes written (from /proc/self/io, which includes reaped children) while it was open. These
+are process-wide counters, so when spans overlap -- as they do when kits or steps run concurrently -- they are shared
+between all the open spans, and should be taken as an upper bound.
+
+Spans are grouped into lanes, one per kit branch. The current lane is kept in a context variable, so asyncio tasks
+started while a lane is active stay in it. Spans can be nested, so each span also records the categories of the spans
+that were open in its lane when it started, and the totals in the summary leave out spans that are inside another span
+they would be added up with.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import re
+import resource
+import time
+from collections import defaultdict
+
+current_lane = contextvars.ContextVar("merge_trace_lane", default="main")
+
+
+def command_name(cmd):
+	"""Return a short name for a shell command or argument list, like 'git fetch' or 'rsync'."""
+	if not isinstance(cmd, str):
+		cmd = " ".join(cmd)
+	# our shell commands usually look like "( cd /some/dir && git fetch ... )":
+	cmd = re.sub(r"^[(\s]*cd\s+\S+\s*&&\s*", "", cmd.strip())
+	words = cmd.lstrip("( ").split()
+	if not len(words):
+		return "sh"
+	if words[0] == "git":
+		for word in words[1:]:
+			if not word.startswith("-"):
+				return "git " + word
+		return "git"
+	return os.path.basename(words[0])
+
+
+class Tracer:
+
+	def __init__(self):
+		self.enabled = False
+		self.events = []
+		self.subprocess_count = 0
+		self._origin = time.monotonic()
+		# (lane, category) -> number of spans open:
+		self._open = defaultdict(int)
+
+	def reset(self):
+		self.events = []
+
+	@staticmethod
+	def _bytes_written():
+		try:
+			with open("/proc/self/io", "r") as f:
+				for line in f:
+					if line.startswith("wchar:"):
+						return int(line.split()[1])
+		except (OSError, ValueError):
+			pass
+		return 0
+
+	def _counters(self):
+		children = resource.getrusage(resource.RUSAGE_CHILDREN)
+		return time.process_time() + children.ru_utime + children.ru_stime, self.subprocess_count, self._bytes_written()
+
+	@contextlib.contextmanager
+	def span(self, name, cat, **args):
+		if not self.enabled:
+			yield
+			return
+		lane = current_lane.get()
+		within = sorted(key[1] for key, count in self._open.items() if key[0] == lane and count > 0)
+		self._open[(lane, cat)] += 1
+		start = time.monotonic()
+		cpu, procs, written = self._counters()
+		try:
+			yield
+		finally:
+			end = time.monotonic()
+			end_cpu, end_procs, end_written = self._counters()
+			self._open[(lane, cat)] -= 1
+			self.events.append({
+				"name": name,
+				"cat": cat,
+				"lane": lane,
+				"within": within,
+				"start": start - self._origin,
+				"wall": end - start,
+				"cpu": end_cpu - cpu,
+				"subprocesses": end_procs - procs,
+				"bytes_written": end_written - written,
+				"args": args
+			})
+
+	@contextlib.contextmanager
+	def subprocess(self, cmd):
+		# wrap every subprocess we run in this, so it is counted (even if tracing is disabled) and traced:
+		self.subprocess_count += 1
+		name = command_name(cmd)
+		with self.span(name, "git" if name.startswith("git") else "shell", cmd=cmd if isinstance(cmd, str) else " ".join(cmd)):
+			yield
+
+	@contextlib.contextmanager
+	def lane(self, name):
+		token = current_lane.set(name)
+		try:
+			yield
+		finally:
+			current_lane.reset(token)
+
+	def chrome_trace(self, lane=None):
+		lanes = {}
+		out = []
+		for event in self.events:
+			if lane is not None and event["lane"] != lane:
+				continue
+			if event["lane"] not in lanes:
+				lanes[event["lane"]] = len(lanes) + 1
+				out.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": lanes[event["lane"]], "args": {"name": event["lane"]}})
+			args = dict(event["args"])
+			args.update({"cpu": round(event["cpu"], 3), "subprocesses": event["subprocesses"], "bytes_written": event["bytes_written"]})
+			out.append({
+				"name": event["name"],
+				"cat": event["cat"],
+				"ph": "X",
+				"ts": int(event["start"] * 1000000),
+				"dur": int(event["wall"] * 1000000),
+				"pid": 1,
+				"tid": lanes[event["lane"]],
+				"args": args
+			})
+		return {"traceEvents": out, "displayTimeUnit": "ms"}
+
+	def lanes(self):
+		return sorted(set(event["lane"] for event in self.events))
+
+	def write_trace(self, path, lane=None):
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w") as f:
+			json.dump(self.chrome_trace(lane=lane), f)
+
+	def totals(self, cats, key):
+		"""
+		Return the wall time, CPU time, subprocesses and bytes written of the spans in categories ``cats`` (or all of them,
+		if None), added up per ``key`` ("lane" or "cat"). Spans inside another span of ``cats`` (or of their own category,
+		if ``cats`` is None) aren't counted again.
+		"""
+		totals = defaultdict(lambda: {"wall": 0.0, "cpu": 0.0, "subprocesses": 0, "bytes_written": 0})
+		for event in self.events:
+			if cats is not None and (event["cat"] not in cats or any(cat in cats for cat in event["within"])):
+				continue
+			if cats is None and event["cat"] in event["within"]:
+				continue
+			total = totals[event[key]]
+			for field in ["wall", "cpu", "subprocesses", "bytes_written"]:
+				total[field] += event[field]
+		return totals
+
+	def summary(self, limit=20):
+		"""Return a table of the slowest steps, and of the total time spent per kit and per kind of span."""
+
+		def row(label, event):
+			return "%10.2f %10.2f %8d %12d  %s" % (event["wall"], event["cpu"], event["subprocesses"], event["bytes_written"], label)
+
+		header = "%10s %10s %8s %12s  %s" % ("wall (s)", "cpu (s)", "procs", "written", "")
+		lines = ["Slowest steps:", header]
+		steps = sorted((event for event in self.events if event["cat"] == "step"), key=lambda event: event["wall"], reverse=True)
+		for event in steps[:limit]:
+			lines.append(row("%s: %s" % (event["lane"], event["name"]), event))
+
+		# with --worktrees, kits are finalized after their kit span has ended:
+		for title, cats, key in [("Kits:", ["kit", "finalize"], "lane"), ("By kind:", None, "cat")]:
+			totals = self.totals(cats, key)
+			lines += ["", title, header]
+			for label, total in sorted(totals.items(), key=lambda item: item[1]["wall"], reverse=True)[:limit]:
+				lines.append(row(label, total))
+		return "\n".join(lines) + "\n"
+
+
+tracer = Tracer()
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+import fnmatch
+import os
+
+
+class TreeIndex:
+
+	"""
+	A TreeIndex is an in-memory snapshot of the category -> package -> ebuild layout of an ebuild repository. It is built
+	with a single os.scandir() pass over the tree, and is then used to answer all the "which catpkgs exist in this repo?"
+	questions that the merge steps ask, so we don't stat the same category and package directories over and over again.
+
+	Hidden entries and top-level directories that never contain catpkgs (eclass, licenses, metadata, profiles) are not
+	indexed. Only directories are recorded as packages, and only ``*.ebuild`` files are recorded inside packages.
+
+	A TreeIndex is a snapshot -- it does not notice changes made to the tree after it has been built. ``sha1`` records the
+	commit the tree was at when the snapshot was taken, if known. Snapshots of committed trees can be written to disk with
+	save() and read back with load(), and a stale snapshot can be brought up to date with apply_changes() using the list of
+	paths that ``git diff --name-only`` reports between the old and new commits.
+	"""
+
+	non_category_dirs = {"eclass", "licenses", "metadata", "profiles"}
+	file_magic = b"TREEINDEX1"
+
+	def __init__(self, root, sha1=None):
+		self.root = root
+		self.sha1 = sha1
+		# contents of profiles/categories, or None if the tree has no such file:
+		self.profile_categories = None
+		# format: { 'cat' : { 'pkg' : ( 'pkg-1.0.ebuild', ... ) } }
+		self._tree = {}
+
+	@classmethod
+	def scan(cls, root, sha1=None):
+		index = cls(root, sha1=sha1)
+		index._read_profile_categories()
+		try:
+			top = os.scandir(root)
+		except FileNotFoundError:
+			return index
+		with top:
+			for cat_entry in top:
+				if cat_entry.name[:1] == "." or cat_entry.name in cls.non_category_dirs:
+					continue
+				if not cat_entry.is_dir():
+					continue
+				index._tree[cat_entry.name] = index._scan_category(cat_entry.path)
+		return index
+
+	def _read_profile_categories(self):
+		try:
+			with open(os.path.join(self.root, "profiles/categories"), "r") as f:
+				self.profile_categories = f.read().split()
+		except FileNotFoundError:
+			self.profile_categories = None
+
+	@staticmethod
+	def _scan_package(pkg_path):
+		with os.scandir(pkg_path) as it:
+			return tuple(sorted(e.name for e in it if e.name.endswith(".ebuild") and e.is_file()))
+
+	def _scan_category(self, cat_path):
+		pkgs = {}
+		with os.scandir(cat_path) as it:
+			for pkg_entry in it:
+				if pkg_entry.name[:1] == "." or not pkg_entry.is_dir():
+					continue
+				pkgs[pkg_entry.name] = self._scan_package(pkg_entry.path)
+		return pkgs
+
+	@property
+	def categories(self):
+		"""All indexed top-level directories, sorted. Use profile_categories for the 'official' category list."""
+		return sorted(self._tree.keys())
+
+	def has_category(self, cat):
+		return cat in self._tree
+
+	def packages(self, cat):
+		if cat not in self._tree:
+			return []
+		return sorted(self._tree[cat].keys())
+
+	def ebuilds(self, catpkg):
+		cat, _, pkg = catpkg.partition("/")
+		try:
+			return self._tree[cat][pkg]
+		except KeyError:
+			return ()
+
+	def catpkg_exists(self, catpkg):
+		cat, _, pkg = catpkg.partition("/")
+		return cat in self._tree and pkg in self._tree[cat]
+
+	def catpkgs(self, categories=None):
+		if categories is None:
+			categories = self.categories
+		for cat in categories:
+			for pkg in self.packages(cat):
+				yield cat + "/" + pkg
+
+	def match_glob(self, pattern):
+		"""
+		Return a sorted list of catpkgs matching a glob such as ``dev-python/*``, with the same semantics as running
+		glob.glob() on the tree and keeping directories.
+		"""
+		cat_pat, sep, pkg_pat = pattern.partition("/")
+		if not sep or "/" in pkg_pat:
+			return []
+		out = []
+		for cat in fnmatch.filter(self.categories, cat_pat):
+			for pkg in fnmatch.filter(self.packages(cat), pkg_pat):
+				out.append(cat + "/" + pkg)
+		return out
+
+	def match_regex(self, regex):
+		return [catpkg for catpkg in self.catpkgs() if regex.match(catpkg)]
+
+	def apply_changes(self, paths, sha1=None):
+		"""
+		Update the snapshot in-place for a list of changed paths (relative to our root), rescanning only the categories and
+		packages that these paths live in. ``sha1`` is the commit the tree is now at.
+		"""
+		dirty_cats = set()
+		dirty_pkgs = set()
+		for path in paths:
+			parts = path.split("/")
+			if path == "profiles/categories":
+				self._read_profile_categories()
+				continue
+			if len(parts) < 2 or parts[0][:1] == "." or parts[0] in self.non_category_dirs:
+				continue
+			dirty_cats.add(parts[0])
+			if len(parts) >= 3:
+				dirty_pkgs.add((parts[0], parts[1]))
+		for cat, pkg in dirty_pkgs:
+			pkg_path = os.path.join(self.root, cat, pkg)
+			if os.path.isdir(pkg_path):
+				self._tree.setdefault(cat, {})[pkg] = self._scan_package(pkg_path)
+			elif cat in self._tree:
+				self._tree[cat].pop(pkg, None)
+		for cat in dirty_cats:
+			cat_path = os.path.join(self.root, cat)
+			if not os.path.isdir(cat_path):
+				self._tree.pop(cat, None)
+			elif cat not in self._tree:
+				self._tree[cat] = self._scan_category(cat_path)
+		self.sha1 = sha1
+
+	def save(self, path):
+		"""
+		Write the snapshot to ``path``. The format is a header line, a line holding profiles/categories, and then one
+		``cat/pkg<TAB>ebuild<TAB>ebuild...`` line per package. The file is replaced atomically.
+		"""
+		lines = [b"%s %s" % (self.file_magic, (self.sha1 or "-").encode("ascii"))]
+		if self.profile_categories is None:
+			lines.append(b"-")
+		else:
+			lines.append(("+ " + " ".join(self.profile_categories)).encode("utf-8"))
+		for cat in self.categories:
+			if not self._tree[cat]:
+				lines.append(cat.encode("utf-8"))
+				continue
+			for pkg, ebuilds in sorted(self._tree[cat].items()):
+				lines.append("\t".join((cat + "/" + pkg,) + ebuilds).encode("utf-8"))
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp_path = "%s.%s.tmp" % (path, os.getpid())
+		with open(tmp_path, "wb") as f:
+			f.write(b"\n".join(lines) + b"\n")
+		os.replace(tmp_path, path)
+
+	@classmethod
+	def load(cls, root, path):
+		"""Load a snapshot written by save(), returning None if ``path`` does not exist or is not a valid snapshot."""
+		try:
+			with open(path, "rb") as f:
+				data = f.read()
+		except FileNotFoundError:
+			return None
+		lines = data.decode("utf-8").split("\n")
+		header = lines[0].split()
+		if len(header) != 2 or header[0] != cls.file_magic.decode("ascii") or len(lines) < 2:
+			return None
+		index = cls(root, sha1=None if header[1] == "-" else header[1])
+		if lines[1] != "-":
+			index.profile_categories = lines[1][2:].split()
+		tree = index._tree
+		for line in lines[2:]:
+			if not line:
+				continue
+			fields = line.split("\t")
+			cat, _, pkg = fields[0].partition("/")
+			pkgs = tree.setdefault(cat, {})
+			if pkg:
+				pkgs[pkg] = tuple(fields[1:])
+		return index
+
+# vim: ts=4 sw=4 noet
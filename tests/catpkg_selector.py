@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+import os, sys
+import re
+import time
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.catpkg_selector import CatPkgSelector
+from merge.merge_utils import CatPkgMatchLogger
+from merge.tree_index import TreeIndex
+
+class CatPkgSelectorTest(unittest.TestCase):
+
+	def setUp(self):
+
+		# about the size of gentoo: 160 categories, 20000 catpkgs:
+		self.catpkgs = [ "cat%03d-foo/pkg%04d" % (cat, pkg) for cat in range(0, 160) for pkg in range(0, 125) ]
+		self.index = TreeIndex("/nonexistent")
+		for catpkg in self.catpkgs:
+			cat, pkg = catpkg.split("/")
+			self.index._tree.setdefault(cat, {})[pkg] = ()
+
+	def test_match(self):
+
+		selector = CatPkgSelector([ "sys-apps/portage", "dev-python/*", "@regex@:dev-perl/.*-Test", re.compile("x11-.*/lib"), "media-*/gst-*" ])
+		for catpkg in [ "sys-apps/portage", "dev-python/foo", "dev-perl/Foo-Test", "x11-libs/libX11", "media-libs/gst-plugins-base" ]:
+			self.assertTrue(selector.match(catpkg), catpkg)
+		for catpkg in [ "sys-apps/portage2", "dev-python2/foo", "dev-perl/Test-Foo", "x11-libs/X11", "media-libs/gstreamer" ]:
+			self.assertFalse(selector.match(catpkg), catpkg)
+		# regexes are anchored at the start only, like re.match():
+		self.assertTrue(selector.match("dev-perl/Foo-Test-Simple"))
+		self.assertFalse(CatPkgSelector([]).match("sys-apps/portage"))
+		self.assertEqual(CatPkgSelector([ "cat001-foo/*", "cat002-foo/pkg0001", "@regex@:cat003-foo/pkg000[12]", "nope/nope" ]).select(self.index),
+						 sorted(self.catpkgs[125:250] + [ "cat002-foo/pkg0001", "cat003-foo/pkg0001", "cat003-foo/pkg0002" ]))
+
+	def test_same_as_patterns(self):
+
+		# a package set of a quarter of the tree, checked against every catpkg, as InsertEbuilds does:
+		select = self.catpkgs[::4]
+		selector = CatPkgSelector(select)
+		self.assertEqual([ catpkg for catpkg in self.catpkgs if selector.match(catpkg) ], select)
+
+		# many regexes, checked against the whole tree, as generateKitSteps does with @regex@ patterns:
+		expected = set()
+		for pattern in self.regexes():
+			regex = re.compile(pattern[8:])
+			expected.update(catpkg for catpkg in self.index.catpkgs() if regex.match(catpkg))
+		self.assertEqual(CatPkgSelector(self.regexes()).select(self.index), sorted(expected))
+
+	def regexes(self):
+		return [ "@regex@:cat%03d-foo/pkg00.*" % cat for cat in range(0, 160, 2) ]
+
+	@unittest.skipUnless(os.environ.get("MERGE_BENCHMARK"), "timings are only checked with MERGE_BENCHMARK=1")
+	def test_speedup(self):
+
+		select = self.catpkgs[::4]
+		start = time.monotonic()
+		listed = [ catpkg for catpkg in self.catpkgs[:2000] if catpkg in select ]
+		list_time = time.monotonic() - start
+		start = time.monotonic()
+		selector = CatPkgSelector(select)
+		selected = [ catpkg for catpkg in self.catpkgs if selector.match(catpkg) ]
+		selector_time = time.monotonic() - start
+		print("list: %.3fs for 2000 catpkgs, selector: %.3fs for %s catpkgs" % (list_time, selector_time, len(self.catpkgs)))
+		self.assertLess(selector_time, list_time)
+		self.assertEqual(selected, select)
+		self.assertEqual(listed, select[:len(listed)])
+
+		start = time.monotonic()
+		expected = set()
+		for pattern in self.regexes():
+			regex = re.compile(pattern[8:])
+			expected.update(catpkg for catpkg in self.index.catpkgs() if regex.match(catpkg))
+		regex_time = time.monotonic() - start
+		start = time.monotonic()
+		selected = CatPkgSelector(self.regexes()).select(self.index)
+		selector_time = time.monotonic() - start
+		print("one regex at a time: %.3fs, combined: %.3fs" % (regex_time, selector_time))
+		self.assertLess(selector_time, regex_time)
+		self.assertEqual(selected, sorted(expected))
+
+	def test_match_logger(self):
+
+		logger = CatPkgMatchLogger()
+		logger.record("foo-kit", "dev-python/foo", regex_matched=re.compile("dev-python/.*"))
+		logger.record("foo-kit", "sys-apps/bar")
+		# nothing recorded for the current kit takes effect until the next one:
+		self.assertFalse(logger.match("dev-python/foo"))
+		logger.nextKit()
+		self.assertTrue(logger.match("dev-python/baz"))
+		self.assertTrue(logger.match("sys-apps/bar"))
+		self.assertFalse(logger.match("sys-apps/baz"))
+		self.assertFalse(logger.match("sys-apps/baz"))
+		self.assertEqual((logger.matchcount, logger.cache_hits, logger.cache_misses), (2, 1, 4))
+		logger.record("bar-kit", "sys-apps/baz")
+		logger.nextKit()
+		self.assertTrue(logger.match("sys-apps/baz"))
+		restored = CatPkgMatchLogger()
+		restored.restore(logger.snapshot())
+		self.assertTrue(restored.match("dev-python/other"))
+
+if __name__ == "__main__":
+	unittest.main()
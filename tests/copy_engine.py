@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+import asyncio
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.copy_engine import CopyEngine
+from merge.merge_utils import GenerateRepoMetadata, MergeUpdates, Tree
+
+class MockTree(Tree):
+
+	def __init__(self, root):
+		self.root = root
+
+class CopyEngineTest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.root = tempfile.mkdtemp()
+		self.loop = asyncio.get_event_loop()
+		self.src = os.path.join(self.root, "src")
+		for path, content in [ ("dev-libs/oni/oni-1.0.ebuild", "EAPI=6\n"), ("dev-libs/oni/files/oni.patch", "patch\n"),
+							   ("dev-libs/oni/files/big", "x" * 300000), ("dev-libs/oni/metadata.xml", "<pkgmetadata/>\n") ]:
+			os.makedirs(os.path.join(self.src, os.path.dirname(path)), exist_ok=True)
+			with open(os.path.join(self.src, path), "w") as f:
+				f.write(content)
+		os.chmod(os.path.join(self.src, "dev-libs/oni/files/oni.patch"), 0o755)
+		os.symlink("oni.patch", os.path.join(self.src, "dev-libs/oni/files/link"))
+		os.utime(os.path.join(self.src, "dev-libs/oni/oni-1.0.ebuild"), (1000000000, 1000000000))
+
+	def tearDown(self):
+
+		shutil.rmtree(self.root)
+
+	def listing(self, root):
+		# everything "cp -a" preserves that we care about:
+		out = []
+		for dirpath, dirnames, filenames in os.walk(root):
+			dirnames.sort()
+			for name in sorted(filenames):
+				path = os.path.join(dirpath, name)
+				st = os.lstat(path)
+				if os.path.islink(path):
+					out.append((os.path.relpath(path, root), "->", os.readlink(path)))
+				else:
+					with open(path, "rb") as f:
+						out.append((os.path.relpath(path, root), oct(st.st_mode), st.st_mtime_ns, f.read()))
+		return out
+
+	def test_like_cp(self):
+
+		expected = os.path.join(self.root, "expected")
+		os.makedirs(os.path.join(expected, "dev-libs/oni"))
+		with open(os.path.join(expected, "dev-libs/oni/ChangeLog"), "w") as f:
+			f.write("existing files are kept\n")
+		shutil.copytree(expected, os.path.join(self.root, "dest"), symlinks=True)
+		dest = os.path.join(self.root, "dest")
+		subprocess.run([ "cp", "-a", os.path.join(self.src, "dev-libs/oni/."), os.path.join(expected, "dev-libs/oni") ], check=True)
+		engine = CopyEngine(jobs=4)
+		self.loop.run_until_complete(engine.copy([ (os.path.join(self.src, "dev-libs/oni"), os.path.join(dest, "dev-libs/oni")) ]))
+		self.assertEqual(self.listing(dest), self.listing(expected))
+		self.assertEqual(sum(engine.counts.values()), 5)
+
+	def test_hardlink(self):
+
+		dest = os.path.join(self.root, "dest")
+		engine = CopyEngine(hardlink=True)
+		self.loop.run_until_complete(engine.copy([ (os.path.join(self.src, "dev-libs"), os.path.join(dest, "dev-libs")) ]))
+		ebuild = os.path.join(dest, "dev-libs/oni/oni-1.0.ebuild")
+		self.assertEqual(os.stat(ebuild).st_ino, os.stat(os.path.join(self.src, "dev-libs/oni/oni-1.0.ebuild")).st_ino)
+		self.assertEqual(engine.counts["hardlink"], 4)
+
+		# copying over a hard-linked file replaces it, rather than writing through to the source tree:
+		other = os.path.join(self.root, "other.ebuild")
+		with open(other, "w") as f:
+			f.write("EAPI=7\n")
+		CopyEngine().copySync([ (other, ebuild) ])
+		with open(os.path.join(self.src, "dev-libs/oni/oni-1.0.ebuild")) as f:
+			self.assertEqual(f.read(), "EAPI=6\n")
+		with open(ebuild) as f:
+			self.assertEqual(f.read(), "EAPI=7\n")
+
+	def test_hardlinked_kit_steps(self):
+
+		# merge steps that rewrite kit files must not write through hard links into the source tree:
+		gentoo = os.path.join(self.root, "gentoo-staging")
+		fixups = os.path.join(self.root, "kit-fixups")
+		for root, files in [ (gentoo, { "profiles/updates/1Q-2020": "move a/b c/d\n", "profiles/repo_name": "gentoo\n",
+										"metadata/layout.conf": "repo-name = gentoo\n" }),
+							 (fixups, { "profiles/updates/1Q-2020": "move e/f g/h\n" }) ]:
+			for path, content in files.items():
+				os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+				with open(os.path.join(root, path), "w") as f:
+					f.write(content)
+		kit = MockTree(os.path.join(self.root, "core-kit"))
+		engine = CopyEngine(hardlink=True)
+		engine.copySync([ (os.path.join(gentoo, "profiles"), os.path.join(kit.root, "profiles")),
+						  (os.path.join(gentoo, "metadata"), os.path.join(kit.root, "metadata")) ])
+		self.assertEqual(engine.counts["hardlink"], 3)
+		for step in [ MergeUpdates(fixups), GenerateRepoMetadata("core-kit") ]:
+			self.loop.run_until_complete(step.run(kit))
+		with open(os.path.join(kit.root, "profiles/updates/1Q-2020")) as f:
+			self.assertEqual(f.read(), "move a/b c/d\nmove e/f g/h\n")
+		with open(os.path.join(kit.root, "profiles/repo_name")) as f:
+			self.assertEqual(f.read(), "core-kit\n")
+		for path, content in [ ("profiles/updates/1Q-2020", "move a/b c/d\n"), ("profiles/repo_name", "gentoo\n"),
+							   ("metadata/layout.conf", "repo-name = gentoo\n") ]:
+			with open(os.path.join(gentoo, path)) as f:
+				self.assertEqual(f.read(), content, path)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import asyncio
+import hashlib
+import os, sys
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.dep_graph import DepGraph, tree_dep_graph
+from merge.md5cache import MetadataTable
+from merge.tree_index import TreeIndex
+
+def dep_keys(depstring):
+	# enough of use_reduce() and dep_getkey() for these tests:
+	out = []
+	for token in depstring.split():
+		if token in [ "(", ")", "||" ] or token.endswith("?") or token.startswith("!"):
+			continue
+		if token == "broken":
+			raise ValueError("not an atom")
+		out.append(token.lstrip("<>=~").rsplit("-", 1)[0] if token[0] in "<>=~" else token)
+	return out
+
+class DepGraphTest(unittest.TestCase):
+
+	def setUp(self):
+
+		table = MetadataTable("/nonexistent")
+		table.add("app-misc/a", "app-misc/a-1", { "DEPEND" : "dev-libs/b", "RDEPEND" : "ssl? ( >=dev-libs/openssl-1.0 ) !app-misc/old" })
+		table.add("app-misc/a", "app-misc/a-2", { "RDEPEND" : "|| ( dev-libs/c dev-libs/b )" })
+		table.add("dev-libs/b", "dev-libs/b-1", { "DEPEND" : "dev-libs/c" })
+		table.add("dev-libs/c", "dev-libs/c-1", { "RDEPEND" : "app-misc/a sys-libs/zlib" })
+		table.add("dev-libs/d", "dev-libs/d-1", { "DEPEND" : "broken" })
+		self.graph = DepGraph.build(table, dep_keys=dep_keys)
+
+	def test_graph(self):
+
+		graph = self.graph
+		self.assertEqual(graph.tree_catpkgs(), [ "app-misc/a", "dev-libs/b", "dev-libs/c", "dev-libs/d" ])
+		self.assertEqual(sorted(graph.dependencies("app-misc/a")), [ "dev-libs/b", "dev-libs/c", "dev-libs/openssl" ])
+		self.assertEqual(graph.dependencies("dev-libs/d"), [])
+		self.assertTrue(graph.in_tree("dev-libs/b"))
+		self.assertFalse(graph.in_tree("sys-libs/zlib"))
+		self.assertEqual(graph.dependencies("sys-libs/zlib"), [])
+		self.assertEqual(sorted(graph.dependents("dev-libs/c")), [ "app-misc/a", "dev-libs/b" ])
+		self.assertEqual(graph.dependents("sys-libs/zlib"), [ "dev-libs/c" ])
+		self.assertEqual(graph.dependents("nope/nope"), [])
+
+	def test_reachable(self):
+
+		graph = self.graph
+		# like @depsincat@, which always asked for direct dependencies only:
+		self.assertEqual(graph.reachable([ "dev-libs/b" ]), { "dev-libs/c" })
+		# a single catpkg is not taken to be a list of characters:
+		self.assertEqual(graph.reachable("dev-libs/b", levels=1), { "dev-libs/c", "app-misc/a", "sys-libs/zlib" })
+		self.assertEqual(graph.reachable("dev-libs/b", levels=5), { "dev-libs/b", "dev-libs/c", "app-misc/a", "sys-libs/zlib", "dev-libs/openssl" })
+		self.assertEqual(graph.reachable([ "dev-libs/b", "nope/nope" ], levels=1), graph.reachable("dev-libs/b", levels=1))
+		self.assertIn((graph.ids["dev-libs/b"], 1), graph._memo)
+
+	def test_masters(self):
+
+		tree = MetadataTable("/nonexistent/foo-kit")
+		tree.add("app-misc/a", "app-misc/a-2", { "DEPEND" : "dev-libs/b" })
+		core_kit = MetadataTable("/nonexistent/core-kit")
+		core_kit.add("app-misc/a", "app-misc/a-1", { "RDEPEND" : "dev-libs/c" })
+		# not in the tree at all, like the root of a @depsincat@ that only core-kit has:
+		core_kit.add("app-misc/root", "app-misc/root-1", { "DEPEND" : "app-misc/a dev-libs/d" })
+		graph = DepGraph.build(tree, dep_keys=dep_keys, masters=[ core_kit ])
+		self.assertEqual(graph.tree_catpkgs(), [ "app-misc/a" ])
+		self.assertFalse(graph.in_tree("app-misc/root"))
+		# every version cp_list() would return counts, whichever repository it is in:
+		self.assertEqual(sorted(graph.dependencies("app-misc/a")), [ "dev-libs/b", "dev-libs/c" ])
+		self.assertEqual(graph.reachable("app-misc/root"), { "app-misc/a", "dev-libs/d" })
+		self.assertEqual(graph.reachable("app-misc/root", levels=1), { "app-misc/a", "dev-libs/b", "dev-libs/c", "dev-libs/d" })
+		self.assertEqual(graph.dependents("app-misc/a"), [])
+
+	def test_tree_dep_graph(self):
+
+		root = tempfile.mkdtemp()
+		try:
+			def ebuild(kit, cpv, **values):
+				cat, pf = cpv.split("/")
+				content = "EAPI=6\n"
+				os.makedirs(os.path.join(root, kit, cat, pf.rsplit("-", 1)[0]))
+				with open(os.path.join(root, kit, cat, pf.rsplit("-", 1)[0], pf + ".ebuild"), "w") as f:
+					f.write(content)
+				lines = [ "%s=%s" % (key, value) for key, value in sorted(values.items()) ]
+				lines += [ "_eclasses_=", "_md5_=" + hashlib.md5(content.encode("utf-8")).hexdigest() ]
+				os.makedirs(os.path.join(root, kit, "metadata/md5-cache", cat), exist_ok=True)
+				with open(os.path.join(root, kit, "metadata/md5-cache", cat, pf), "w") as f:
+					f.write("\n".join(lines) + "\n")
+
+			ebuild("core-kit", "app-misc/root-1", DEPEND="dev-libs/b")
+			ebuild("foo-kit", "dev-libs/b-1", RDEPEND="dev-libs/c")
+			tree = SimpleNamespace(name="foo-kit", root=os.path.join(root, "foo-kit"), config=SimpleNamespace(dest_trees=root))
+			tree.index = TreeIndex.scan(tree.root)
+			graph = asyncio.get_event_loop().run_until_complete(tree_dep_graph(tree))
+			# the root of a @depsincat@ only needs to be in core-kit, as it did when portage was asked for it:
+			self.assertEqual(graph.reachable("app-misc/root"), { "dev-libs/b" })
+			self.assertEqual(graph.tree_catpkgs(), [ "dev-libs/b" ])
+		finally:
+			shutil.rmtree(root)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+import asyncio
+import os, sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.eclass_index import EclassIndex, eclass_index_path, tree_eclass_index
+from merge.md5cache import MetadataTable
+from fixtures import MockConfig
+
+class MockTree():
+
+	def __init__(self, root, config, sha1):
+		self.name = "gentoo-staging"
+		self.root = root
+		self.config = config
+		self.dirty = False
+		self.sha1 = sha1
+
+	def head(self):
+		return self.sha1
+
+class EclassIndexTest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.root = tempfile.mkdtemp()
+		self.loop = asyncio.get_event_loop()
+		self.table = MetadataTable(self.root)
+		self.table.add("dev-python/foo", "dev-python/foo-1.0", { "INHERITED" : "eutils python-single-r1" })
+		self.table.add("dev-python/foo", "dev-python/foo-1.1", { "INHERITED" : "python-single-r1" })
+		self.table.add("dev-libs/bar", "dev-libs/bar-2", { "INHERITED" : "eutils" })
+		self.table.add("dev-libs/oni", "dev-libs/oni-1", {})
+
+	def tearDown(self):
+
+		shutil.rmtree(self.root)
+
+	def test_index(self):
+
+		index = EclassIndex.build(self.table, sha1="abc")
+		self.assertEqual(index.eclasses, [ "eutils", "python-single-r1" ])
+		self.assertEqual(index.catpkgs("eutils"), { "dev-python/foo", "dev-libs/bar" })
+		self.assertEqual(index.catpkgs("eutils", categories=[ "dev-libs" ]), { "dev-libs/bar" })
+		self.assertEqual(index.catpkgs("nope"), set())
+		path = os.path.join(self.root, "eclass.idx")
+		index.save(path)
+		loaded = EclassIndex.load(path)
+		self.assertEqual((loaded.sha1, loaded._catpkgs), ("abc", index._catpkgs))
+		self.assertIsNone(EclassIndex.load(os.path.join(self.root, "nope.idx")))
+		self.assertFalse(index.selfContained(self.root))
+
+	def test_persisted(self):
+
+		# an index saved by an earlier run is used as long as the tree is at the same commit, without reading metadata:
+		tree = MockTree(os.path.join(self.root, "gentoo-staging"), MockConfig(self.root), "abc")
+		EclassIndex.build(self.table, sha1="abc").save(eclass_index_path(tree))
+		index = self.loop.run_until_complete(tree_eclass_index(tree))
+		self.assertEqual(index.catpkgs("python-single-r1"), { "dev-python/foo" })
+		self.assertIs(self.loop.run_until_complete(tree_eclass_index(tree)), index)
+
+if __name__ == "__main__":
+	unittest.main()
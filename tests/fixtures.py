@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+# Fixtures shared by the tests that run GitTrees against scratch repositories. These are imported by the test scripts
+# next to this file, and don't run any tests themselves.
+
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+class MockConfig():
+
+	def __init__(self, root, object_store=None):
+		self.source_trees = os.path.join(root, "source-trees")
+		self.dest_trees = os.path.join(root, "dest-trees")
+		self.cache_dir = os.path.join(root, "cache")
+		self.object_store = object_store
+		self.fetch_ttl = None
+		self.source_jobs = 4
+
+class GitTestCase(unittest.TestCase):
+
+	"""
+	A TestCase with a scratch directory in self.root and a MockConfig for it in self.config. Git needs an identity to
+	commit with, which GitTrees get from the environment, so one is set in os.environ (and self.env) for each test, and
+	the environment is put back afterwards.
+	"""
+
+	git_identity = { "GIT_AUTHOR_NAME": "test", "GIT_AUTHOR_EMAIL": "test@localhost",
+					 "GIT_COMMITTER_NAME": "test", "GIT_COMMITTER_EMAIL": "test@localhost" }
+
+	def setUp(self):
+
+		self.root = tempfile.mkdtemp()
+		self.saved_environ = os.environ.copy()
+		os.environ.update(self.git_identity)
+		self.env = os.environ.copy()
+		self.config = MockConfig(self.root)
+		self.loop = asyncio.get_event_loop()
+
+	def tearDown(self):
+
+		os.environ.clear()
+		os.environ.update(self.saved_environ)
+		shutil.rmtree(self.root)
+
+	def git(self, *args, cwd=None):
+		return subprocess.run(("git",) + args, cwd=cwd, env=self.env, check=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+
+	def make_upstream(self, name, files):
+		"""
+		Create a bare repository with a master branch holding ``files``, a dictionary mapping paths to their contents, and
+		return its path. The clone used to create it is left in work/``name``.
+		"""
+		upstream = os.path.join(self.root, "upstream", name + ".git")
+		self.git("init", "--quiet", "--bare", "-b", "master", upstream)
+		work = os.path.join(self.root, "work", name)
+		self.git("clone", "--quiet", upstream, work)
+		for path, content in files.items():
+			os.makedirs(os.path.join(work, os.path.dirname(path)), exist_ok=True)
+			with open(os.path.join(work, path), "w") as f:
+				f.write(content)
+		self.git("add", ".", cwd=work)
+		self.git("commit", "--quiet", "--allow-empty", "-m", "initial commit", cwd=work)
+		self.git("push", "--quiet", "origin", "master", cwd=work)
+		return upstream
+
+def placeholder_files(paths):
+	"""
+	Return a dictionary of files for make_upstream(), in which each of ``paths`` holds its own path, except
+	profiles/categories, which lists sys-apps and dev-libs.
+	"""
+	return dict((path, "sys-apps\ndev-libs\n" if path == "profiles/categories" else "%s\n" % path) for path in paths)
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import os, sys
+import shutil
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.merge_utils import GitTree, GitTreeError, InsertEbuilds, InsertLicenses
+from fixtures import GitTestCase, placeholder_files
+
+class GraftTest(GitTestCase):
+
+	def setUp(self):
+
+		super().setUp()
+		upstream = self.make_upstream("source", placeholder_files([ "profiles/categories", "licenses/GPL-2", "licenses/MIT", "sys-apps/foobar/foobar-1.0.ebuild",
+																	 "sys-apps/foobar/files/foobar.patch", "dev-libs/oni/oni-1.0.ebuild" ]))
+		self.srctree = GitTree("source", "master", config=self.config, url=upstream, root=os.path.join(self.config.source_trees, "source"))
+		self.loop.run_until_complete(self.srctree.initialize())
+
+	def build_kit(self, name, graft):
+		upstream = self.make_upstream(name, placeholder_files([ "README", "sys-apps/foobar/foobar-0.9.ebuild" ]))
+		tree = GitTree(name, "master", config=self.config, url=upstream, root=os.path.join(self.config.dest_trees, name), graft=graft)
+		self.loop.run_until_complete(tree.initialize())
+		self.loop.run_until_complete(tree.run([
+			InsertLicenses(self.srctree),
+			InsertEbuilds(self.srctree, select=[ "sys-apps/foobar" ], replace=True),
+			InsertEbuilds(self.srctree, select=[ "dev-libs/oni" ])
+		]))
+		self.loop.run_until_complete(tree.gitCommit(message="updates", push=False))
+		return tree
+
+	def test_graft_matches_copy(self):
+
+		grafted = self.build_kit("graft-kit", graft=True)
+		copied = self.build_kit("copy-kit", graft=False)
+		self.assertEqual(self.git("rev-parse", "HEAD^{tree}", cwd=grafted.root), self.git("rev-parse", "HEAD^{tree}", cwd=copied.root))
+		self.assertEqual(self.git("status", "--porcelain", cwd=grafted.root), "")
+		self.assertFalse(os.path.exists(os.path.join(grafted.root, "sys-apps/foobar/foobar-0.9.ebuild")))
+		with open(os.path.join(grafted.root, "sys-apps/foobar/files/foobar.patch"), "r") as f:
+			self.assertEqual(f.read(), "sys-apps/foobar/files/foobar.patch\n")
+		for path in [ "licenses", "sys-apps/foobar" ]:
+			self.assertEqual(self.git("rev-parse", "HEAD:" + path, cwd=grafted.root), self.git("rev-parse", "HEAD:" + path, cwd=self.srctree.root))
+
+	def test_source_removed(self):
+
+		# grafted blobs are copied into the kit's own repository, so it doesn't need the source repo afterwards:
+		grafted = self.build_kit("graft-kit", graft=True)
+		self.assertFalse(os.path.exists(os.path.join(grafted.root, ".git/objects/info/alternates")))
+		shutil.rmtree(self.srctree.root)
+		self.git("fsck", "--full", "--strict", cwd=grafted.root)
+		self.assertEqual(self.git("show", "HEAD:sys-apps/foobar/files/foobar.patch", cwd=grafted.root), "sys-apps/foobar/files/foobar.patch\n")
+
+	def test_copy_check_fails(self):
+
+		# if we can't tell which objects are missing, we must not carry on as if none were:
+		tree = self.build_kit("graft-kit", graft=True)
+		blob = self.git("rev-parse", "HEAD:licenses/MIT", cwd=self.srctree.root).strip()
+		shutil.rmtree(os.path.join(tree.root, ".git"))
+		with self.assertRaises(GitTreeError):
+			self.loop.run_until_complete(tree.copyObjects(self.srctree, [ blob ]))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+
+import os, sys
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.merge_utils import GitTree, CleanTree, InsertEbuilds
+from fixtures import GitTestCase, placeholder_files
+
+class IncrementalTest(GitTestCase):
+
+	def setUp(self):
+
+		super().setUp()
+		upstream = self.make_upstream("source", placeholder_files([ "profiles/categories", "sys-apps/foobar/foobar-1.0.ebuild",
+																	 "dev-libs/oni/oni-1.0.ebuild", "dev-libs/oni/files/oni.patch", "dev-libs/gone/gone-1.0.ebuild" ]))
+		self.srctree = GitTree("source", "master", config=self.config, url=upstream, root=os.path.join(self.config.source_trees, "source"))
+		self.loop.run_until_complete(self.srctree.initialize())
+
+	def generate(self, tree):
+		self.loop.run_until_complete(tree.run([
+			CleanTree(),
+			InsertEbuilds(self.srctree, select="all")
+		]))
+		self.loop.run_until_complete(tree.gitCommit(message="updates", push=False))
+
+	def test_incremental_matches_full(self):
+
+		upstream = self.make_upstream("foo-kit", placeholder_files([ "README" ]))
+		tree = GitTree("foo-kit", "master", config=self.config, url=upstream, root=os.path.join(self.config.dest_trees, "foo-kit"), incremental=True)
+		self.loop.run_until_complete(tree.initialize())
+		self.generate(tree)
+		os.makedirs(os.path.join(tree.root, "metadata/md5-cache/dev-libs"))
+		with open(os.path.join(tree.root, "metadata/md5-cache/dev-libs/oni-1.0"), "w") as f:
+			f.write("EAPI=6\n")
+		tree.journal("metadata/md5-cache")
+		self.loop.run_until_complete(tree.gitCommit(message="metadata", push=False))
+		oni = os.stat(os.path.join(tree.root, "dev-libs/oni/oni-1.0.ebuild"))
+
+		# update the source repo, then generate the kit again:
+		with open(os.path.join(self.srctree.root, "sys-apps/foobar/foobar-1.0.ebuild"), "w") as f:
+			f.write("EAPI=7\n")
+		self.git("rm", "--quiet", "-r", "dev-libs/gone", cwd=self.srctree.root)
+		self.git("commit", "--quiet", "-a", "-m", "updates", cwd=self.srctree.root)
+		self.srctree.invalidateRefs()
+		self.srctree.invalidateIndex()
+		self.generate(tree)
+
+		full = GitTree("full-kit", "master", config=self.config, url=upstream, root=os.path.join(self.config.dest_trees, "full-kit"))
+		self.loop.run_until_complete(full.initialize())
+		self.generate(full)
+		for path in [ "sys-apps", "dev-libs" ]:
+			self.assertEqual(self.git("rev-parse", "HEAD:" + path, cwd=tree.root), self.git("rev-parse", "HEAD:" + path, cwd=full.root))
+		self.assertEqual(self.git("status", "--porcelain", cwd=tree.root), "")
+		self.assertFalse(os.path.exists(tree.previousDir()))
+		# the unchanged catpkg was moved back rather than copied, and the metadata cache was kept for GenCache to update:
+		self.assertEqual(os.stat(os.path.join(tree.root, "dev-libs/oni/oni-1.0.ebuild")).st_ino, oni.st_ino)
+		self.assertTrue(os.path.exists(os.path.join(tree.root, "metadata/md5-cache/dev-libs/oni-1.0")))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+import os, sys
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.merge_utils import GitTree, MergeStep, CleanTree, GenerateRepoMetadata, Minify
+from fixtures import GitTestCase
+
+class WriteStray(MergeStep):
+
+	# not journaled -- we don't tell the tree what we write:
+	async def run(self, tree):
+		with open(os.path.join(tree.root, "stray"), "w") as f:
+			f.write("stray\n")
+
+class JournalTest(GitTestCase):
+
+	def setUp(self):
+
+		super().setUp()
+		upstream = self.make_upstream("foo-kit", {
+			"sys-apps/foobar/Manifest": "DIST foobar-1.0.tar.gz 100 SHA512 abc\nEBUILD foobar-1.0.ebuild 10 SHA512 def\n",
+			"sys-apps/foobar/ChangeLog": ""
+		})
+		self.tree = GitTree("foo-kit", "master", config=self.config, url=upstream, root=os.path.join(self.config.dest_trees, "foo-kit"))
+		self.loop.run_until_complete(self.tree.initialize())
+
+	def committed_files(self):
+		return self.git("ls-tree", "-r", "--name-only", "HEAD", cwd=self.tree.root).split()
+
+	def test_journaled_commit(self):
+
+		self.loop.run_until_complete(self.tree.run([ GenerateRepoMetadata("foo-kit"), Minify() ]))
+		self.assertEqual(self.tree._journal, { "metadata/layout.conf", "profiles/repo_name", "sys-apps/foobar/ChangeLog", "sys-apps/foobar/Manifest" })
+		# written behind the journal's back, so it won't be committed:
+		open(os.path.join(self.tree.root, "untracked"), "w").close()
+		self.loop.run_until_complete(self.tree.gitCommit(message="updates", push=False))
+		self.assertEqual(self.committed_files(), [ "metadata/layout.conf", "profiles/repo_name", "sys-apps/foobar/Manifest" ])
+		self.assertEqual(self.git("show", "HEAD:sys-apps/foobar/Manifest", cwd=self.tree.root), "DIST foobar-1.0.tar.gz 100 SHA512 abc\n")
+		self.assertEqual(self.tree._journal, set())
+
+		# CleanTree journals what it removes separately, so only what is written again afterwards is staged, and the rest
+		# is committed as deleted:
+		self.loop.run_until_complete(self.tree.run([ CleanTree(), GenerateRepoMetadata("foo-kit", aliases=[ "foo" ]) ]))
+		self.assertEqual(self.tree._journal, { "metadata/layout.conf", "profiles/repo_name" })
+		self.assertEqual(self.tree._removed, { "metadata", "profiles", "sys-apps", "untracked" })
+		self.loop.run_until_complete(self.tree.gitCommit(message="updates", push=False))
+		self.assertEqual(self.committed_files(), [ "metadata/layout.conf", "profiles/repo_name" ])
+		self.assertIn("aliases = foo", self.git("show", "HEAD:metadata/layout.conf", cwd=self.tree.root))
+		self.assertEqual(self.git("status", "--porcelain", cwd=self.tree.root), "")
+
+		self.loop.run_until_complete(self.tree.run([ CleanTree() ]))
+		self.loop.run_until_complete(self.tree.gitCommit(message="updates", push=False))
+		self.assertEqual(self.committed_files(), [])
+
+	def test_unjournaled_step(self):
+
+		self.loop.run_until_complete(self.tree.run([ WriteStray() ]))
+		self.assertIsNone(self.tree._journal)
+		self.loop.run_until_complete(self.tree.gitCommit(message="updates", push=False))
+		self.assertIn("stray", self.committed_files())
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+import hashlib
+import os, sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.md5cache import MetadataTable, kit_metadata, load_table, parse_licenses
+from merge.portdb_pool import affects_metadata
+from merge.tree_index import TreeIndex
+
+def md5(data):
+	return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+class Md5CacheTest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.root = tempfile.mkdtemp()
+		self.tree = os.path.join(self.root, "foo-kit")
+		self.core_kit = os.path.join(self.root, "core-kit")
+		self.files = {}
+		self.write(self.core_kit, "eclass/eutils.eclass", "# eutils\n")
+		self.write(self.core_kit, "eclass/python-single-r1.eclass", "# core-kit's python-single-r1\n")
+		self.write(self.tree, "eclass/python-single-r1.eclass", "# our python-single-r1\n")
+		for cpv in [ "dev-python/foo-1.0", "dev-python/foo-1.1", "dev-libs/bar-2", "dev-libs/oni-1" ]:
+			cat, pf = cpv.split("/")
+			self.write(self.tree, "%s/%s/%s.ebuild" % (cat, pf.rsplit("-", 1)[0], pf), "EAPI=6 # %s\n" % cpv)
+
+	def tearDown(self):
+
+		shutil.rmtree(self.root)
+
+	def write(self, root, path, content):
+		os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+		with open(os.path.join(root, path), "w") as f:
+			f.write(content)
+		self.files[os.path.join(root, path)] = content
+
+	def entry(self, cpv, ebuild, eclasses, **values):
+		cat, pf = cpv.split("/")
+		lines = [ "%s=%s" % (key, value) for key, value in sorted(values.items()) ]
+		lines.append("_eclasses_=" + "\t".join("%s\t%s" % (eclass, md5(self.files[path])) for eclass, path in eclasses))
+		lines.append("_md5_=" + md5(self.files[os.path.join(self.tree, ebuild)]))
+		self.write(self.tree, "metadata/md5-cache/%s/%s" % (cat, pf), "\n".join(lines) + "\n")
+
+	def test_load(self):
+
+		ours = os.path.join(self.tree, "eclass/python-single-r1.eclass")
+		eutils = os.path.join(self.core_kit, "eclass/eutils.eclass")
+		self.entry("dev-python/foo-1.0", "dev-python/foo/foo-1.0.ebuild", [ ("eutils", eutils), ("python-single-r1", ours) ], LICENSE="|| ( MIT BSD )", SRC_URI="mirror://foo/foo-1.0.tar.gz")
+		self.entry("dev-python/foo-1.1", "dev-python/foo/foo-1.1.ebuild", [ ("python-single-r1", ours) ], LICENSE="MIT")
+		# generated against core-kit's python-single-r1, which ours overrides:
+		self.entry("dev-libs/bar-2", "dev-libs/bar/bar-2.ebuild", [ ("python-single-r1", os.path.join(self.core_kit, "eclass/python-single-r1.eclass")) ])
+		self.entry("dev-libs/oni-1", "dev-libs/oni/oni-1.ebuild", [])
+		# the ebuild changed since its entry was generated:
+		self.write(self.tree, "dev-libs/oni/oni-1.ebuild", "EAPI=7\n")
+
+		table, stale = load_table(self.tree, TreeIndex.scan(self.tree), [ os.path.join(self.tree, "eclass"), os.path.join(self.core_kit, "eclass") ], [ os.path.join(self.tree, "metadata/md5-cache") ], jobs=2)
+		self.assertEqual(stale, [ ("dev-libs/bar", "dev-libs/bar-2"), ("dev-libs/oni", "dev-libs/oni-1") ])
+		self.assertEqual(table.cpvs, [ "dev-libs/bar-2", "dev-libs/oni-1", "dev-python/foo-1.0", "dev-python/foo-1.1" ])
+		self.assertEqual(table.get("dev-python/foo-1.0", [ "INHERITED", "LICENSE", "SRC_URI", "RESTRICT" ]), [ "eutils python-single-r1", "|| ( MIT BSD )", "mirror://foo/foo-1.0.tar.gz", "" ])
+		self.assertEqual(list(table.column("LICENSE", "dev-python/foo")), [ ("dev-python/foo-1.0", "|| ( MIT BSD )"), ("dev-python/foo-1.1", "MIT") ])
+		self.assertEqual(table.get("dev-libs/bar-2", [ "INHERITED", "LICENSE" ]), [ "", "" ])
+
+		# stale entries are filled in from elsewhere (portage, in tree_metadata()):
+		table.add("dev-libs/oni", "dev-libs/oni-1", { "INHERITED" : "python-single-r1 eutils" })
+		self.assertEqual(table.get("dev-libs/oni-1", [ "INHERITED" ]), [ "python-single-r1 eutils" ])
+		self.assertEqual(len(table), 4)
+
+	def test_kit_metadata(self):
+
+		self.assertEqual(parse_licenses("GPL-2 || ( MIT BSD ) ssl? ( openssl !libressl? ( GPL-2 ) )"), [ "GPL-2", "MIT", "BSD", "openssl" ])
+		for bad in [ "GPL-2 )", "ssl? GPL-2", "|| ( MIT", "ssl?" ]:
+			self.assertRaises(ValueError, parse_licenses, bad)
+		table = MetadataTable(self.tree)
+		table.add("dev-python/foo", "dev-python/foo-1.0", { "INHERITED" : "eutils python-single-r1", "LICENSE" : "|| ( MIT BSD )" })
+		table.add("dev-libs/bar", "dev-libs/bar-2", { "INHERITED" : "eutils", "LICENSE" : "GPL-2 )" })
+		meta = kit_metadata(table)
+		self.assertEqual((meta.eclasses, meta.licenses), ({ "eutils", "python-single-r1" }, { "MIT", "BSD", "GPL-2" }))
+		self.assertEqual(meta.cpv_licenses["dev-python/foo-1.0"], ( "MIT", "BSD" ))
+		# collected once, until the table changes:
+		self.assertIs(kit_metadata(table), meta)
+		table.add("dev-libs/bar", "dev-libs/bar-2", { "INHERITED" : "eutils" })
+		self.assertEqual(kit_metadata(table).licenses, { "MIT", "BSD" })
+
+		# only steps that can change ebuild metadata make us collect it again:
+		self.assertFalse(affects_metadata([ "eclass/ELT-patches", "profiles/use.local.desc", "@manifests", "metadata/md5-cache", "licenses" ]))
+		for writes in [ None, [ "@ebuilds" ], [ "eclass" ], [ "eclass/eutils.eclass" ], [ "dev-libs/oni" ], [ "metadata/layout.conf" ] ]:
+			self.assertTrue(affects_metadata(writes), writes)
+
+if __name__ == "__main__":
+	unittest.main()
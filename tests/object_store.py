@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+import asyncio
+import os, sys
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.merge_utils import GitTree
+from fixtures import GitTestCase, MockConfig
+
+class ObjectStoreTest(GitTestCase):
+
+	def setUp(self):
+
+		super().setUp()
+		self.upstream = self.make_upstream("foo-kit", dict(("sys-apps/foobar/foobar-1.%s.ebuild" % ver, "# foobar %s\n" % ver * 100) for ver in range(0, 20)))
+		self.store = os.path.join(self.root, "objects.git")
+		self.config = MockConfig(self.root, object_store=self.store)
+
+	def local_object_count(self, repo_root):
+		counts = {}
+		for line in self.git("count-objects", "-v", cwd=repo_root).splitlines():
+			key, val = line.split(":", 1)
+			if key in [ "count", "in-pack" ]:
+				counts[key] = int(val)
+		return counts["count"] + counts["in-pack"]
+
+	def make_tree(self, name, reclone=False):
+		# we use a file:// URL so git uses its regular transport rather than copying the object directory of a local path:
+		tree = GitTree(name, "master", config=self.config, url="file://" + self.upstream, root=os.path.join(self.config.dest_trees, name),
+					   reclone=reclone)
+		asyncio.get_event_loop().run_until_complete(tree.initialize())
+		return tree
+
+	def test_clone_uses_object_store(self):
+
+		tree = self.make_tree("foo-kit")
+		with open(os.path.join(tree.root, ".git/objects/info/alternates"), "r") as f:
+			self.assertIn(os.path.join(self.store, "objects"), f.read())
+		self.assertEqual(self.local_object_count(tree.root), 0)
+		self.assertEqual(tree.head(), self.git("rev-parse", "refs/remotes/foo-kit/master", cwd=self.store).strip())
+
+	def test_reclone_uses_object_store(self):
+
+		self.make_tree("foo-kit")
+		tree = self.make_tree("foo-kit", reclone=True)
+		self.assertEqual(self.local_object_count(tree.root), 0)
+		self.assertTrue(os.path.exists(os.path.join(tree.root, "sys-apps/foobar/foobar-1.19.ebuild")))
+
+if __name__ == "__main__":
+	unittest.main()
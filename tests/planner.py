@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+import asyncio
+import os, sys
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.merge_utils import GitTree, CatPkgMatchLogger, copyFromFixupsSteps, copyFromSourceRepositoriesSteps, getPlannedSourceInstances, startKit
+from merge.planner import KitPlan, check_claims, diff_assignments, generate_release, new_claims, plan_assignment, plan_kit, read_assignment, write_assignment
+from fixtures import GitTestCase
+
+class MockFoundation():
+
+	def __init__(self, repos):
+		self.kit_source_defs = { "test-sources": [ { "repo": repo_dict["name"] } for repo_dict in repos ] }
+		self.overlays = dict((repo_dict["name"], { "url": repo_dict["repo"].url }) for repo_dict in repos)
+
+class PlannerTest(GitTestCase):
+
+	def setUp(self):
+
+		super().setUp()
+		self.fixup_repo = self.source_tree("kit-fixups", {
+			"package-sets/global/foo-kit-packages": "sys-apps/*\ndev-libs/shared\n",
+			"package-sets/global/bar-kit-packages": "dev-libs/*\napp-misc/old -> app-misc/new\n",
+			"bar-kit/global/dev-libs/fixed/fixed-1.0.ebuild": "fixup\n",
+			"bar-kit/next/dev-libs/nextonly/nextonly-1.0.ebuild": "fixup\n"
+		})
+		gentoo = self.source_tree("gentoo-staging", {
+			"profiles/categories": "sys-apps\ndev-libs\napp-misc\n",
+			"sys-apps/a/a-1.0.ebuild": "a\n",
+			"sys-apps/b/b-1.0.ebuild": "b\n",
+			"dev-libs/shared/shared-1.0.ebuild": "shared\n",
+			"dev-libs/x/x-1.0.ebuild": "gentoo x\n",
+			"dev-libs/fixed/fixed-0.9.ebuild": "unfixed\n",
+			"app-misc/old/old-1.0.ebuild": "old\n",
+			"app-misc/rest/rest-1.0.ebuild": "rest\n"
+		})
+		other = self.source_tree("other", {
+			"dev-libs/x/x-2.0.ebuild": "other x\n",
+			"dev-libs/y/y-1.0.ebuild": "y\n"
+		})
+		self.repos = [
+			{ "name": "gentoo-staging", "repo": gentoo, "overlay_def": {} },
+			{ "name": "other", "repo": other, "overlay_def": {} }
+		]
+		self.kits = [ { "name": "foo-kit", "branch": "master" }, { "name": "bar-kit", "branch": "master" },
+					  { "name": "bar-kit", "branch": "next" }, { "name": "nokit", "branch": "master" } ]
+
+	def source_tree(self, name, files):
+		tree = GitTree(name, "master", config=self.config, url=self.make_upstream(name, files), root=os.path.join(self.config.source_trees, name))
+		self.loop.run_until_complete(tree.initialize())
+		return tree
+
+	async def generate_kit(self, kit_dict, repos, cpm_logger, secondary_kit, prefix):
+		# the part of updateKit() that depends on the source repos and cpm_logger:
+		name = "%s-%s-%s" % (prefix, kit_dict["name"], kit_dict["branch"])
+		tree = GitTree(kit_dict["name"], kit_dict["branch"], config=self.config, url=self.make_upstream(name, {}), root=os.path.join(self.config.dest_trees, name))
+		await tree.initialize()
+		for repo_dict in repos:
+			steps = await copyFromSourceRepositoriesSteps(repo_dict=repo_dict, kit_dict=kit_dict, source_defs=repos, release="1.4-release",
+														  secondary_kit=secondary_kit, fixup_repo=self.fixup_repo, cpm_logger=cpm_logger, move_maps={})
+			await tree.run(steps)
+		await tree.run(copyFromFixupsSteps(release="1.4-release", fixup_repo=self.fixup_repo, branch=kit_dict["branch"], kit_dict=kit_dict, cpm_logger=cpm_logger))
+		await tree.gitCommit(message="updates", push=False)
+		return tree
+
+	def generate(self, kit_dict, cpm_logger, secondary_kit, prefix):
+		tree = self.loop.run_until_complete(self.generate_kit(kit_dict, self.repos, cpm_logger, secondary_kit, prefix))
+		return self.git("rev-parse", "HEAD^{tree}", cwd=tree.root).strip()
+
+	def plan_kits(self, kits):
+		cpm_logger = CatPkgMatchLogger()
+		plans = []
+		prev_kit_dict = None
+		for kit_dict in kits:
+			plan = KitPlan(kit_dict, "1.4-release")
+			plan.secondary_kit = startKit(cpm_logger, kit_dict, prev_kit_dict)
+			plans.append(self.loop.run_until_complete(plan_kit(plan, "1.4-release", self.repos, self.fixup_repo, cpm_logger, move_maps={})))
+			prev_kit_dict = kit_dict
+		return plans
+
+	def test_planned_matches_serial(self):
+
+		# the serial way, like merge-all-kits without --jobs:
+		cpm_logger = CatPkgMatchLogger()
+		serial = {}
+		prev_kit_dict = None
+		for kit_dict in self.kits:
+			secondary_kit = startKit(cpm_logger, kit_dict, prev_kit_dict)
+			serial["%s/%s" % (kit_dict["name"], kit_dict["branch"])] = self.generate(kit_dict, cpm_logger, secondary_kit, "serial")
+			prev_kit_dict = kit_dict
+		logger_path = os.path.join(self.config.cache_dir, "match-logger", "1.4-release.json.gz")
+		cpm_logger.save(logger_path)
+
+		plans = self.plan_kits(self.kits)
+		self.assertEqual(sorted(plans[1].copies.keys()), [ "app-misc/new", "dev-libs/fixed", "dev-libs/x", "dev-libs/y" ])
+		self.assertEqual(plans[1].copies["app-misc/new"], ("gentoo-staging", "app-misc/old"))
+		self.assertEqual(plans[1].copies["dev-libs/fixed"], ("kit-fixups", "dev-libs/fixed"))
+		self.assertEqual(sorted(plans[3].copies.keys()), [ "app-misc/rest" ])
+
+		# generate from the plans in reverse order, so no kit can depend on the kits before it having been generated:
+		for pos in reversed(range(0, len(plans))):
+			plan = plans[pos]
+			kit_logger = CatPkgMatchLogger()
+			kit_logger.restore(plan.logger_state)
+			self.assertEqual(self.generate(plan.kit_dict, kit_logger, plan.secondary_kit, "planned"), serial[plan.key])
+			# the logger saved by the serial run can be loaded in the state it was in right before this kit, too:
+			loaded = CatPkgMatchLogger.load(logger_path, until=plan.key)
+			self.assertEqual(startKit(loaded, plan.kit_dict, self.kits[pos - 1] if pos > 0 else None), plan.secondary_kit)
+			self.assertEqual(loaded.snapshot(), plan.logger_state)
+			claims = new_claims(plan.logger_state, kit_logger)
+			self.assertEqual(claims, plan.claims)
+			check_claims(plans, pos, claims)
+
+	def test_assignment_diff(self):
+
+		plans = self.plan_kits(self.kits)
+		assignment = plan_assignment(plans)
+		self.assertEqual(assignment["catpkgs"]["app-misc/new"], [ "bar-kit/master (gentoo-staging:app-misc/old)", "bar-kit/next (gentoo-staging:app-misc/old)" ])
+		self.assertEqual(assignment["catpkgs"]["dev-libs/shared"], [ "foo-kit/master (gentoo-staging:dev-libs/shared)" ])
+		path = os.path.join(self.config.cache_dir, "plans", "1.4-release.json")
+		write_assignment(path, assignment)
+		self.assertEqual(read_assignment(path), assignment)
+		self.assertEqual(diff_assignments(assignment, read_assignment(path)), [])
+
+		# drop the next branch of bar-kit, and move dev-libs/shared to bar-kit:
+		plans[0].copies.pop("dev-libs/shared")
+		plans[1].copies["dev-libs/shared"] = ("gentoo-staging", "dev-libs/shared")
+		self.assertEqual(diff_assignments(assignment, plan_assignment(plans[:2] + plans[3:])), [
+			"~ app-misc/new: bar-kit/master (gentoo-staging:app-misc/old), bar-kit/next (gentoo-staging:app-misc/old) -> bar-kit/master (gentoo-staging:app-misc/old)",
+			"~ dev-libs/fixed: bar-kit/master (kit-fixups:dev-libs/fixed), bar-kit/next (kit-fixups:dev-libs/fixed) -> bar-kit/master (kit-fixups:dev-libs/fixed)",
+			"- dev-libs/nextonly: bar-kit/next (kit-fixups:dev-libs/nextonly)",
+			"~ dev-libs/shared: foo-kit/master (gentoo-staging:dev-libs/shared) -> bar-kit/master (gentoo-staging:dev-libs/shared)",
+			"~ dev-libs/x: bar-kit/master (gentoo-staging:dev-libs/x), bar-kit/next (gentoo-staging:dev-libs/x) -> bar-kit/master (gentoo-staging:dev-libs/x)",
+			"~ dev-libs/y: bar-kit/master (other:dev-libs/y), bar-kit/next (other:dev-libs/y) -> bar-kit/master (other:dev-libs/y)"
+		])
+
+	def test_generate_release(self):
+
+		running = set()
+		overlaps = []
+
+		def plan(name, branch, sources):
+			p = KitPlan({ "name": name, "branch": branch }, "1.4-release")
+			p.sources = sources
+			return p
+
+		async def generate(p):
+			overlaps.extend((p.key, other) for other in running)
+			running.add(p.key)
+			await asyncio.sleep(0.01)
+			running.discard(p.key)
+			return p.key + "-sha1", set()
+
+		plans = [ plan("core-kit", "master", [ ("gentoo", "/gentoo", "A") ]), plan("foo-kit", "master", [ ("gentoo", "/gentoo", "A") ]),
+				  plan("foo-kit", "next", [ ("gentoo", "/gentoo", "A") ]), plan("bar-kit", "master", [ ("gentoo", "/gentoo", "A") ]),
+				  plan("oni-kit", "master", [ ("gentoo", "/gentoo", "B") ]) ]
+		heads = self.loop.run_until_complete(generate_release(plans, generate, jobs=4))
+		self.assertEqual(heads["oni-kit/master"], "oni-kit/master-sha1")
+		# only foo-kit/master (or foo-kit/next) and bar-kit/master, which share a source commit, ran together:
+		self.assertEqual(len(overlaps), 1)
+		self.assertIn("bar-kit/master", overlaps[0])
+
+	def test_generate_release_kits(self):
+
+		kits = [ dict(kit_dict, source="test-sources") for kit_dict in self.kits ]
+		cpm_logger = CatPkgMatchLogger()
+		serial = {}
+		prev_kit_dict = None
+		for kit_dict in kits:
+			secondary_kit = startKit(cpm_logger, kit_dict, prev_kit_dict)
+			serial["%s/%s" % (kit_dict["name"], kit_dict["branch"])] = self.generate(kit_dict, cpm_logger, secondary_kit, "serial")
+			prev_kit_dict = kit_dict
+		plans = self.plan_kits(kits)
+
+		# gentoo-staging moves on after planning. Source repos are initialized again for generation, which merges their
+		# upstream branch, so the kits must be generated from the planned commit rather than the new one:
+		work = os.path.join(self.root, "work", "gentoo-staging")
+		with open(os.path.join(work, "dev-libs/x/x-1.0.ebuild"), "w") as f:
+			f.write("changed x\n")
+		self.git("commit", "--quiet", "-a", "-m", "change x", cwd=work)
+		self.git("push", "--quiet", "origin", "master", cwd=work)
+		self.loop.run_until_complete(self.repos[0]["repo"].gitFetch(force=True))
+
+		foundation = MockFoundation(self.repos)
+		roots = {}
+
+		async def generate(plan):
+			kit_logger = CatPkgMatchLogger()
+			kit_logger.restore(plan.logger_state)
+			repos = await getPlannedSourceInstances(foundation, self.config, plan)
+			tree = await self.generate_kit(plan.kit_dict, repos, kit_logger, plan.secondary_kit, "concurrent")
+			roots[plan.key] = tree.root
+			return tree.head(), new_claims(plan.logger_state, kit_logger)
+
+		heads = self.loop.run_until_complete(generate_release(plans, generate, jobs=3))
+		for plan in plans:
+			self.assertEqual(self.git("rev-parse", heads[plan.key] + "^{tree}", cwd=roots[plan.key]).strip(), serial[plan.key], plan.key)
+
+if __name__ == "__main__":
+	unittest.main()
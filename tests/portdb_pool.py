@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.merge_utils import Tree
+from merge.portdb_pool import PortDBPool
+from fixtures import MockConfig
+
+class MockPortDB():
+
+	def __init__(self, env):
+		self.env = env
+		self.frozen = False
+		self.melted = 0
+
+	def freeze(self):
+		self.frozen = True
+
+	def melt(self):
+		self.frozen = False
+		self.melted += 1
+
+class MockTree(Tree):
+
+	def __init__(self, name, root, config):
+		self.name = name
+		self.root = root
+		self.config = config
+
+class PortDBPoolTest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.root = tempfile.mkdtemp()
+		self.config = MockConfig(self.root)
+		self.core_kit = MockTree("core-kit", os.path.join(self.config.dest_trees, "core-kit"), self.config)
+		self.foo_kit = MockTree("foo-kit", os.path.join(self.config.dest_trees, "foo-kit"), self.config)
+
+	def tearDown(self):
+
+		shutil.rmtree(self.root)
+
+	def test_pool(self):
+
+		pool = PortDBPool(size=2, factory=MockPortDB)
+		p = pool.get(self.foo_kit)
+		self.assertTrue(p.frozen)
+		self.assertIn("location = %s\n" % self.foo_kit.root, p.env["PORTAGE_REPOSITORIES"])
+		self.assertIs(pool.get(self.foo_kit), p)
+		# different settings get their own portdbapi:
+		self.assertEqual(pool.get(self.foo_kit, accept_keywords="~amd64 amd64").env["ACCEPT_KEYWORDS"], "~amd64 amd64")
+		self.assertEqual((pool.built, pool.reused, pool.refreshed), (2, 1, 0))
+
+		# changes to the kit, or to core-kit, its master repository, clear the xmatch cache:
+		self.foo_kit.invalidateIndex([ "@manifests" ])
+		self.assertIs(pool.get(self.foo_kit), p)
+		self.core_kit.invalidateIndex([ "licenses" ])
+		self.assertIs(pool.get(self.foo_kit), p)
+		self.assertEqual((p.melted, p.frozen), (2, True))
+		self.assertEqual((pool.built, pool.reused, pool.refreshed), (2, 1, 2))
+
+		# but portage only reads eclasses, categories and masks once, so changes to them (or checking out another
+		# branch) need a new portdbapi:
+		for tree, writes in [ (self.foo_kit, [ "eclass/foo.eclass" ]), (self.core_kit, [ "profiles/categories" ]), (self.foo_kit, None) ]:
+			tree.invalidateIndex(writes)
+			new_p = pool.get(self.foo_kit)
+			self.assertIsNot(new_p, p)
+			p = new_p
+		self.assertEqual((pool.built, pool.rebuilt, pool.refreshed), (5, 3, 2))
+
+		# the least recently used one is dropped when the pool is full:
+		self.assertNotIn("[foo-kit]", pool.get(self.core_kit).env["PORTAGE_REPOSITORIES"])
+		self.assertIsNot(pool.get(self.foo_kit, accept_keywords="~amd64 amd64"), p)
+		self.assertEqual(pool.built, 7)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+
+import asyncio
+import os, sys
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.push_scheduler import PushScheduler, PushError
+from merge.merge_utils import GitTree
+from fixtures import GitTestCase
+
+class PushSchedulerTest(GitTestCase):
+
+	def test_push_to_bare_remotes(self):
+
+		scheduler = PushScheduler(jobs=2, backoff=0)
+		trees = []
+		for name in [ "foo-kit", "bar-kit", "oni-kit" ]:
+			upstream = self.make_upstream(name, {})
+			tree = GitTree(name, "master", config=self.config, url=upstream, root=os.path.join(self.config.dest_trees, name))
+			self.loop.run_until_complete(tree.initialize())
+			trees.append((tree, upstream))
+		for commit in range(0, 2):
+			for tree, upstream in trees:
+				with open(os.path.join(tree.root, "README"), "w") as f:
+					f.write("commit %s\n" % commit)
+				tree.journal("README")
+				self.loop.run_until_complete(tree.gitCommit(message="updates", push=True, push_scheduler=scheduler))
+		self.loop.run_until_complete(scheduler.barrier())
+		for tree, upstream in trees:
+			self.assertEqual(self.git("rev-parse", "refs/heads/master", cwd=upstream).strip(), tree.head())
+
+	def test_coalesce_and_retry(self):
+
+		scheduler = PushScheduler(jobs=1, retries=2, backoff=0)
+		calls = []
+
+		def make_push(key, results):
+			async def push():
+				calls.append(key)
+				await asyncio.sleep(0)
+				return results.pop(0)
+			return push
+
+		# "a" runs first, so the three later pushes of "b" coalesce into one while they wait:
+		scheduler.schedule("a", make_push("a", [ False, True ]))
+		for attempt in range(0, 3):
+			scheduler.schedule("b", make_push("b%s" % attempt, [ True ]))
+		scheduler.schedule("c", make_push("c", [ False, False, False ]))
+		with self.assertRaises(PushError):
+			self.loop.run_until_complete(scheduler.barrier())
+		self.assertEqual(calls, [ "a", "a", "b2", "c", "c", "c" ])
+		self.assertEqual(scheduler.coalesced_count, 2)
+
+if __name__ == "__main__":
+	unittest.main()
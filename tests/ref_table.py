@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+import os, sys
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.merge_utils import GitTree
+from fixtures import GitTestCase
+
+class RefTableTest(GitTestCase):
+
+	def setUp(self):
+
+		super().setUp()
+		self.upstream = self.make_upstream("foo-kit", { "README": "master\n" })
+		self.work = os.path.join(self.root, "work", "foo-kit")
+		self.git("checkout", "--quiet", "-b", "next", cwd=self.work)
+		self.upstream_commit("README", "next\n")
+		self.tree = self.make_tree()
+
+	def make_tree(self):
+		tree = GitTree("foo-kit", "master", config=self.config, url=self.upstream, root=os.path.join(self.config.dest_trees, "foo-kit"))
+		self.loop.run_until_complete(tree.initialize())
+		return tree
+
+	def upstream_commit(self, path, content):
+		# commit to the current branch of our clone of upstream, and push it:
+		with open(os.path.join(self.work, path), "w") as f:
+			f.write(content)
+		self.git("commit", "--quiet", "-a", "-m", "update %s" % path, cwd=self.work)
+		branch = self.git("symbolic-ref", "--short", "HEAD", cwd=self.work).strip()
+		self.git("push", "--quiet", "origin", branch, cwd=self.work)
+		return self.git("rev-parse", "HEAD", cwd=self.work).strip()
+
+	def expected_refs(self, tree):
+		# what git itself thinks our refs are, in the form of the ref table:
+		refs = {}
+		for line in self.git("for-each-ref", "--format=%(objectname) %(refname)", cwd=tree.root).splitlines():
+			sha1, _, refname = line.partition(" ")
+			refs[refname] = sha1
+		refs["HEAD"] = self.git("rev-parse", "HEAD", cwd=tree.root).strip()
+		return refs
+
+	def commit(self, tree, path, content):
+		with open(os.path.join(tree.root, path), "w") as f:
+			f.write(content)
+		tree.journal(path)
+		self.loop.run_until_complete(tree.gitCommit(message="update %s" % path, push=False))
+
+	def test_checkout_and_commit(self):
+
+		self.assertEqual(self.tree._refTable(), self.expected_refs(self.tree))
+		self.assertEqual(self.tree.currentLocalBranch, "master")
+		self.assertEqual(self.tree.remoteBranches(), [ "origin/master", "origin/next" ])
+		self.loop.run_until_complete(self.tree.gitCheckout("next"))
+		self.assertEqual(self.tree.currentLocalBranch, "next")
+		self.assertEqual(self.tree._refTable(), self.expected_refs(self.tree))
+		self.commit(self.tree, "README", "local\n")
+		self.assertEqual(self.tree._refTable(), self.expected_refs(self.tree))
+		self.assertEqual(self.tree.head(), self.tree._refTable()["refs/heads/next"])
+		self.assertNotEqual(self.tree.head(), self.tree._refTable()["refs/remotes/origin/next"])
+
+	def test_fetch_and_merge(self):
+
+		sha1 = self.upstream_commit("README", "next, again\n")
+		self.assertTrue(self.loop.run_until_complete(self.tree.gitFetch(force=True)))
+		self.assertEqual(self.tree._refTable()["refs/remotes/origin/next"], sha1)
+		self.assertEqual(self.tree._refTable(), self.expected_refs(self.tree))
+		# checking out merges the fetched upstream branch:
+		self.loop.run_until_complete(self.tree.gitCheckout("next"))
+		self.assertEqual(self.tree.head(), sha1)
+		self.assertEqual(self.tree._refTable(), self.expected_refs(self.tree))
+
+	def test_detached_head(self):
+
+		master = self.tree.head()
+		self.loop.run_until_complete(self.tree.gitCheckout("next"))
+		self.git("checkout", "--quiet", "--detach", master, cwd=self.tree.root)
+		self.tree.invalidateRefs()
+		self.assertEqual(self.tree.head(), master)
+		self.assertIsNone(self.tree.currentLocalBranch)
+		self.assertEqual(self.tree._refTable(), self.expected_refs(self.tree))
+
+	def test_packed_refs(self):
+
+		self.git("pack-refs", "--all", cwd=self.tree.root)
+		self.assertFalse(os.path.exists(os.path.join(self.tree.root, ".git/refs/heads/master")))
+		self.tree.invalidateRefs()
+		self.assertEqual(self.tree.currentLocalBranch, "master")
+		self.assertEqual(self.tree._refTable(), self.expected_refs(self.tree))
+		self.assertTrue(self.tree.localBranchExists("next"))
+		self.assertTrue(self.tree.remoteBranchExists("next"))
+		self.commit(self.tree, "README", "local\n")
+		self.assertEqual(self.tree._refTable(), self.expected_refs(self.tree))
+
+	def test_second_tree_is_stale(self):
+
+		# a GitTree only notices changes made through it, so another GitTree on the same root keeps its table until it is
+		# told to reload it:
+		other = self.make_tree()
+		before = other.head()
+		self.commit(self.tree, "README", "local\n")
+		self.assertNotEqual(self.tree.head(), before)
+		self.assertEqual(other.head(), before)
+		self.assertEqual(other._refTable()["refs/heads/master"], before)
+		other.invalidateRefs()
+		self.assertEqual(other.head(), self.tree.head())
+		self.assertEqual(other._refTable(), self.expected_refs(other))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+import os, sys
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.step_graph import resources_overlap, step_dependencies
+
+class Step():
+
+	def __init__(self, reads=None, writes=None):
+		self.reads = reads
+		self.writes = writes
+
+class StepGraphTest(unittest.TestCase):
+
+	def test_overlap(self):
+
+		self.assertTrue(resources_overlap(None, []))
+		self.assertTrue(resources_overlap([ "profiles" ], [ "profiles/categories" ]))
+		self.assertTrue(resources_overlap([ "" ], [ "@ebuilds" ]))
+		self.assertFalse(resources_overlap([ "profiles/use.local.desc" ], [ "profiles/categories" ]))
+		self.assertFalse(resources_overlap([ "profiles/cat" ], [ "profiles/categories" ]))
+		self.assertFalse(resources_overlap([ "@ebuilds" ], [ "@manifests" ]))
+
+		# @ resources overlap the category and catpkg directories and files they could be in:
+		for path in [ "sys-apps", "sys-apps/foobar", "sys-apps/foobar/foobar-1.0.ebuild", "sys-apps/foobar/files", "sys-apps/foobar/files/fix/a.patch" ]:
+			self.assertTrue(resources_overlap([ "@ebuilds" ], [ path ]), path)
+			self.assertTrue(resources_overlap([ path ], [ "@ebuilds" ]), path)
+		self.assertTrue(resources_overlap([ "sys-apps/foobar/Manifest" ], [ "@manifests" ]))
+		self.assertTrue(resources_overlap([ "@manifests" ], [ "sys-apps/foobar/ChangeLog-2015" ]))
+		self.assertTrue(resources_overlap([ "@pkgmetadata" ], [ "profiles", "sys-apps/foobar/metadata.xml" ]))
+		for path in [ "sys-apps/foobar/metadata.xml", "sys-apps/foobar/foobar-1.0.ebuild/x", "sys-apps/foobar/Manifest", "profiles",
+					  "profiles/categories", "metadata/md5-cache", "eclass/eutils.eclass" ]:
+			self.assertFalse(resources_overlap([ "@ebuilds" ], [ path ]), path)
+
+	def test_dependencies(self):
+
+		steps = [
+			Step(),                                                               # 0: barrier
+			Step(reads=[], writes=[ "eclass/ELT-patches" ]),                      # 1
+			Step(reads=[ "@ebuilds", "eclass" ], writes=[ "profiles/a" ]),        # 2: like GenPythonUse
+			Step(reads=[ "@ebuilds", "eclass" ], writes=[ "profiles/b" ]),        # 3: like GenPythonUse
+			Step(reads=[ "@manifests" ], writes=[ "@manifests" ]),                # 4: like Minify
+			Step(reads=[ "@ebuilds", "profiles/a" ], writes=[ "metadata/md5-cache" ]), # 5
+			Step(reads=[ "@manifests", "metadata/md5-cache" ], writes=[]),        # 6: like FastPullScan
+			Step(),                                                               # 7: barrier
+			Step(reads=[], writes=[ "profiles/a" ])                               # 8
+		]
+		self.assertEqual(step_dependencies(steps), [ set(), { 0 }, { 0, 1 }, { 0, 1 }, { 0 }, { 0, 2 }, { 0, 4, 5 }, { 0, 1, 2, 3, 4, 5, 6 }, { 7 } ])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+import os, sys
+import shutil
+import subprocess
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.merge_utils import GitTree, MergeStep
+from merge.step_memo import StepMemo
+from fixtures import GitTestCase
+
+class CountEbuilds(MergeStep):
+
+	# writes a list of ebuilds, like a (very) small GenCache:
+	journaled = True
+	memoize = True
+	reads = [ "@ebuilds" ]
+	writes = [ "metadata/ebuild-list" ]
+	runs = 0
+
+	def __init__(self, header):
+		self.header = header
+
+	async def run(self, tree):
+		CountEbuilds.runs += 1
+		os.makedirs(os.path.join(tree.root, "metadata/ebuild-list"), exist_ok=True)
+		with open(os.path.join(tree.root, "metadata/ebuild-list/all"), "w") as f:
+			f.write(self.header + "\n")
+			for dirpath, dirnames, filenames in os.walk(tree.root):
+				f.writelines(name + "\n" for name in sorted(filenames) if name.endswith(".ebuild"))
+		tree.journal("metadata/ebuild-list")
+
+class StepMemoTest(GitTestCase):
+
+	def setUp(self):
+
+		super().setUp()
+		self.tree = GitTree("core-kit", "master", config=self.config, url=self.make_upstream("core-kit", {}), root=os.path.join(self.config.dest_trees, "core-kit"),
+							memo=StepMemo(os.path.join(self.config.cache_dir, "step-memo")))
+		self.loop.run_until_complete(self.tree.initialize())
+
+	def write(self, path, content):
+		path = os.path.join(self.tree.root, path)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w") as f:
+			f.write(content)
+		self.tree.journal(path)
+
+	def ebuild_list(self):
+		with open(os.path.join(self.tree.root, "metadata/ebuild-list/all")) as f:
+			return f.read().split()
+
+	def test_replay(self):
+
+		CountEbuilds.runs = 0
+		self.write("sys-apps/foobar/foobar-1.0.ebuild", "EAPI=6\n")
+		self.loop.run_until_complete(self.tree.run([ CountEbuilds("v1") ]))
+		self.assertEqual(CountEbuilds.runs, 1)
+
+		# things the step doesn't read don't matter, and its output is put back when it is replayed:
+		self.write("sys-apps/foobar/metadata.xml", "<pkgmetadata/>\n")
+		shutil.rmtree(os.path.join(self.tree.root, "metadata/ebuild-list"))
+		self.loop.run_until_complete(self.tree.run([ CountEbuilds("v1") ]))
+		self.assertEqual((CountEbuilds.runs, self.tree.memo.hits), (1, 1))
+		self.assertEqual(self.ebuild_list(), [ "v1", "foobar-1.0.ebuild" ])
+		self.loop.run_until_complete(self.tree.gitCommit(message="updates", push=False))
+		self.assertEqual(subprocess.run([ "git", "status", "--porcelain" ], cwd=self.tree.root, stdout=subprocess.PIPE).stdout, b"")
+
+		# but changes to step parameters or to what it reads do:
+		self.loop.run_until_complete(self.tree.run([ CountEbuilds("v2") ]))
+		self.write("sys-apps/foobar/foobar-1.1.ebuild", "EAPI=6\n")
+		self.loop.run_until_complete(self.tree.run([ CountEbuilds("v2") ]))
+		self.assertEqual(CountEbuilds.runs, 3)
+		self.assertEqual(self.ebuild_list(), [ "v2", "foobar-1.0.ebuild", "foobar-1.1.ebuild" ])
+
+	def test_digest(self):
+
+		digest = lambda resources: self.loop.run_until_complete(self.tree.contentDigest(resources))
+		# resources that match nothing yet are fine:
+		empty = digest([ "@ebuilds", "eclass" ])
+		self.write("sys-apps/foobar/foobar-1.0.ebuild", "EAPI=6\n")
+		first = digest([ "@ebuilds", "eclass" ])
+		self.assertNotEqual(first, empty)
+		# only what is read is staged and hashed:
+		self.write("sys-apps/foobar/metadata.xml", "<pkgmetadata/>\n")
+		self.write("profiles/categories", "sys-apps\n")
+		self.assertEqual(digest([ "@ebuilds", "eclass" ]), first)
+		self.assertNotEqual(digest([ "@ebuilds", "profiles" ]), first)
+		self.loop.run_until_complete(self.tree.gitCommit(message="updates", push=False))
+		self.assertEqual(digest([ "@ebuilds", "eclass" ]), first)
+		# removing a committed file counts as a change:
+		os.unlink(os.path.join(self.tree.root, "sys-apps/foobar/foobar-1.0.ebuild"))
+		self.assertEqual(digest([ "@ebuilds", "eclass" ]), empty)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+import asyncio
+import os, sys
+import time
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.tracing import Tracer, command_name
+
+class TracingTest(unittest.TestCase):
+
+	def test_command_name(self):
+
+		self.assertEqual(command_name("( cd /var/git/foo-kit && git fetch --verbose origin )"), "git fetch")
+		self.assertEqual(command_name([ "git", "--literal-pathspecs", "ls-tree", "-r" ]), "git ls-tree")
+		self.assertEqual(command_name([ "/usr/bin/rsync", "-a", "src/", "dest/" ]), "rsync")
+		self.assertEqual(command_name(""), "sh")
+
+	def test_lanes(self):
+
+		tracer = Tracer()
+		tracer.enabled = True
+
+		async def kit(name):
+			with tracer.lane(name), tracer.span(name, "kit"):
+				with tracer.span("InsertEbuilds", "step"):
+					await asyncio.sleep(0.01)
+				with tracer.subprocess([ "git", "commit" ]):
+					pass
+
+		loop = asyncio.get_event_loop()
+		loop.run_until_complete(asyncio.gather(kit("foo-kit/master"), kit("bar-kit/master")))
+		self.assertEqual(tracer.lanes(), [ "bar-kit/master", "foo-kit/master" ])
+		self.assertEqual(tracer.subprocess_count, 2)
+		for event in tracer.events:
+			if event["cat"] == "kit":
+				self.assertGreaterEqual(event["subprocesses"], 1)
+		trace = tracer.chrome_trace(lane="foo-kit/master")["traceEvents"]
+		self.assertEqual(sorted(event["name"] for event in trace if event["ph"] == "X"), [ "InsertEbuilds", "foo-kit/master", "git commit" ])
+		self.assertIn("InsertEbuilds", tracer.summary())
+
+		# when disabled, spans aren't recorded but subprocesses are still counted:
+		tracer.reset()
+		tracer.enabled = False
+		with tracer.subprocess("true"):
+			pass
+		self.assertEqual((tracer.events, tracer.subprocess_count), ([], 3))
+
+	def test_nested_totals(self):
+
+		tracer = Tracer()
+		tracer.enabled = True
+		# a kit finalized inside its kit span, as merge-all-kits does without --worktrees, and one finalized afterwards:
+		with tracer.lane("foo-kit/master"), tracer.span("foo-kit", "kit"):
+			time.sleep(0.02)
+			with tracer.span("finalize", "finalize"), tracer.span("GenCache", "step"), tracer.span("inner", "step"):
+				time.sleep(0.03)
+		with tracer.lane("bar-kit/master"):
+			with tracer.span("bar-kit", "kit"):
+				time.sleep(0.02)
+			with tracer.span("finalize", "finalize"):
+				time.sleep(0.03)
+		kits = tracer.totals([ "kit", "finalize" ], "lane")
+		wall = dict((event["lane"], event["wall"]) for event in tracer.events if event["cat"] == "kit")
+		self.assertEqual(kits["foo-kit/master"]["wall"], wall["foo-kit/master"])
+		self.assertGreater(kits["bar-kit/master"]["wall"], wall["bar-kit/master"] + 0.025)
+		kinds = tracer.totals(None, "cat")
+		self.assertLess(kinds["step"]["wall"], 0.045)
+		self.assertLess(kinds["kit"]["wall"], 0.1)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.tree_index import TreeIndex
+
+class TreeIndexTest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.root = tempfile.mkdtemp()
+		for path in [ "sys-apps/foobar/foobar-1.5.ebuild", "sys-apps/foobar/foobar-1.6.ebuild", "sys-apps/funapp/funapp-2.0.ebuild",
+					  "virtual/bleh/bleh-1.ebuild", "eclass/foo.eclass", "profiles/categories" ]:
+			os.makedirs(os.path.join(self.root, os.path.dirname(path)), exist_ok=True)
+			with open(os.path.join(self.root, path), "w") as f:
+				f.write("sys-apps\n" if path == "profiles/categories" else "")
+
+	def tearDown(self):
+
+		shutil.rmtree(self.root)
+
+	def test_scan(self):
+
+		index = TreeIndex.scan(self.root)
+		self.assertEqual(index.categories, [ "sys-apps", "virtual" ])
+		self.assertEqual(index.profile_categories, [ "sys-apps" ])
+		self.assertEqual(index.ebuilds("sys-apps/foobar"), ("foobar-1.5.ebuild", "foobar-1.6.ebuild"))
+		self.assertTrue(index.catpkg_exists("virtual/bleh"))
+		self.assertFalse(index.catpkg_exists("eclass/foo.eclass"))
+		self.assertEqual(index.match_glob("sys-apps/f*"), [ "sys-apps/foobar", "sys-apps/funapp" ])
+
+	def test_save_load_and_update(self):
+
+		index = TreeIndex.scan(self.root, sha1="1" * 40)
+		cache_path = os.path.join(self.root, ".cache/index.idx")
+		index.save(cache_path)
+		loaded = TreeIndex.load(self.root, cache_path)
+		self.assertEqual(loaded.sha1, "1" * 40)
+		self.assertEqual(list(loaded.catpkgs()), list(index.catpkgs()))
+
+		shutil.rmtree(os.path.join(self.root, "sys-apps/funapp"))
+		os.makedirs(os.path.join(self.root, "dev-libs/oni"))
+		open(os.path.join(self.root, "dev-libs/oni/oni-1.0.ebuild"), "w").close()
+		loaded.apply_changes([ "sys-apps/funapp/funapp-2.0.ebuild", "dev-libs/oni/oni-1.0.ebuild" ], sha1="2" * 40)
+		self.assertEqual(list(loaded.catpkgs()), list(TreeIndex.scan(self.root).catpkgs()))
+		self.assertEqual(loaded.sha1, "2" * 40)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+import asyncio
+import os, sys
+import unittest
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+from merge.merge_utils import GitTree
+from fixtures import GitTestCase
+
+class WorktreeTest(GitTestCase):
+
+	def setUp(self):
+
+		super().setUp()
+		self.upstream = self.make_upstream("foo-kit", { "sys-apps/foobar/foobar-master.ebuild": "" })
+		work = os.path.join(self.root, "work", "foo-kit")
+		self.git("checkout", "--quiet", "-b", "next", cwd=work)
+		open(os.path.join(work, "sys-apps/foobar/foobar-next.ebuild"), "w").close()
+		self.git("add", ".", cwd=work)
+		self.git("commit", "--quiet", "-m", "next commit", cwd=work)
+		self.git("push", "--quiet", "origin", "next", cwd=work)
+
+	def test_worktree(self):
+
+		loop = asyncio.get_event_loop()
+		tree = GitTree("foo-kit", "master", config=self.config, url=self.upstream, root=os.path.join(self.config.dest_trees, "foo-kit"))
+		loop.run_until_complete(tree.removeWorktrees())
+		loop.run_until_complete(tree.initialize())
+		wt = loop.run_until_complete(tree.worktree("next"))
+		self.assertEqual(wt.root, tree.root + ".worktrees/next")
+		self.assertEqual(tree.currentLocalBranch, "master")
+		self.assertEqual(wt.currentLocalBranch, "next")
+		self.assertTrue(wt.catpkg_exists("sys-apps/foobar"))
+		self.assertEqual(wt.index.ebuilds("sys-apps/foobar"), ("foobar-master.ebuild", "foobar-next.ebuild"))
+		self.assertEqual(tree.index.ebuilds("sys-apps/foobar"), ("foobar-master.ebuild",))
+
+		# commits made in the worktree land on its branch, and are visible from the main working tree:
+		open(os.path.join(wt.root, "sys-apps/foobar/foobar-2.0.ebuild"), "w").close()
+		loop.run_until_complete(wt.gitCommit(message="updates", push=False))
+		tree.invalidateRefs()
+		self.assertEqual(tree._refTable()["refs/heads/next"], wt.head())
+
+		# a new run starts from scratch:
+		tree = GitTree("foo-kit", "next", config=self.config, url=self.upstream, root=os.path.join(self.config.dest_trees, "foo-kit"))
+		loop.run_until_complete(tree.removeWorktrees())
+		loop.run_until_complete(tree.initialize())
+		self.assertFalse(os.path.exists(wt.root))
+		self.assertEqual(tree.currentLocalBranch, "next")
+
+if __name__ == "__main__":
+	unittest.main()
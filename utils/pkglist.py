@@ -1,24 +1,32 @@
-#!/usr/bin/python3.4
+#!/usr/bin/python3
 
-from src.merge_utils import *
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.realpath(__file__), "../../modules")))
+
+from merge.merge_utils import Tree
+from merge.dep_graph import tree_dep_graph
 
 import portage
 
+
+class KitTree(Tree):
+
+	# a kit in meta-repo, next to the core-kit it uses as its master:
+
+	def __init__(self, name, root):
+		self.name = name
+		self.root = root
+		self.config = SimpleNamespace(dest_trees=os.path.dirname(root))
+
 cur_name = sys.argv[1]
 cur_tree = "/var/git/meta-repo/kits/" + cur_name
-cur_overlay = GitTree(cur_name, root=cur_tree)
-env = os.environ.copy()
-env['PORTAGE_DEPCACHEDIR'] = '/var/cache/edb/%s-%s-meta' % (cur_overlay.name, cur_overlay.branch)
-env['PORTAGE_REPOSITORIES'] = '''
-[DEFAULT]
-main-repo = %s
-
-[%s]
-location = %s
-''' % (cur_name, cur_name, cur_tree)
+cur_overlay = KitTree(cur_name, cur_tree)
 
 p_global = portage.portdbapi()
-#mysettings=portage.config(env=env, config_profile_path=''))
 v = portage.vardbapi()
 
 results = {
@@ -48,46 +56,23 @@ results = {
 #			else:
 #				results["orphaned"] += inst_match
 
-p = portage.portdbapi(mysettings=portage.config(env=env, config_profile_path=''))
+# the same dependency graph that @depsincat@ uses, built from the kit's md5-cache:
+graph = asyncio.get_event_loop().run_until_complete(tree_dep_graph(cur_overlay, depcachedir='/var/cache/edb/%s-meta' % cur_name))
 mypkgs = {}
 kit_count = {}
-cp_all = p.cp_all()
-for catpkg in cp_all:
-	for pkg in p.cp_list(catpkg):
-		if pkg == '':
-			print("No match for %s" % catpkg)
-			continue
-		try:
-			aux = p.aux_get(pkg, ["DEPEND", "RDEPEND"])
-		except PortageKeyError:
-			print("Portage key error for %s" % repr(pkg))
-			continue
+for catpkg in graph.tree_catpkgs():
+	for mypkg in graph.dependencies(catpkg):
 		try:
-			f = flatten(use_reduce(aux[0]+" "+aux[1], matchall=True))
-		except portage.exception.InvalidDependString:
-			print("bad dep string in " + pkg + ": " + aux[0] + " " + aux[1])
+			kit = p_global.better_cache[mypkg][0].name
+		except KeyError:
+			kit = "(none)"
+		if kit == sys.argv[1]:
 			continue
-		for dep in f:
-			if len(dep) and dep[0] == "!":
-				continue
-			try:
-				mypkg = dep_getkey(dep)
-			except portage.exception.InvalidAtom:
-				continue
-			try:
-				kit = p_global.better_cache[mypkg][0].name
-			except KeyError:
-				kit = "(none)"
-			if kit == sys.argv[1]:
-				continue
-			if mypkg not in cp_all:
-				if mypkg not in mypkgs:
-					mypkgs[mypkg] = []
-				if catpkg not in mypkgs[mypkg]:
-					mypkgs[mypkg].append(catpkg)
-			if kit not in kit_count:
-				kit_count[kit] = 0
-			kit_count[kit] += 1
+		if not graph.in_tree(mypkg):
+			mypkgs[mypkg] = graph.dependents(mypkg)
+		if kit not in kit_count:
+			kit_count[kit] = 0
+		kit_count[kit] += 1
 print("External dependency            Packages with dependency")
 print("=============================  ================================================================")
 for pkg in sorted(mypkgs.keys()):